@@ -0,0 +1,190 @@
+import collections
+import json
+import logging
+import os
+import statistics
+import threading
+import time
+from typing import Dict, List, Optional
+
+from processor import path_to_log_dir
+
+logger = logging.getLogger(__name__)
+
+TOP_SLOW_DOMAINS = 10  # how many of the slowest domains to include in the summary
+THROUGHPUT_BUCKET_SECS = 60
+
+
+class CrawlStats:
+    """
+    Structured per-URL metrics for a crawl, so we can tell if the time is going to DNS, slow servers, throttling or
+    extraction. Each URL gets one record (a plain dict), filled in as we see its response, failure and extraction.
+    """
+
+    def __init__(self):
+        self.started = time.time()
+        self._records: Dict[str, Dict] = {}
+        self._lock = threading.Lock()
+
+    def _record_for(self, url: str, domain: str) -> Dict:
+        if url not in self._records:
+            self._records[url] = dict(
+                url=url,
+                domain=domain,
+                status=None,
+                latency=None,
+                bytes=None,
+                redirects=0,
+                failure=None,
+                extraction_secs=None,
+                extracted=False,
+                finished=None,  # seconds since the crawl started
+            )
+        return self._records[url]
+
+    def record_response(
+        self,
+        url: str,
+        domain: str,
+        status: int,
+        latency: Optional[float],
+        body_bytes: int,
+        redirects: int,
+    ) -> None:
+        with self._lock:
+            record = self._record_for(url, domain)
+            record.update(
+                status=status,
+                latency=latency,
+                bytes=body_bytes,
+                redirects=redirects,
+                finished=time.time() - self.started,
+            )
+
+    def record_failure(self, url: str, domain: str, failure_class: str) -> None:
+        with self._lock:
+            record = self._record_for(url, domain)
+            record.update(failure=failure_class, finished=time.time() - self.started)
+
+    def record_extraction(
+        self, url: str, domain: str, seconds: float, success: bool
+    ) -> None:
+        with self._lock:
+            record = self._record_for(url, domain)
+            record.update(extraction_secs=seconds, extracted=success)
+
+    def records(self) -> List[Dict]:
+        return list(self._records.values())
+
+    def merge(self, records: List[Dict], started: float) -> None:
+        """
+        Take in records from a crawl that ran in another process (ie. a shard), shifting its times to line up with ours.
+        """
+        offset = started - self.started
+        with self._lock:
+            for record in records:
+                record = dict(record)
+                if record["finished"] is not None:
+                    record["finished"] += offset
+                self._records[record["url"]] = record
+
+    def summary(self) -> Dict:
+        records = self.records()
+        by_domain = collections.defaultdict(list)
+        for r in records:
+            if r["latency"] is not None:
+                by_domain[r["domain"]].append(r["latency"])
+        slow_domains = sorted(
+            [
+                dict(domain=d, median_latency=statistics.median(lats), urls=len(lats))
+                for d, lats in by_domain.items()
+            ],
+            key=lambda d: d["median_latency"],
+            reverse=True,
+        )[:TOP_SLOW_DOMAINS]
+        failures = collections.Counter(
+            [r["failure"] for r in records if r["failure"] is not None]
+        )
+        throughput = collections.Counter(
+            [
+                int(r["finished"] // THROUGHPUT_BUCKET_SECS)
+                for r in records
+                if r["finished"] is not None
+            ]
+        )
+        latencies = [r["latency"] for r in records if r["latency"] is not None]
+        return dict(
+            urls=len(records),
+            responses=len([r for r in records if r["status"] is not None]),
+            extracted=len([r for r in records if r["extracted"]]),
+            failures=dict(failures.most_common()),
+            bytes=sum([r["bytes"] for r in records if r["bytes"] is not None]),
+            redirects=sum([r["redirects"] for r in records]),
+            median_latency=statistics.median(latencies) if latencies else None,
+            extraction_secs=sum(
+                [r["extraction_secs"] for r in records if r["extraction_secs"]]
+            ),
+            duration_secs=time.time() - self.started,
+            slow_domains=slow_domains,
+            # URLs finished in each bucket of THROUGHPUT_BUCKET_SECS since the crawl started
+            throughput=(
+                [throughput.get(i, 0) for i in range(max(throughput) + 1)]
+                if throughput
+                else []
+            ),
+        )
+
+    def log_summary(self) -> Dict:
+        summary = self.summary()
+        logger.info(
+            "Crawled {} URLs in {:.0f} secs: {} responses, {} extracted, {:.1f} MB, median latency {}, "
+            "{:.0f} secs extracting".format(
+                summary["urls"],
+                summary["duration_secs"],
+                summary["responses"],
+                summary["extracted"],
+                summary["bytes"] / (1024 * 1024),
+                (
+                    "{:.2f} secs".format(summary["median_latency"])
+                    if summary["median_latency"] is not None
+                    else "n/a"
+                ),
+                summary["extraction_secs"],
+            )
+        )
+        logger.info(f"  failures: {summary['failures']}")
+        logger.info(
+            "  slowest domains: {}".format(
+                ", ".join(
+                    [
+                        "{} ({:.1f}s x {})".format(
+                            d["domain"], d["median_latency"], d["urls"]
+                        )
+                        for d in summary["slow_domains"]
+                    ]
+                )
+            )
+        )
+        logger.info(
+            f"  URLs finished per {THROUGHPUT_BUCKET_SECS} secs: {summary['throughput']}"
+        )
+        return summary
+
+    def save(self, label: str) -> str:
+        """
+        Write the summary and raw per-URL records to the logs dir, so we can use them to tune the crawler later.
+        :return: the path to the file written
+        """
+        path = os.path.join(
+            path_to_log_dir,
+            "crawl-stats-{}-{}.json".format(label, time.strftime("%Y%m%d-%H%M%S")),
+        )
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump(
+                dict(summary=self.summary(), records=self.records()),
+                f,
+                ensure_ascii=False,
+                default=str,
+            )
+        logger.info(f"  saved crawl stats to {path}")
+        return path
@@ -0,0 +1,114 @@
+import calendar
+import datetime as dt
+import logging
+import math
+import os
+from typing import Dict, Optional
+
+logger = logging.getLogger(__name__)
+
+# NewsData gives us a fixed pool of credits each month (one credit per API call, of up to 50 articles)
+ND_MONTHLY_CREDITS = int(os.environ.get("ND_MONTHLY_CREDITS", 20000))
+ND_RUNS_PER_DAY = int(os.environ.get("ND_RUNS_PER_DAY", 1))
+FAIRNESS_FLOOR_CREDITS = int(
+    os.environ.get("ND_FAIRNESS_FLOOR_CREDITS", 1)
+)  # every project gets at least this much, so new or quiet queries still get a look
+MAX_PROJECT_CREDITS = int(
+    os.environ.get("ND_MAX_PROJECT_CREDITS", 20)
+)  # we can't fetch text for too many stories from one project anyway
+YIELD_DAYS = 14  # how far back to look when judging how productive a project's query is
+MIN_YIELD_STORIES = (
+    20  # below this many processed stories we don't trust a project's yield yet
+)
+
+
+def run_budget(
+    monthly_credits: int,
+    spent_this_month: int,
+    spent_today: int,
+    today: dt.date,
+    runs_per_day: int = ND_RUNS_PER_DAY,
+) -> int:
+    """
+    How many credits this run can spend. The credits left in the month are spread evenly over the days left in it, so
+    anything we didn't spend on earlier days (or earlier runs today) carries over.
+    :param monthly_credits: the size of the monthly credit pool
+    :param spent_this_month: credits spent so far this month, including today
+    :param spent_today: credits spent so far today
+    :param today:
+    :param runs_per_day: how many times a day the fetcher runs
+    :return:
+    """
+    days_in_month = calendar.monthrange(today.year, today.month)[1]
+    days_left = days_in_month - today.day + 1  # including today
+    left_before_today = monthly_credits - (spent_this_month - spent_today)
+    daily_allowance = max(0, left_before_today) / days_left
+    left_today = max(0, math.floor(daily_allowance - spent_today))
+    return min(left_today, math.ceil(daily_allowance / runs_per_day))
+
+
+def project_yield(
+    total: int, above: int, min_stories: int = MIN_YIELD_STORIES
+) -> Optional[float]:
+    """
+    :return: the fraction of a project's processed stories that were above threshold, or None if we haven't
+             processed enough of them to say
+    """
+    if total < min_stories:
+        return None
+    return above / total
+
+
+def allocate(
+    budget: int,
+    yields: Dict[int, Optional[float]],
+    floor: int = FAIRNESS_FLOOR_CREDITS,
+    max_credits: int = MAX_PROJECT_CREDITS,
+) -> Dict[int, int]:
+    """
+    Split a run's credit budget across projects. Every project gets the fairness floor first (highest yield first if
+    there isn't enough for everyone), and the rest is handed out in proportion to each project's yield, up to
+    `max_credits` per project. Projects we don't know the yield of yet are treated as average.
+    :param budget: credits to hand out
+    :param yields: project id to fraction of recent stories that were above threshold (None if unknown)
+    :param floor: credits each project gets before yield is taken into account
+    :param max_credits: the most credits any one project can get
+    :return: project id to whole credits; these never add up to more than the budget
+    """
+    known = [y for y in yields.values() if y is not None]
+    prior = (sum(known) / len(known)) if known else 1.0
+    weights = {pid: (prior if y is None else y) for pid, y in yields.items()}
+    by_weight = sorted(weights, key=lambda pid: weights[pid], reverse=True)
+    allocation = {pid: 0 for pid in yields}
+    # first the fairness floor
+    left = budget
+    for pid in by_weight:
+        credits = min(floor, max_credits, left)
+        allocation[pid] = credits
+        left -= credits
+    # then hand out the rest by yield; repeat to pass along anything the projects at their max couldn't take
+    while left > 0:
+        open_pids = [
+            pid
+            for pid in by_weight
+            if allocation[pid] < max_credits and weights[pid] > 0
+        ]
+        if not open_pids:
+            break
+        total_weight = sum(weights[pid] for pid in open_pids)
+        shares = {
+            pid: min(left * weights[pid] / total_weight, max_credits - allocation[pid])
+            for pid in open_pids
+        }
+        handed_out = 0
+        for pid in open_pids:
+            whole = math.floor(shares[pid])
+            allocation[pid] += whole
+            handed_out += whole
+        if handed_out == 0:
+            # all the shares are fractions of a credit, so give single credits out to the best projects
+            for pid in open_pids[:left]:
+                allocation[pid] += 1
+                handed_out += 1
+        left -= handed_out
+    return allocation
@@ -0,0 +1,24 @@
+"""add story sampling rate
+
+Revision ID: 3f8b1d6c2a47
+Revises: e4a7c19b2d56
+Create Date: 2026-10-19 18:05:12.481305
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '3f8b1d6c2a47'
+down_revision = 'e4a7c19b2d56'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column('stories', sa.Column('sampling_rate', sa.Float, nullable=True))
+
+
+def downgrade():
+    op.drop_column('stories', 'sampling_rate')
@@ -0,0 +1,35 @@
+"""add domain health
+
+Revision ID: 5a1f0c3e9b27
+Revises: 036b1381b853
+Create Date: 2026-10-19 09:12:44.318205
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '5a1f0c3e9b27'
+down_revision = '036b1381b853'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table(
+        'domain_health',
+        sa.Column('domain', sa.String, primary_key=True),
+        sa.Column('success_count', sa.Integer, default=0),
+        sa.Column('failure_count', sa.Integer, default=0),
+        sa.Column('consecutive_failures', sa.Integer, default=0),
+        sa.Column('median_latency', sa.Float, nullable=True),
+        sa.Column('last_failure_class', sa.String, nullable=True),
+        sa.Column('last_failure_date', sa.DateTime(), nullable=True),
+        sa.Column('circuit_opened_date', sa.DateTime(), nullable=True),
+        sa.Column('updated_at', sa.DateTime()),
+    )
+
+
+def downgrade():
+    op.drop_table('domain_health')
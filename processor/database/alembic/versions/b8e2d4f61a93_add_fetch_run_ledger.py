@@ -0,0 +1,52 @@
+"""add fetch run ledger
+
+Revision ID: b8e2d4f61a93
+Revises: 5a1f0c3e9b27
+Create Date: 2026-10-19 14:03:21.582147
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'b8e2d4f61a93'
+down_revision = '5a1f0c3e9b27'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table(
+        'fetch_runs',
+        sa.Column('id', sa.String, primary_key=True),
+        sa.Column('source', sa.String),
+        sa.Column('started_at', sa.DateTime()),
+        sa.Column('finished_at', sa.DateTime(), nullable=True),
+    )
+    op.create_table(
+        'fetch_run_projects',
+        sa.Column('run_id', sa.String, primary_key=True),
+        sa.Column('project_id', sa.Integer, primary_key=True),
+        sa.Column('story_count', sa.Integer),
+        sa.Column('list_secs', sa.Float, nullable=True),
+        sa.Column('listed_at', sa.DateTime()),
+    )
+    op.create_table(
+        'fetch_run_stories',
+        sa.Column('id', sa.BigInteger, primary_key=True, autoincrement=True),
+        sa.Column('run_id', sa.String),
+        sa.Column('project_id', sa.Integer),
+        sa.Column('url', sa.String),
+        sa.Column('status', sa.String),
+        sa.Column('story', sa.JSON),
+        sa.Column('updated_at', sa.DateTime()),
+    )
+    op.create_index('fetch_run_stories_run_project', 'fetch_run_stories', ['run_id', 'project_id'])
+
+
+def downgrade():
+    op.drop_index('fetch_run_stories_run_project', 'fetch_run_stories')
+    op.drop_table('fetch_run_stories')
+    op.drop_table('fetch_run_projects')
+    op.drop_table('fetch_runs')
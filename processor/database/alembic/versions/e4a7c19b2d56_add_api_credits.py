@@ -0,0 +1,32 @@
+"""add api credits
+
+Revision ID: e4a7c19b2d56
+Revises: b8e2d4f61a93
+Create Date: 2026-10-19 16:22:47.310592
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'e4a7c19b2d56'
+down_revision = 'b8e2d4f61a93'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table(
+        'api_credits',
+        sa.Column('source', sa.String, primary_key=True),
+        sa.Column('project_id', sa.Integer, primary_key=True),
+        sa.Column('day', sa.Date(), primary_key=True),
+        sa.Column('credits', sa.Integer),
+        sa.Column('stories', sa.Integer),
+        sa.Column('updated_at', sa.DateTime()),
+    )
+
+
+def downgrade():
+    op.drop_table('api_credits')
@@ -0,0 +1,80 @@
+import datetime as dt
+import logging
+from typing import Dict, Tuple
+
+from sqlalchemy import Integer, func, select
+from sqlalchemy.orm.session import Session
+
+from processor.database.models import ApiCredits, Story
+
+logger = logging.getLogger(__name__)
+
+
+def add_credits(
+    session: Session,
+    source: str,
+    project_id: int,
+    credits: int,
+    stories: int,
+    day: dt.date = None,
+) -> None:
+    """
+    Budget: record API credits spent (and stories queued with them) for a project today.
+    :param session:
+    :param source:
+    :param project_id:
+    :param credits:
+    :param stories:
+    :param day: defaults to today
+    :return:
+    """
+    day = day or dt.date.today()
+    row = session.get(ApiCredits, (source, project_id, day))
+    if row is None:
+        row = ApiCredits(
+            source=source, project_id=project_id, day=day, credits=0, stories=0
+        )
+        session.add(row)
+    row.credits += credits
+    row.stories += stories
+    row.updated_at = dt.datetime.now()
+    session.commit()
+
+
+def credits_spent(session: Session, source: str, since: dt.date) -> int:
+    """
+    Budget: how many credits we have spent on a source, across all projects, from a day on.
+    """
+    total = session.execute(
+        select(func.sum(ApiCredits.credits)).where(
+            ApiCredits.source == source, ApiCredits.day >= since
+        )
+    ).scalar()
+    return total or 0
+
+
+def project_yields(
+    session: Session, source: str, last_n_days: int
+) -> Dict[int, Tuple[int, int]]:
+    """
+    Budget: how productive each project's stories from a source have been recently.
+    :param session:
+    :param source:
+    :param last_n_days:
+    :return: project id to (stories processed, stories above threshold)
+    """
+    earliest = dt.datetime.now() - dt.timedelta(days=last_n_days)
+    rows = session.execute(
+        select(
+            Story.project_id,
+            func.count(),
+            func.sum(Story.above_threshold.cast(Integer)),
+        )
+        .where(
+            Story.source == source,
+            Story.queued_date > earliest,
+            Story.above_threshold.is_not(None),
+        )
+        .group_by(Story.project_id)
+    )
+    return {project_id: (total, above or 0) for project_id, total, above in rows}
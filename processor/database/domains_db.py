@@ -0,0 +1,50 @@
+import datetime as dt
+import logging
+
+from sqlalchemy import select
+from sqlalchemy.orm.session import Session
+
+from processor.database.models import DomainHealth
+from processor.domain_health import DomainHealthTracker
+
+logger = logging.getLogger(__name__)
+
+_HEALTH_COLUMNS = [
+    "domain",
+    "success_count",
+    "failure_count",
+    "consecutive_failures",
+    "median_latency",
+    "last_failure_class",
+    "last_failure_date",
+    "circuit_opened_date",
+]
+
+
+def load_domain_health(session: Session) -> DomainHealthTracker:
+    """
+    Crawler: load what we know about how each domain has behaved on previous runs.
+    :param session:
+    :return: a tracker primed with all the saved per-domain records
+    """
+    rows = session.execute(select(DomainHealth)).scalars().all()
+    records = [{col: getattr(row, col) for col in _HEALTH_COLUMNS} for row in rows]
+    return DomainHealthTracker(records)
+
+
+def save_domain_health(session: Session, tracker: DomainHealthTracker) -> None:
+    """
+    Crawler: save the records for domains we saw on this run, so the next run can skip the unhealthy ones.
+    :param session:
+    :param tracker:
+    :return:
+    """
+    tracker.finish_run()
+    now = dt.datetime.now()
+    records = tracker.updated_records()
+    for record in records:
+        row = DomainHealth(**record)
+        row.updated_at = now
+        session.merge(row)
+    session.commit()
+    logger.info(f"  saved health for {len(records)} domains")
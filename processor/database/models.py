@@ -4,7 +4,7 @@ from typing import Dict
 
 import mcmetadata.urls as urls
 from dateutil.parser import parse
-from sqlalchemy import Boolean, DateTime, Float, Integer, String
+from sqlalchemy import JSON, Boolean, Date, DateTime, Float, Integer, String
 from sqlalchemy.orm import DeclarativeBase, Mapped, mapped_column
 
 logger = logging.getLogger(__name__)
@@ -31,6 +31,9 @@ class Story(Base):
     source: Mapped[str] = mapped_column(String)
     url: Mapped[str] = mapped_column(String)
     normalized_url: Mapped[str] = mapped_column(String)
+    sampling_rate: Mapped[float] = mapped_column(
+        Float, nullable=True
+    )  # the fraction of its query's matches we kept, if it was sampled (see processor.sampling)
 
     def __repr__(self):
         return "<Story id={} source={}>".format(self.id, self.source)
@@ -43,6 +46,7 @@ class Story(Base):
             story["url"]
         )  # this will help in de-duplication
         db_story.source = source
+        db_story.sampling_rate = story.get("sampling_rate")
         # carefully parse date, with fallback to today so we at least get something close to right
         use_fallback_date = False
         try:
@@ -78,3 +82,78 @@ class ProjectHistory(Base):
 
     def __repr__(self):
         return "<ProjectHistory id={}>".format(self.id)
+
+
+class DomainHealth(Base):
+    __tablename__ = "domain_health"
+
+    domain: Mapped[str] = mapped_column(String, primary_key=True)
+    success_count: Mapped[int] = mapped_column(Integer)
+    failure_count: Mapped[int] = mapped_column(Integer)
+    consecutive_failures: Mapped[int] = mapped_column(Integer)
+    median_latency: Mapped[float] = mapped_column(Float, nullable=True)
+    last_failure_class: Mapped[str] = mapped_column(String, nullable=True)
+    last_failure_date: Mapped[dt.datetime] = mapped_column(DateTime, nullable=True)
+    circuit_opened_date: Mapped[dt.datetime] = mapped_column(DateTime, nullable=True)
+    updated_at: Mapped[dt.datetime] = mapped_column(DateTime)
+
+    def __repr__(self):
+        return "<DomainHealth domain={}>".format(self.domain)
+
+
+class FetchRun(Base):
+    __tablename__ = "fetch_runs"
+
+    id: Mapped[str] = mapped_column(String, primary_key=True)
+    source: Mapped[str] = mapped_column(String)
+    started_at: Mapped[dt.datetime] = mapped_column(DateTime)
+    finished_at: Mapped[dt.datetime] = mapped_column(DateTime, nullable=True)
+
+    def __repr__(self):
+        return "<FetchRun id={}>".format(self.id)
+
+
+class FetchRunProject(Base):
+    __tablename__ = "fetch_run_projects"
+
+    run_id: Mapped[str] = mapped_column(String, primary_key=True)
+    project_id: Mapped[int] = mapped_column(Integer, primary_key=True)
+    story_count: Mapped[int] = mapped_column(Integer)
+    list_secs: Mapped[float] = mapped_column(Float, nullable=True)
+    listed_at: Mapped[dt.datetime] = mapped_column(DateTime)
+
+    def __repr__(self):
+        return "<FetchRunProject run_id={} project_id={}>".format(
+            self.run_id, self.project_id
+        )
+
+
+class FetchRunStory(Base):
+    __tablename__ = "fetch_run_stories"
+
+    id: Mapped[int] = mapped_column(primary_key=True)
+    run_id: Mapped[str] = mapped_column(String)
+    project_id: Mapped[int] = mapped_column(Integer)
+    url: Mapped[str] = mapped_column(String)
+    status: Mapped[str] = mapped_column(String)
+    story: Mapped[Dict] = mapped_column(JSON)
+    updated_at: Mapped[dt.datetime] = mapped_column(DateTime)
+
+    def __repr__(self):
+        return "<FetchRunStory id={} status={}>".format(self.id, self.status)
+
+
+class ApiCredits(Base):
+    __tablename__ = "api_credits"
+
+    source: Mapped[str] = mapped_column(String, primary_key=True)
+    project_id: Mapped[int] = mapped_column(Integer, primary_key=True)
+    day: Mapped[dt.date] = mapped_column(Date, primary_key=True)
+    credits: Mapped[int] = mapped_column(Integer)
+    stories: Mapped[int] = mapped_column(Integer)
+    updated_at: Mapped[dt.datetime] = mapped_column(DateTime)
+
+    def __repr__(self):
+        return "<ApiCredits source={} project_id={} day={}>".format(
+            self.source, self.project_id, self.day
+        )
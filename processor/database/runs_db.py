@@ -0,0 +1,196 @@
+import collections
+import datetime as dt
+import logging
+import statistics
+from typing import Dict, List, Optional, Tuple
+
+from sqlalchemy import delete, select, update
+from sqlalchemy.orm.session import Session
+
+from processor.database.models import FetchRun, FetchRunProject, FetchRunStory
+
+logger = logging.getLogger(__name__)
+
+
+def start_run(session: Session, run_id: str, source: str) -> bool:
+    """
+    Ledger: start a new fetch run, or pick up one that was interrupted. A run that already finished is cleared out and
+    started over.
+    :param session:
+    :param run_id:
+    :param source:
+    :return: True if we are resuming an unfinished run
+    """
+    run = session.get(FetchRun, run_id)
+    if run is not None and run.finished_at is None:
+        return True
+    if run is not None:
+        session.execute(delete(FetchRunStory).where(FetchRunStory.run_id == run_id))
+        session.execute(delete(FetchRunProject).where(FetchRunProject.run_id == run_id))
+        session.delete(run)
+        session.flush()
+    session.add(FetchRun(id=run_id, source=source, started_at=dt.datetime.now()))
+    session.commit()
+    return False
+
+
+def prune_runs(session: Session, source: str, started_before: dt.datetime) -> int:
+    """
+    Ledger: delete the runs of a source that started before a time, along with their projects and stories. Each day
+    gets a new run id, so otherwise these pile up forever.
+    :param session:
+    :param source:
+    :param started_before:
+    :return: the number of runs deleted
+    """
+    run_ids = (
+        session.execute(
+            select(FetchRun.id).where(
+                FetchRun.source == source, FetchRun.started_at < started_before
+            )
+        )
+        .scalars()
+        .all()
+    )
+    if run_ids:
+        session.execute(delete(FetchRunStory).where(FetchRunStory.run_id.in_(run_ids)))
+        session.execute(
+            delete(FetchRunProject).where(FetchRunProject.run_id.in_(run_ids))
+        )
+        session.execute(delete(FetchRun).where(FetchRun.id.in_(run_ids)))
+        session.commit()
+    return len(run_ids)
+
+
+def finish_run(session: Session, run_id: str) -> None:
+    run = session.get(FetchRun, run_id)
+    run.finished_at = dt.datetime.now()
+    session.commit()
+
+
+def add_listed_project(
+    session: Session,
+    run_id: str,
+    project_id: int,
+    stories: List[Dict],
+    status: str,
+    list_secs: Optional[float] = None,
+) -> None:
+    """
+    Ledger: save all the stories we listed for a project, so a resumed run doesn't have to query for them again.
+    :param session:
+    :param run_id:
+    :param project_id:
+    :param stories: story metadata dicts (they have to be JSON serializable)
+    :param status: the status to start each story off with
+    :param list_secs: how long the listing took
+    :return:
+    """
+    now = dt.datetime.now()
+    session.add_all(
+        [
+            FetchRunStory(
+                run_id=run_id,
+                project_id=project_id,
+                url=s["url"],
+                status=status,
+                story=s,
+                updated_at=now,
+            )
+            for s in stories
+        ]
+    )
+    session.merge(
+        FetchRunProject(
+            run_id=run_id,
+            project_id=project_id,
+            story_count=len(stories),
+            list_secs=list_secs,
+            listed_at=now,
+        )
+    )
+    session.commit()
+
+
+def project_list_secs(
+    session: Session, source: str, last_n_runs: int
+) -> Dict[int, float]:
+    """
+    Planner: how long each project has typically taken to list, in the recent runs of a source.
+    :param session:
+    :param source:
+    :param last_n_runs:
+    :return: project id to the median seconds it took
+    """
+    run_ids = (
+        select(FetchRun.id)
+        .where(FetchRun.source == source)
+        .order_by(FetchRun.started_at.desc())
+        .limit(last_n_runs)
+    )
+    rows = session.execute(
+        select(FetchRunProject.project_id, FetchRunProject.list_secs).where(
+            FetchRunProject.run_id.in_(run_ids), FetchRunProject.list_secs.is_not(None)
+        )
+    )
+    secs_by_project = collections.defaultdict(list)
+    for project_id, list_secs in rows:
+        secs_by_project[project_id].append(list_secs)
+    return {pid: statistics.median(secs) for pid, secs in secs_by_project.items()}
+
+
+def listed_stories(session: Session, run_id: str) -> Dict[int, List[Dict]]:
+    """
+    :return: the stories for each project that was already listed in this run
+    """
+    project_ids = session.execute(
+        select(FetchRunProject.project_id).where(FetchRunProject.run_id == run_id)
+    ).scalars()
+    stories = {project_id: [] for project_id in project_ids}
+    rows = session.execute(
+        select(FetchRunStory.project_id, FetchRunStory.story).where(
+            FetchRunStory.run_id == run_id
+        )
+    )
+    for project_id, story in rows:
+        stories[project_id].append(story)
+    return stories
+
+
+def story_statuses(session: Session, run_id: str) -> Dict[Tuple[int, str], str]:
+    """
+    :return: the status of each (project_id, url) in the run
+    """
+    rows = session.execute(
+        select(FetchRunStory.project_id, FetchRunStory.url, FetchRunStory.status).where(
+            FetchRunStory.run_id == run_id
+        )
+    )
+    return {(project_id, url): status for project_id, url, status in rows}
+
+
+def update_story_statuses(
+    session: Session, run_id: str, keys: List[Tuple[int, str]], status: str
+) -> None:
+    """
+    :param session:
+    :param run_id:
+    :param keys: (project_id, url) for each story to update
+    :param status:
+    :return:
+    """
+    urls_by_project = collections.defaultdict(list)
+    for project_id, url in keys:
+        urls_by_project[project_id].append(url)
+    now = dt.datetime.now()
+    for project_id, urls in urls_by_project.items():
+        session.execute(
+            update(FetchRunStory)
+            .where(
+                FetchRunStory.run_id == run_id,
+                FetchRunStory.project_id == project_id,
+                FetchRunStory.url.in_(urls),
+            )
+            .values(status=status, updated_at=now)
+        )
+    session.commit()
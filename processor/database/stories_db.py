@@ -1,9 +1,9 @@
 import copy
 import datetime as dt
 import logging
-from typing import Dict, List
+from typing import Dict, List, Set
 
-from sqlalchemy import delete, select, text, update
+from sqlalchemy import Integer, delete, select, text, update
 from sqlalchemy.exc import IntegrityError
 from sqlalchemy.orm.session import Session
 from sqlalchemy.sql import func
@@ -42,6 +42,28 @@ def project_story_normalized_urls(
     return [s.normalized_url for s in matching]
 
 
+def project_existing_normalized_urls(
+    session: Session, project_id: int, normalized_urls: List[str]
+) -> Set[str]:
+    """
+    Find which of some URLs we already have stories for in this project (ie. the ones `add_stories` would ignore as
+    duplicates). Helpful for skipping stories before we bother fetching their text.
+    :param session:
+    :param project_id:
+    :param normalized_urls:
+    :return: the subset of `normalized_urls` already in the DB for this project
+    """
+    existing = set()
+    chunk_size = 1000  # keep the IN clause a reasonable size
+    for i in range(0, len(normalized_urls), chunk_size):
+        query = select(Story.normalized_url).where(
+            Story.project_id == project_id,
+            Story.normalized_url.in_(normalized_urls[i : i + chunk_size]),
+        )
+        existing.update(session.execute(query).scalars())
+    return existing
+
+
 def add_stories(
     session: Session, source_story_list: List[Dict], project: Dict, source: str
 ) -> List[Dict]:
@@ -169,6 +191,50 @@ def recent_stories(
     return result.scalars().all()
 
 
+def project_story_stats(
+    session: Session, source: str, last_n_days: int
+) -> Dict[int, Dict[str, int]]:
+    """
+    Caps: how much each project has gotten from a source recently, and how much of it was useful.
+    :param session:
+    :param source:
+    :param last_n_days:
+    :return: project id to counts of stories `processed`, `above` threshold and `posted`, plus the most stories
+             queued on any one day (`busiest_day`)
+    """
+    earliest = dt.datetime.now() - dt.timedelta(days=last_n_days)
+    recent = (Story.source == source) & (Story.queued_date > earliest)
+    stats = {}
+    rows = session.execute(
+        select(
+            Story.project_id,
+            func.count(Story.above_threshold),
+            func.sum(Story.above_threshold.cast(Integer)),
+            func.count(Story.posted_date),
+        )
+        .where(recent)
+        .group_by(Story.project_id)
+    )
+    for project_id, processed, above, posted in rows:
+        stats[project_id] = dict(
+            processed=processed, above=above or 0, posted=posted, busiest_day=0
+        )
+    by_day = (
+        select(Story.project_id, func.count().label("stories"))
+        .where(recent)
+        .group_by(Story.project_id, func.date(Story.queued_date))
+        .subquery()
+    )
+    rows = session.execute(
+        select(by_day.c.project_id, func.max(by_day.c.stories)).group_by(
+            by_day.c.project_id
+        )
+    )
+    for project_id, busiest_day in rows:
+        stats[project_id]["busiest_day"] = busiest_day
+    return stats
+
+
 def _stories_by_date_col(
     session: Session,
     column_name: str,
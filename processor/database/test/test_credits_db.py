@@ -0,0 +1,56 @@
+import datetime as dt
+import unittest
+
+import processor
+import processor.database as database
+import processor.database.credits_db as credits_db
+import processor.database.models as models
+
+
+class TestCreditsDb(unittest.TestCase):
+    def setUp(self):
+        models.Base.metadata.create_all(
+            database._get_engine(), tables=[models.ApiCredits.__table__]
+        )
+
+    def tearDown(self):
+        Session = database.get_session_maker()
+        with Session() as session:
+            session.query(models.ApiCredits).delete()
+            session.commit()
+
+    def test_credits_spent(self):
+        today = dt.date.today()
+        Session = database.get_session_maker()
+        with Session() as session:
+            credits_db.add_credits(session, processor.SOURCE_NEWSDATA, 1, 3, 120)
+            credits_db.add_credits(session, processor.SOURCE_NEWSDATA, 1, 2, 80)
+            credits_db.add_credits(session, processor.SOURCE_NEWSDATA, 2, 4, 150)
+            credits_db.add_credits(
+                session,
+                processor.SOURCE_NEWSDATA,
+                2,
+                10,
+                400,
+                day=today - dt.timedelta(days=1),
+            )
+            assert (
+                credits_db.credits_spent(session, processor.SOURCE_NEWSDATA, today) == 9
+            )
+            assert (
+                credits_db.credits_spent(
+                    session, processor.SOURCE_NEWSDATA, today - dt.timedelta(days=1)
+                )
+                == 19
+            )
+            assert (
+                credits_db.credits_spent(session, processor.SOURCE_MEDIA_CLOUD, today)
+                == 0
+            )
+            row = session.get(models.ApiCredits, (processor.SOURCE_NEWSDATA, 1, today))
+            assert row.credits == 5
+            assert row.stories == 200
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,101 @@
+import datetime as dt
+import unittest
+
+from sqlalchemy import select
+
+import processor.database as database
+import processor.database.models as models
+import processor.database.runs_db as runs_db
+import processor.run_ledger as run_ledger
+from processor.run_ledger import RunLedger
+
+TEST_RUN_ID = "test-run"
+LEDGER_TABLES = [
+    models.FetchRun.__table__,
+    models.FetchRunProject.__table__,
+    models.FetchRunStory.__table__,
+]
+
+
+class TestRunLedger(unittest.TestCase):
+    def setUp(self):
+        models.Base.metadata.create_all(database._get_engine(), tables=LEDGER_TABLES)
+
+    def tearDown(self):
+        Session = database.get_session_maker()
+        with Session() as session:
+            session.query(models.FetchRunStory).delete()
+            session.query(models.FetchRunProject).delete()
+            session.query(models.FetchRun).delete()
+            session.commit()
+
+    def test_resume(self):
+        stories = [
+            dict(url=f"http://a.com/{i}", project_id=1, title=f"story {i}")
+            for i in range(4)
+        ]
+        ledger = RunLedger("test", TEST_RUN_ID)
+        assert not ledger.resuming
+        assert ledger.listed_stories(1) is None
+        ledger.record_listed(1, stories, 1.5)
+        ledger.mark(stories[:2], run_ledger.FETCHED)
+        ledger.mark(stories[:1], run_ledger.QUEUED)
+        ledger.mark(stories[3:], run_ledger.FAILED)
+        ledger.flush()
+        # pretend we crashed, and came back with the same run id
+        ledger = RunLedger("test", TEST_RUN_ID)
+        assert ledger.resuming
+        assert ledger.listed_stories(1) == stories
+        assert ledger.listed_stories(2) is None
+        remaining = ledger.remaining(ledger.listed_stories(1))
+        assert [s["url"] for s in remaining] == ["http://a.com/1", "http://a.com/2"]
+        assert ledger.status(stories[1]) == run_ledger.FETCHED
+        # once a run finishes, starting it again starts over
+        ledger.finish()
+        ledger = RunLedger("test", TEST_RUN_ID)
+        assert not ledger.resuming
+        assert ledger.listed_stories(1) is None
+
+    def test_project_list_secs(self):
+        for day, secs in enumerate([10, 30, 20]):
+            ledger = RunLedger("test", f"test-run-{day}")
+            ledger.record_listed(1, [], secs)
+            ledger.record_listed(2, [], secs * 2)
+            ledger.finish()
+        RunLedger("other", "other-run").record_listed(1, [], 500)
+        Session = database.get_session_maker()
+        with Session() as session:
+            assert runs_db.project_list_secs(session, "test", 5) == {1: 20, 2: 40}
+
+    def test_prune_runs(self):
+        story = dict(url="http://a.com/1", project_id=1)
+        for run_id in ["test-old", "test-new"]:
+            ledger = RunLedger("test", run_id)
+            ledger.record_listed(1, [story], 1)
+            ledger.finish()
+        RunLedger("other", "other-old").record_listed(1, [story], 1)
+        Session = database.get_session_maker()
+        with Session() as session:
+            long_ago = dt.datetime.now() - dt.timedelta(
+                days=run_ledger.RUN_LEDGER_KEEP_DAYS + 1
+            )
+            for run_id in ["test-old", "other-old"]:
+                session.get(models.FetchRun, run_id).started_at = long_ago
+            session.commit()
+        # starting a new run clears out the old ones from the same source, and everything they listed
+        RunLedger("test", "test-newest")
+        with Session() as session:
+            run_ids = set(session.scalars(select(models.FetchRun.id)))
+            assert run_ids == {"test-new", "test-newest", "other-old"}
+            assert set(session.scalars(select(models.FetchRunProject.run_id))) == {
+                "test-new",
+                "other-old",
+            }
+            assert set(session.scalars(select(models.FetchRunStory.run_id))) == {
+                "test-new",
+                "other-old",
+            }
+
+
+if __name__ == "__main__":
+    unittest.main()
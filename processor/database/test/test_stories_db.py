@@ -1,3 +1,4 @@
+import datetime as dt
 import unittest
 
 import processor
@@ -55,3 +56,36 @@ class TestStoriesDb(unittest.TestCase):
         # try to add them again
         assert self._story_count() == len(stories_to_queue)
         self._remove_all_stories()
+
+    def test_project_story_stats(self):
+        now = dt.datetime.now()
+        Session = database.get_session_maker()
+        with Session() as session:
+            for i, (project_id, above, posted, days_ago) in enumerate(
+                [
+                    (1, True, True, 1),
+                    (1, False, False, 1),
+                    (1, None, False, 2),
+                    (2, True, False, 1),
+                    (2, True, False, 30),  # too old to count
+                ]
+            ):
+                session.add(
+                    models.Story(
+                        project_id=project_id,
+                        source=processor.SOURCE_NEWSCATCHER,
+                        url=f"https://example.com/{i}",
+                        normalized_url=f"example.com/{i}",
+                        queued_date=now - dt.timedelta(days=days_ago),
+                        above_threshold=above,
+                        posted_date=now if posted else None,
+                    )
+                )
+            session.commit()
+            stats = stories_db.project_story_stats(
+                session, processor.SOURCE_NEWSCATCHER, 14
+            )
+        assert stats == {
+            1: dict(processed=2, above=1, posted=1, busiest_day=2),
+            2: dict(processed=1, above=1, posted=0, busiest_day=1),
+        }
@@ -0,0 +1,189 @@
+import datetime as dt
+import logging
+import statistics
+import threading
+from collections import defaultdict
+from typing import Dict, List, Optional
+from urllib.parse import urlparse
+
+logger = logging.getLogger(__name__)
+
+CIRCUIT_FAILURE_THRESHOLD = (
+    5  # consecutive failures before we stop sending requests to a domain
+)
+CIRCUIT_MIN_ATTEMPTS = (
+    10  # don't judge success rate until we've tried a domain this many times
+)
+CIRCUIT_MIN_SUCCESS_RATE = (
+    0.1  # below this success rate we stop sending requests to a domain
+)
+CIRCUIT_PROBE_HOURS = (
+    24  # how long an open circuit waits before we let a probe request through
+)
+PROBE_URL_COUNT = 1  # how many URLs to let through when probing an open circuit
+MAX_TRACKED_ATTEMPTS = (
+    200  # decay counts past this, so success rate follows recent behaviour
+)
+
+
+def domain_for_url(url: str) -> str:
+    return urlparse(url).netloc
+
+
+class DomainHealthTracker:
+    """
+    Remembers how each domain we crawl has behaved, so we can stop wasting crawler slots on ones that reliably time
+    out or block us. This is a simple circuit breaker - after too many failures a domain's circuit "opens" and we skip
+    it, then every CIRCUIT_PROBE_HOURS we let a probe URL through and close the circuit again if it works.
+    Records are plain dicts (matching the `domain_health` table) so they can be persisted across runs.
+    """
+
+    def __init__(self, records: Optional[List[Dict]] = None):
+        self._records: Dict[str, Dict] = {r["domain"]: dict(r) for r in (records or [])}
+        self._run_latencies: Dict[str, List[float]] = defaultdict(list)
+        self._updated_domains = set()
+        self.skipped: Dict[str, int] = defaultdict(
+            int
+        )  # domain to URLs skipped during this run
+        self._lock = threading.Lock()
+
+    def _record_for(self, domain: str) -> Dict:
+        if domain not in self._records:
+            self._records[domain] = dict(
+                domain=domain,
+                success_count=0,
+                failure_count=0,
+                consecutive_failures=0,
+                median_latency=None,
+                last_failure_class=None,
+                last_failure_date=None,
+                circuit_opened_date=None,
+            )
+        return self._records[domain]
+
+    @staticmethod
+    def _decay(record: Dict) -> None:
+        if (record["success_count"] + record["failure_count"]) > MAX_TRACKED_ATTEMPTS:
+            record["success_count"] = record["success_count"] // 2
+            record["failure_count"] = record["failure_count"] // 2
+
+    def record_success(self, domain: str, latency: Optional[float] = None) -> None:
+        with self._lock:
+            record = self._record_for(domain)
+            record["success_count"] += 1
+            record["consecutive_failures"] = 0
+            if record["circuit_opened_date"] is not None:
+                logger.info(f"  closing circuit for {domain} (probe succeeded)")
+            record["circuit_opened_date"] = None
+            self._decay(record)
+            if latency is not None:
+                self._run_latencies[domain].append(latency)
+            self._updated_domains.add(domain)
+
+    def record_failure(self, domain: str, failure_class: str) -> None:
+        with self._lock:
+            record = self._record_for(domain)
+            now = dt.datetime.now()
+            record["failure_count"] += 1
+            record["consecutive_failures"] += 1
+            record["last_failure_class"] = failure_class
+            record["last_failure_date"] = now
+            self._decay(record)
+            attempts = record["success_count"] + record["failure_count"]
+            too_many_in_a_row = (
+                record["consecutive_failures"] >= CIRCUIT_FAILURE_THRESHOLD
+            )
+            too_unreliable = (attempts >= CIRCUIT_MIN_ATTEMPTS) and (
+                (record["success_count"] / attempts) < CIRCUIT_MIN_SUCCESS_RATE
+            )
+            if too_many_in_a_row or too_unreliable:
+                # (re)start the wait, so a failed probe pushes the next one back
+                record["circuit_opened_date"] = now
+            self._updated_domains.add(domain)
+
+    def success_rate(self, domain: str) -> Optional[float]:
+        record = self._records.get(domain)
+        if record is None:
+            return None
+        attempts = record["success_count"] + record["failure_count"]
+        return (record["success_count"] / attempts) if attempts > 0 else None
+
+    def median_latency(self, domain: str) -> Optional[float]:
+        record = self._records.get(domain)
+        return record["median_latency"] if record else None
+
+    def is_open(self, domain: str) -> bool:
+        record = self._records.get(domain)
+        return (record is not None) and (record["circuit_opened_date"] is not None)
+
+    def probe_due(self, domain: str, now: Optional[dt.datetime] = None) -> bool:
+        if not self.is_open(domain):
+            return False
+        now = now or dt.datetime.now()
+        opened = self._records[domain]["circuit_opened_date"]
+        return (now - opened) >= dt.timedelta(hours=CIRCUIT_PROBE_HOURS)
+
+    def record_skip(self, domain: str, url_count: int = 1) -> None:
+        with self._lock:
+            self.skipped[domain] += url_count
+
+    def filter_domain_groups(self, domain_groups: List[List[str]]) -> List[List[str]]:
+        """
+        Drop URLs from domains whose circuit is open. If a domain is due for a probe, only keep a few of its URLs.
+        Skipped URLs are counted up in `self.skipped`.
+        :param domain_groups: lists of URLs, one per domain (ie. from `fetcher.group_urls_by_domain`)
+        :return: the groups to crawl
+        """
+        now = dt.datetime.now()
+        allowed = []
+        for group in domain_groups:
+            domain = domain_for_url(group[0])
+            if not self.is_open(domain):
+                allowed.append(group)
+            elif self.probe_due(domain, now):
+                allowed.append(group[:PROBE_URL_COUNT])
+                if len(group) > PROBE_URL_COUNT:
+                    self.record_skip(domain, len(group) - PROBE_URL_COUNT)
+            else:
+                self.record_skip(domain, len(group))
+        return allowed
+
+    def finish_run(self) -> None:
+        """
+        Fold the latencies we saw this run into the smoothed per-domain median.
+        """
+        with self._lock:
+            for domain, latencies in self._run_latencies.items():
+                record = self._record_for(domain)
+                run_median = statistics.median(latencies)
+                if record["median_latency"] is None:
+                    record["median_latency"] = run_median
+                else:
+                    record["median_latency"] = (
+                        record["median_latency"] + run_median
+                    ) / 2
+            self._run_latencies.clear()
+
+    def records_for(self, domains: List[str]) -> List[Dict]:
+        """
+        :return: saved records for just these domains (ie. to hand to a crawl running in another process)
+        """
+        return [dict(self._records[d]) for d in set(domains) if d in self._records]
+
+    def merge_run(self, records: List[Dict], skipped: Dict[str, int]) -> None:
+        """
+        Take in the results of a crawl that ran in another process with its own tracker. That tracker should have
+        already called `finish_run`. Domains are crawled by just one process, so its records replace ours.
+        """
+        with self._lock:
+            for record in records:
+                self._records[record["domain"]] = dict(record)
+                self._updated_domains.add(record["domain"])
+            for domain, count in skipped.items():
+                self.skipped[domain] += count
+
+    def updated_records(self) -> List[Dict]:
+        """
+        :return: records for just the domains that we saw during this run (the ones that need saving)
+        """
+        return [dict(self._records[d]) for d in self._updated_domains]
@@ -0,0 +1,75 @@
+import logging
+import math
+import os
+import random
+from typing import Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+JITTER_SECS = int(
+    os.environ.get("FETCH_SCHEDULE_JITTER_SECS", 5 * 60)
+)  # runs start up to this long after their slot, so sources don't all hit the DB and queue at the same second
+
+
+class SourceSchedule:
+    """
+    When a source's fetch runs. Runs start on fixed slots, every `interval_hours` counted from `offset_hours` past
+    midnight UTC (so "24@22" is every day at 22:00 UTC, like the cron jobs did), plus a random jitter. Slots are
+    fixed in time rather than counted from when the last run finished, so a slow run doesn't push every later run
+    back; the scheduler skips any slot that comes up while the source's last run is still going.
+    """
+
+    def __init__(
+        self,
+        source: str,
+        interval_hours: float,
+        offset_hours: float = 0,
+        jitter_secs: int = JITTER_SECS,
+    ):
+        """
+        :param source: one of the processor.SOURCE_* names
+        :param interval_hours: time between runs; 0 turns the source off
+        :param offset_hours: how far past midnight UTC the slots start
+        :param jitter_secs: the most a run can start after its slot
+        """
+        self.source = source
+        self.interval_secs = interval_hours * 60 * 60
+        self.offset_secs = offset_hours * 60 * 60
+        self.jitter_secs = jitter_secs
+
+    @classmethod
+    def parse(
+        cls, source: str, spec: str, jitter_secs: int = JITTER_SECS
+    ) -> "SourceSchedule":
+        """
+        :param source:
+        :param spec: "<interval hours>[@<offset hours>]", eg. "24@22" or "6"
+        :param jitter_secs:
+        :return:
+        """
+        interval, _, offset = spec.strip().partition("@")
+        return cls(source, float(interval), float(offset or 0), jitter_secs)
+
+    @property
+    def enabled(self) -> bool:
+        return self.interval_secs > 0
+
+    def slot_start(self, now: float) -> float:
+        """
+        :param now: epoch seconds
+        :return: the start of the slot `now` is in
+        """
+        slots = math.floor((now - self.offset_secs) / self.interval_secs)
+        return self.offset_secs + slots * self.interval_secs
+
+    def next_run(
+        self, after: float, rng: Optional[random.Random] = None
+    ) -> Tuple[float, float]:
+        """
+        :param after: epoch seconds
+        :param rng: for the jitter
+        :return: the first slot that starts after `after`, and when the run for it should start (the slot plus jitter)
+        """
+        rng = rng or random
+        slot = self.slot_start(after) + self.interval_secs
+        return slot, slot + rng.uniform(0, self.jitter_secs)
@@ -1,17 +1,54 @@
 import collections
+import heapq
 import logging
-from typing import Any, Callable, Dict, List, Optional
+import multiprocessing
+import os
+import queue
+import statistics
+import time
+from typing import Any, AsyncIterator, Callable, Dict, List, Optional
 from urllib.parse import urlparse
 
 import scrapy
 import scrapy.crawler as crawler
-from scrapy.http import Response
+from scrapy import signals
+from scrapy.exceptions import StopDownload
+from scrapy.http import Headers, Response
+from scrapy.spidermiddlewares.httperror import HttpError
 from scrapy.utils.reactor import install_reactor
 from twisted.internet import defer
+from twisted.python.failure import Failure
+
+from processor.crawl_stats import CrawlStats
+from processor.domain_health import DomainHealthTracker, domain_for_url
 
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.DEBUG)
 
+DEFAULT_DOMAIN_LATENCY = (
+    1.0  # seconds per URL to assume when we know nothing about any domain
+)
+# PDFs, videos and giant live blogs aren't useful to us, and eat up memory if we decode them, so set a budget
+MAX_BODY_BYTES = int(os.environ.get("FETCHER_MAX_BODY_BYTES", 3 * 1024 * 1024))
+OVERSIZE_TRUNCATE = (
+    "truncate"  # keep the start of the page (where the article usually is)
+)
+OVERSIZE_DROP = "drop"
+OVERSIZE_POLICY = os.environ.get("FETCHER_OVERSIZE_POLICY", OVERSIZE_TRUNCATE)
+ALLOWED_CONTENT_TYPES = [
+    "text/html",
+    "application/xhtml+xml",
+    "text/plain",
+    "application/json",  # for pre-extracted content (ie. Wayback Machine)
+]
+# crawl in this many child processes (0 means crawl in this process), each with a share of the domains
+FETCHER_PROCESSES = int(os.environ.get("FETCHER_PROCESSES", 0))
+RESULTS_QUEUE_SIZE = (
+    1000  # bounded so child crawls back off if the parent falls behind handling stories
+)
+_MSG_STORY = "story"
+_MSG_DONE = "done"
+
 
 class UrlSpider(scrapy.Spider):
     name: str = "urlspider"
@@ -33,36 +70,193 @@ class UrlSpider(scrapy.Spider):
         handle_parse: Optional[Callable],
         start_urls: List[str],
         *args: List,
+        domain_health: Optional[DomainHealthTracker] = None,
+        priorities: Optional[Dict[str, int]] = None,
+        max_body_bytes: int = MAX_BODY_BYTES,
+        oversize_policy: str = OVERSIZE_POLICY,
+        allowed_content_types: Optional[List[str]] = None,
+        crawl_stats: Optional[CrawlStats] = None,
         **kwargs: Dict,
     ) -> None:
         """
         Handle_parse will be called with a story:Dict object
-        :param handle_parse: called with story_data dict of "content", "final_url", "original_url" keys for each story
+        :param handle_parse: called with story_data dict of "content", "final_url", "original_url" keys for each story;
+                             returns True if it got text out of it (for the crawl stats)
         :param start_urls: lst of URLs to fetch
         :param args: passed to parent constructor
+        :param domain_health: optional tracker to record successes/failures in, and to skip domains that go bad
+        :param priorities: optional dict of URL to Scrapy request priority (higher goes first)
+        :param max_body_bytes: responses bigger than this are truncated or dropped (based on `oversize_policy`)
+        :param oversize_policy: OVERSIZE_TRUNCATE or OVERSIZE_DROP
+        :param allowed_content_types: responses with other content types are dropped before we download the body
+        :param crawl_stats: optional collector for per-URL metrics
         :param kwargs: passed to parent constructor
         """
         super().__init__(*args, **kwargs)
         self.on_parse = handle_parse
         self.start_urls = start_urls
+        self.domain_health = domain_health
+        self.priorities = priorities or {}
+        self.max_body_bytes = max_body_bytes
+        self.oversize_policy = oversize_policy
+        self.allowed_content_types = allowed_content_types or ALLOWED_CONTENT_TYPES
+        self.crawl_stats = crawl_stats
         logging.getLogger("scrapy").setLevel(logging.DEBUG)
         logging.getLogger("scrapy.core.engine").setLevel(logging.DEBUG)
 
+    @classmethod
+    def from_crawler(cls, crawler_obj: crawler.Crawler, *args: Any, **kwargs: Any):
+        spider = super().from_crawler(crawler_obj, *args, **kwargs)
+        # check size and type as the response streams in, so we can stop before we download or decode it all
+        crawler_obj.signals.connect(
+            spider.on_headers_received, signal=signals.headers_received
+        )
+        crawler_obj.signals.connect(
+            spider.on_bytes_received, signal=signals.bytes_received
+        )
+        crawler_obj.signals.connect(
+            spider.on_response_received, signal=signals.response_received
+        )
+        crawler_obj.signals.connect(spider.on_closed, signal=signals.spider_closed)
+        return spider
+
+    def on_closed(self, spider: scrapy.Spider, reason: str) -> None:
+        if (
+            reason == "closespider_timeout"
+        ):  # ran into the run deadline (see `fetch_all_html`)
+            self.crawler.stats.inc_value("fetcher/timed_out")
+
+    def on_response_received(
+        self, response: Response, request: scrapy.Request, spider: scrapy.Spider
+    ) -> None:
+        # sent for the final response (after redirects), whatever the status
+        if self.crawl_stats:
+            self.crawl_stats.record_response(
+                request.url,
+                domain_for_url(request.url),
+                response.status,
+                request.meta.get("download_latency"),
+                len(response.body),
+                len(request.meta.get("redirect_urls", [])),
+            )
+
+    def _stop_oversize(self, request: scrapy.Request) -> None:
+        if self.oversize_policy == OVERSIZE_DROP:
+            self.crawler.stats.inc_value("fetcher/dropped_oversize")
+            raise StopDownload(fail=True)
+        self.crawler.stats.inc_value("fetcher/truncated")
+        request.meta["truncated"] = True
+        raise StopDownload(fail=False)  # hands the partial body to `parse`
+
+    def on_headers_received(
+        self,
+        headers: Headers,
+        body_length: int,
+        request: scrapy.Request,
+        spider: scrapy.Spider,
+    ) -> None:
+        # each download starts here, and retries and redirects copy the meta over, so start the body count again
+        request.meta["body_bytes"] = 0
+        request.meta.pop("truncated", None)
+        content_type = _mime_type(headers)
+        if content_type and (content_type not in self.allowed_content_types):
+            self.crawler.stats.inc_value("fetcher/dropped_content_type")
+            raise StopDownload(fail=True)
+        if (body_length is not None) and (body_length > self.max_body_bytes):
+            if self.oversize_policy == OVERSIZE_DROP:  # no point downloading any of it
+                self._stop_oversize(request)
+
+    def on_bytes_received(
+        self, data: bytes, request: scrapy.Request, spider: scrapy.Spider
+    ) -> None:
+        request.meta["body_bytes"] = request.meta.get("body_bytes", 0) + len(data)
+        if request.meta["body_bytes"] > self.max_body_bytes:
+            self._stop_oversize(request)
+
+    async def start(self) -> AsyncIterator[Any]:
+        # Scrapy pulls these lazily, so a domain whose circuit opens part way through the run gets skipped from then on
+        for url in self.start_urls:
+            domain = domain_for_url(url)
+            if self.domain_health and self.domain_health.is_open(domain):
+                if not self.domain_health.probe_due(domain):
+                    self.domain_health.record_skip(domain)
+                    continue
+            yield scrapy.Request(
+                url,
+                callback=self.parse,
+                errback=self.errback,
+                dont_filter=True,
+                priority=self.priorities.get(url, 0),
+            )
+
+    def errback(self, failure: Failure) -> None:
+        failure_class = _failure_class(failure)
+        if self.crawl_stats:
+            self.crawl_stats.record_failure(
+                failure.request.url, domain_for_url(failure.request.url), failure_class
+            )
+        if failure.check(StopDownload):
+            return  # we stopped it on purpose (wrong type or too big), which isn't the domain's fault
+        if self.domain_health:
+            self.domain_health.record_failure(
+                domain_for_url(failure.request.url), failure_class
+            )
+
     def parse(self, response: Response, **kwargs: Any) -> Any:
+        if self.domain_health:
+            self.domain_health.record_success(
+                domain_for_url(response.url), response.meta.get("download_latency")
+            )
         # grab the original, undirected URL so we can relink later
         orig_url = (
             response.request.meta["redirect_urls"][0]
             if "redirect_urls" in response.request.meta
             else response.request.url
         )
-        story_data = dict(
-            content=response.text, final_url=response.request.url, original_url=orig_url
-        )
         if self.on_parse:
-            self.on_parse(story_data)
+            story_data = dict(
+                content=response.text,
+                final_url=response.request.url,
+                original_url=orig_url,
+            )
+            extraction_start = time.time()
+            extracted = False
+            try:
+                extracted = bool(self.on_parse(story_data))
+            finally:
+                if self.crawl_stats:
+                    self.crawl_stats.record_extraction(
+                        response.request.url,
+                        domain_for_url(response.request.url),
+                        time.time() - extraction_start,
+                        extracted,
+                    )
+            del story_data  # let go of the page text as soon as it has been handled
         return None
 
 
+def _mime_type(headers: Headers) -> Optional[str]:
+    content_type = headers.get(b"Content-Type")
+    if not content_type:
+        return None
+    return content_type.decode("latin-1").split(";")[0].strip().lower()
+
+
+def _failure_class(failure: Failure) -> str:
+    # "HttpError403" tells us a lot more than just "HttpError" about why a domain is failing
+    if failure.check(HttpError):
+        return "HttpError{}".format(failure.value.response.status)
+    return failure.type.__name__
+
+
+def _extracted(story_data: Optional[Dict]) -> bool:
+    # the preprocessing (if any) kept the story, and there's some text to show for it
+    if story_data is None:
+        return False
+    text = story_data.get("text_content", story_data.get("content"))
+    return bool(text and text.strip())
+
+
 def group_urls_by_domain(urls: List[str]) -> List[List[str]]:
     """
     Groups URLs by their domain. Skips URLs that do not have extractable domains.
@@ -77,47 +271,389 @@ def group_urls_by_domain(urls: List[str]) -> List[List[str]]:
     return list(domain_groups.values())
 
 
-def fetch_all_html(
-    urls: List[str], handle_parse: Callable, num_spiders: int = 4
-) -> None:
-    if not urls:
-        return
+def _domain_costs(
+    domain_groups: List[List[str]], domain_health: Optional[DomainHealthTracker]
+) -> List[float]:
+    # estimated wall-clock cost of each domain: URL count x historical median latency (or just URL count if no history)
+    if domain_health is None:
+        return [float(len(group)) for group in domain_groups]
+    latencies = [
+        domain_health.median_latency(domain_for_url(g[0])) for g in domain_groups
+    ]
+    known_latencies = [latency for latency in latencies if latency is not None]
+    # domains we haven't seen before are assumed to be typical ones
+    typical_latency = (
+        statistics.median(known_latencies)
+        if known_latencies
+        else DEFAULT_DOMAIN_LATENCY
+    )
+    return [
+        len(group) * (latency if latency is not None else typical_latency)
+        for group, latency in zip(domain_groups, latencies)
+    ]
 
-    # logging.info("=== fetch_all_html START ===")
-    # logging.info(f"Processing {len(urls)} URLs")
-    domain_list = group_urls_by_domain(urls)
-    batches = [[] for _ in range(num_spiders)]
-    for i, domain_urls in enumerate(domain_list):
-        batches[i % num_spiders].extend(domain_urls)
+
+def order_domain_groups(
+    domain_groups: List[List[str]],
+    domain_health: Optional[DomainHealthTracker] = None,
+) -> List[List[str]]:
+    """
+    Sort domain groups so the most expensive ones come first. Slow or big domains that start late become the long pole
+    at the end of a run, so we want them to start as early as possible.
+    :param domain_groups: lists of URLs, one per domain (ie. from `group_urls_by_domain`)
+    :param domain_health: optional tracker with historical per-domain latencies
+    :return: the same groups, most expensive first
+    """
+    costs = _domain_costs(domain_groups, domain_health)
+    order = sorted(range(len(domain_groups)), key=lambda i: costs[i], reverse=True)
+    return [domain_groups[i] for i in order]
+
+
+def _url_priorities(ordered_domain_groups: List[List[str]]) -> Dict[str, int]:
+    # Go through the URLs in "waves" of as many as each domain can have in flight at once, and within each wave start
+    # with the most expensive domains. This starts the long poles first without letting one giant domain hog all the
+    # global request slots while only CONCURRENT_REQUESTS_PER_DOMAIN of them can actually download.
+    per_domain = UrlSpider.custom_settings["CONCURRENT_REQUESTS_PER_DOMAIN"]
+    domain_count = len(ordered_domain_groups)
+    priorities = {}
+    for rank, group in enumerate(ordered_domain_groups):
+        for position, url in enumerate(group):
+            wave = position // per_domain
+            priorities[url] = (domain_count - rank) - (wave * domain_count)
+    return priorities
+
+
+def balance_domain_groups(
+    ordered_domain_groups: List[List[str]],
+    num_batches: int,
+    domain_health: Optional[DomainHealthTracker] = None,
+) -> List[List[str]]:
+    """
+    Spread domains across batches (one per spider) so each batch has about the same estimated cost. Greedily gives the
+    next most expensive domain to the batch with the least work so far. All URLs from a domain stay in one batch.
+    """
+    costs = _domain_costs(ordered_domain_groups, domain_health)
+    batches = [[] for _ in range(num_batches)]
+    batch_costs = [
+        (0.0, i) for i in range(num_batches)
+    ]  # a min-heap of (cost so far, batch index)
+    for group, cost in zip(ordered_domain_groups, costs):
+        batch_cost, batch_index = heapq.heappop(batch_costs)
+        batches[batch_index].extend(group)
+        heapq.heappush(batch_costs, (batch_cost + cost, batch_index))
+    return batches
+
+
+_STAT_KEYS = ["dropped_content_type", "dropped_oversize", "truncated", "timed_out"]
+
+
+def _crawl(
+    domain_list: List[List[str]],
+    priorities: Dict[str, int],
+    handle_parse: Callable,
+    num_spiders: int,
+    domain_health: Optional[DomainHealthTracker],
+    crawl_stats: CrawlStats,
+    spider_kwargs: Dict,
+    deadline: Optional[float] = None,
+) -> Dict[str, int]:
+    # run all the spiders in the reactor of this process (remember the reactor can't be restarted once it stops!)
+    batches = balance_domain_groups(domain_list, num_spiders, domain_health)
+    for (
+        batch
+    ) in (
+        batches
+    ):  # start requests are pulled lazily, so list them in priority order too
+        batch.sort(key=lambda url: priorities[url], reverse=True)
 
     logging.debug(
         f"Created {len(batches)} batches, first batch has {len(batches[0])} URLs"
     )
 
     # Single runner for ALL spiders
-    # logging.info("Install reactor...")
     install_reactor("twisted.internet.asyncioreactor.AsyncioSelectorReactor")
-    # logging.info("Reactor installed")
     from twisted.internet import reactor  # call after install
 
-    # logging.info("Creating CrawlerRunner...")
-    runner = crawler.CrawlerRunner()
-    # logging.info("CrawlerRunner created")
+    settings = {}
+    if deadline is not None:
+        # worked out here, so a crawl in a child process gets what is left when it actually starts
+        settings["CLOSESPIDER_TIMEOUT"] = max(deadline - time.time(), 1)
+    runner = crawler.CrawlerRunner(settings)
+    crawlers = []
+    deferreds = []
+    for batch in batches:
+        if not batch:
+            continue
+        c = runner.create_crawler(UrlSpider)
+        crawlers.append(c)  # hold on to them so we can read their stats after
+        deferreds.append(
+            runner.crawl(
+                c,
+                handle_parse=handle_parse,
+                start_urls=batch,
+                domain_health=domain_health,
+                priorities=priorities,
+                crawl_stats=crawl_stats,
+                **spider_kwargs,
+            )
+        )
+
+    dl = defer.DeferredList(deferreds)
+    dl.addBoth(lambda _: reactor.stop())
+    reactor.run()
+
+    counts = {key: 0 for key in _STAT_KEYS}
+    for c in crawlers:
+        for key in _STAT_KEYS:
+            counts[key] += c.stats.get_value("fetcher/{}".format(key), 0)
+    return counts
+
 
-    # logging.info("About to call runner.crawl()...")
-    deferreds = [
-        runner.crawl(UrlSpider, handle_parse=handle_parse, start_urls=batch)
-        for batch in batches
-        if batch
+def _crawl_shard(
+    urls: List[str],
+    priorities: Dict[str, int],
+    num_spiders: int,
+    health_records: Optional[List[Dict]],
+    spider_kwargs: Dict,
+    preprocess: Optional[Callable],
+    deadline: Optional[float],
+    results_queue: multiprocessing.Queue,
+) -> None:
+    # runs in a child process, sending each (preprocessed) story back to the parent as soon as it is ready
+    domain_health = (
+        DomainHealthTracker(health_records) if health_records is not None else None
+    )
+
+    crawl_stats = CrawlStats()
+
+    def handle_parse(story_data: Dict) -> bool:
+        if preprocess:
+            story_data = preprocess(story_data)
+        if story_data is None:
+            return False
+        results_queue.put((_MSG_STORY, story_data))
+        return _extracted(story_data)
+
+    domain_list = order_domain_groups(group_urls_by_domain(urls), domain_health)
+    counts = _crawl(
+        domain_list,
+        priorities,
+        handle_parse,
+        num_spiders,
+        domain_health,
+        crawl_stats,
+        spider_kwargs,
+        deadline,
+    )
+    health = None
+    if domain_health:
+        domain_health.finish_run()
+        health = dict(
+            records=domain_health.updated_records(),
+            skipped=dict(domain_health.skipped),
+        )
+    stats = dict(records=crawl_stats.records(), started=crawl_stats.started)
+    results_queue.put((_MSG_DONE, dict(counts=counts, health=health, stats=stats)))
+
+
+def _crawl_in_processes(
+    domain_list: List[List[str]],
+    priorities: Dict[str, int],
+    handle_parse: Callable,
+    preprocess: Optional[Callable],
+    num_spiders: int,
+    num_processes: int,
+    domain_health: Optional[DomainHealthTracker],
+    crawl_stats: CrawlStats,
+    spider_kwargs: Dict,
+    deadline: Optional[float] = None,
+) -> Dict[str, int]:
+    # Each shard gets whole domains, so per-domain politeness still holds. We spawn fresh processes (rather than fork)
+    # so each gets its own clean reactor, and any memory the crawl leaks goes away when it exits.
+    ctx = multiprocessing.get_context("spawn")
+    results_queue = ctx.Queue(maxsize=RESULTS_QUEUE_SIZE)
+    shards = [
+        shard
+        for shard in balance_domain_groups(domain_list, num_processes, domain_health)
+        if shard
     ]
-    # logging.info(f"runner.crawl() returned, created {len(deferreds)} deferreds")
+    processes = []
+    for shard in shards:
+        health_records = (
+            domain_health.records_for([domain_for_url(url) for url in shard])
+            if domain_health
+            else None
+        )
+        process = ctx.Process(
+            target=_crawl_shard,
+            args=(
+                shard,
+                {url: priorities[url] for url in shard},
+                num_spiders,
+                health_records,
+                spider_kwargs,
+                preprocess,
+                deadline,
+                results_queue,
+            ),
+            daemon=True,
+        )
+        process.start()
+        processes.append(process)
+    logger.info(f"Crawling {len(domain_list)} domains in {len(processes)} processes")
 
-    dl = defer.DeferredList(deferreds)
-    # logging.info("DeferredList created")
+    counts = {key: 0 for key in _STAT_KEYS}
+    running = len(processes)
+    while running > 0:
+        try:
+            kind, payload = results_queue.get(timeout=5)
+        except queue.Empty:
+            if any(p.is_alive() for p in processes):
+                continue
+            try:  # everything has exited, but make sure we didn't miss a last message
+                kind, payload = results_queue.get_nowait()
+            except queue.Empty:
+                logger.error(f"  {running} crawl processes died without finishing")
+                break
+        if kind == _MSG_STORY:
+            handle_parse(payload)
+        else:
+            running -= 1
+            for key in _STAT_KEYS:
+                counts[key] += payload["counts"][key]
+            crawl_stats.merge(payload["stats"]["records"], payload["stats"]["started"])
+            if domain_health and payload["health"]:
+                domain_health.merge_run(
+                    payload["health"]["records"], payload["health"]["skipped"]
+                )
+    for p in processes:
+        p.join()
+    return counts
 
-    dl.addBoth(lambda _: reactor.stop())
-    # logging.info("Added stop callback")
 
-    # logging.info("About to call reactor.run()")
-    reactor.run()
-    # logging.info("=== reactor.run() completed ===")
+def fetch_all_html(
+    urls: List[str],
+    handle_parse: Callable,
+    num_spiders: int = 4,
+    domain_health: Optional[DomainHealthTracker] = None,
+    max_body_bytes: int = MAX_BODY_BYTES,
+    oversize_policy: str = OVERSIZE_POLICY,
+    allowed_content_types: Optional[List[str]] = None,
+    num_processes: Optional[int] = None,
+    preprocess: Optional[Callable] = None,
+    deadline: Optional[float] = None,
+) -> Dict:
+    """
+    Fetch all the URLs in parallel, spreading domains across a few spiders so per-domain politeness still holds.
+    :param urls:
+    :param handle_parse: called with a story_data dict for each URL that is successfully fetched
+    :param num_spiders: spiders per process
+    :param domain_health: optional tracker of per-domain health; domains with an open circuit will be skipped
+    :param max_body_bytes: responses bigger than this are truncated or dropped (based on `oversize_policy`)
+    :param oversize_policy: OVERSIZE_TRUNCATE or OVERSIZE_DROP
+    :param allowed_content_types: defaults to ALLOWED_CONTENT_TYPES
+    :param num_processes: 0 to crawl in this process, or a number of child processes to shard domains across
+                          (defaults to the FETCHER_PROCESSES env var)
+    :param preprocess: optional function called with each story_data dict before `handle_parse` gets it. When crawling
+                       in child processes this runs in the child (so use it for CPU-heavy work like extraction), and it
+                       must be a picklable module-level function. Return None to skip the story. The crawl stats only
+                       count a story as extracted if what comes back has some `text_content` (or `content`).
+    :param deadline: optional epoch secs to stop crawling by; URLs not started by then are left out (the ones
+                     already handed to the downloader still finish)
+    :return: a summary with a `skipped_domains` dict of domain to number of URLs skipped because the circuit was open,
+             counts of responses dropped for content type (`dropped_content_type`) or size (`dropped_oversize`),
+             or `truncated` because of size, the number of spiders stopped by the deadline (`timed_out`), and the
+             per-URL `crawl_stats` (a CrawlStats you can `save`)
+    """
+    crawl_stats = CrawlStats()
+    summary = dict(
+        skipped_domains={}, crawl_stats=crawl_stats, **{key: 0 for key in _STAT_KEYS}
+    )
+    if not urls:
+        return summary
+
+    # logging.info("=== fetch_all_html START ===")
+    # logging.info(f"Processing {len(urls)} URLs")
+    domain_list = group_urls_by_domain(urls)
+    if domain_health:
+        domain_list = domain_health.filter_domain_groups(domain_list)
+    # start the slowest and biggest domains first, so they don't end up as the long pole at the end of the run
+    domain_list = order_domain_groups(domain_list, domain_health)
+    priorities = _url_priorities(domain_list)
+    spider_kwargs = dict(
+        max_body_bytes=max_body_bytes,
+        oversize_policy=oversize_policy,
+        allowed_content_types=allowed_content_types,
+    )
+    num_processes = FETCHER_PROCESSES if num_processes is None else num_processes
+    if not domain_list:
+        counts = {}
+    elif (deadline is not None) and (time.time() >= deadline):
+        logger.warning(f"Out of time, not fetching any of {len(urls)} URLs")
+        counts = dict(timed_out=1)
+    elif num_processes > 0:
+        counts = _crawl_in_processes(
+            domain_list,
+            priorities,
+            handle_parse,
+            preprocess,
+            num_spiders,
+            num_processes,
+            domain_health,
+            crawl_stats,
+            spider_kwargs,
+            deadline,
+        )
+    else:
+
+        def on_parse(story_data: Dict) -> bool:
+            if preprocess:
+                story_data = preprocess(story_data)
+            if story_data is None:
+                return False
+            extracted = _extracted(story_data)
+            handle_parse(story_data)
+            return extracted
+
+        counts = _crawl(
+            domain_list,
+            priorities,
+            on_parse,
+            num_spiders,
+            domain_health,
+            crawl_stats,
+            spider_kwargs,
+            deadline,
+        )
+    summary.update(counts)
+    crawl_stats.log_summary()
+
+    if (
+        summary["dropped_content_type"]
+        or summary["dropped_oversize"]
+        or summary["truncated"]
+    ):
+        logger.info(
+            "Dropped {} responses for content type, {} for size (truncated {} more)".format(
+                summary["dropped_content_type"],
+                summary["dropped_oversize"],
+                summary["truncated"],
+            )
+        )
+    if summary["timed_out"]:
+        logger.warning(
+            "Stopped {} spiders at the deadline, before they got to all their URLs".format(
+                summary["timed_out"]
+            )
+        )
+    if domain_health:
+        summary["skipped_domains"] = dict(domain_health.skipped)
+    if summary["skipped_domains"]:
+        logger.info(
+            "Skipped {} URLs from {} domains with open circuits: {}".format(
+                sum(summary["skipped_domains"].values()),
+                len(summary["skipped_domains"]),
+                ", ".join(sorted(summary["skipped_domains"].keys())),
+            )
+        )
+    return summary
@@ -0,0 +1,172 @@
+import logging
+import os
+import random
+import time
+from concurrent.futures import (
+    FIRST_COMPLETED,
+    Future,
+    ThreadPoolExecutor,
+    as_completed,
+    wait,
+)
+from typing import Callable, Dict, List, Optional
+
+import requests
+import requests.adapters
+
+from processor.crawl_stats import CrawlStats
+from processor.domain_health import domain_for_url
+from processor.fetcher import UrlSpider
+
+logger = logging.getLogger(__name__)
+
+# lots of small requests to one host, so use a pool of keep-alive connections instead of the full crawler
+JSON_FETCH_CONCURRENCY = int(os.environ.get("JSON_FETCH_CONCURRENCY", 16))
+JSON_FETCH_RETRIES = int(os.environ.get("JSON_FETCH_RETRIES", 3))
+JSON_FETCH_TIMEOUT = 20  # seconds, same as the crawler's DOWNLOAD_TIMEOUT
+RETRY_BASE_DELAY_SECS = 1.0
+RETRYABLE_STATUSES = [429, 500, 502, 503, 504]
+
+
+class RetryableError(Exception):
+    pass
+
+
+def create_session(concurrency: int = JSON_FETCH_CONCURRENCY) -> requests.Session:
+    """
+    A session whose connection pool is big enough that every worker thread keeps its own connection alive.
+    """
+    session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(
+        pool_connections=1, pool_maxsize=concurrency, max_retries=0
+    )
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    session.headers["User-Agent"] = UrlSpider.custom_settings["USER_AGENT"]
+    return session
+
+
+def _retry_delay(attempt: int) -> float:
+    # exponential backoff with jitter, so the workers don't all come back at the same moment
+    return RETRY_BASE_DELAY_SECS * (2**attempt) * random.uniform(0.5, 1.5)
+
+
+def _fetch_one(
+    session: requests.Session,
+    url: str,
+    fields: Optional[List[str]],
+    retries: int,
+    crawl_stats: CrawlStats,
+    deadline: Optional[float] = None,
+) -> Optional[Dict]:
+    domain = domain_for_url(url)
+    for attempt in range(retries + 1):
+        try:
+            start = time.time()
+            response = session.get(url, timeout=JSON_FETCH_TIMEOUT)
+            latency = time.time() - start
+            crawl_stats.record_response(
+                url,
+                domain,
+                response.status_code,
+                latency,
+                len(response.content),
+                len(response.history),
+            )
+            if response.status_code in RETRYABLE_STATUSES:
+                raise RetryableError(f"HttpError{response.status_code}")
+            response.raise_for_status()
+            # decode here in the worker thread, and only keep the fields asked for so the rest can be freed right away
+            start = time.time()
+            data = response.json()
+            if fields is not None:
+                data = {f: data.get(f) for f in fields}
+            crawl_stats.record_extraction(url, domain, time.time() - start, True)
+            return data
+        except (
+            RetryableError,
+            requests.exceptions.ConnectionError,
+            requests.exceptions.Timeout,
+        ) as e:
+            if attempt < retries:
+                delay = _retry_delay(attempt)
+                # don't wait around for another try we won't have time to use
+                if (deadline is None) or (time.time() + delay < deadline):
+                    time.sleep(delay)
+                    continue
+            crawl_stats.record_failure(
+                url,
+                domain,
+                str(e) if isinstance(e, RetryableError) else e.__class__.__name__,
+            )
+        except Exception as e:
+            # a 404 or a bad JSON doc won't get better if we try again
+            crawl_stats.record_failure(url, domain, e.__class__.__name__)
+            logger.debug(f"Failed to fetch {url}: {e}")
+        return None
+    return None
+
+
+def fetch_all_json(
+    urls: List[str],
+    handle_parse: Callable,
+    fields: Optional[List[str]] = None,
+    concurrency: int = JSON_FETCH_CONCURRENCY,
+    retries: int = JSON_FETCH_RETRIES,
+    deadline: Optional[float] = None,
+) -> Dict:
+    """
+    Fetch a bunch of JSON documents, usually all from one host (ie. Wayback Machine pre-extracted content), over a pool
+    of keep-alive connections. Much lighter than `fetcher.fetch_all_html` for this case, which would group everything
+    into one domain and so only make a few requests at a time.
+    :param urls:
+    :param handle_parse: called (on the calling thread) with a dict of `original_url` and the decoded `content` for
+                         each URL that is successfully fetched
+    :param fields: only keep these top-level fields from each document (defaults to keeping all of it)
+    :param concurrency: how many requests to have in flight at once
+    :param retries: how many times to retry connection errors, timeouts, throttling and server errors
+    :param deadline: optional epoch secs to stop by; URLs that haven't been requested by then are left out
+    :return: a summary with the number `fetched`, `failed` and left out because of the deadline (`unfetched`), and the
+             per-URL `crawl_stats` (a CrawlStats)
+    """
+    crawl_stats = CrawlStats()
+    summary = dict(fetched=0, failed=0, unfetched=0, crawl_stats=crawl_stats)
+    if not urls:
+        return summary
+    session = create_session(concurrency)
+    # bound the number of decoded documents waiting for us, in case `handle_parse` is slower than the fetching
+    max_pending = concurrency * 2
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        pending = {}
+        for index, url in enumerate(urls):
+            if len(pending) >= max_pending:
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    _handle_result(pending.pop(future), future, handle_parse, summary)
+            if (deadline is not None) and (time.time() >= deadline):
+                summary["unfetched"] = len(urls) - index
+                break
+            future = executor.submit(
+                _fetch_one, session, url, fields, retries, crawl_stats, deadline
+            )
+            pending[future] = url
+        for future in as_completed(pending):
+            _handle_result(pending[future], future, handle_parse, summary)
+    session.close()
+    crawl_stats.log_summary()
+    if summary["unfetched"]:
+        logger.warning(
+            f"Out of time, didn't get to {summary['unfetched']} of {len(urls)} URLs"
+        )
+    return summary
+
+
+def _handle_result(
+    url: str, future: Future, handle_parse: Callable, summary: Dict
+) -> None:
+    content = future.result()
+    if content is None:
+        summary["failed"] += 1
+        return
+    summary["fetched"] += 1
+    handle_parse(dict(original_url=url, content=content))
@@ -1,38 +1,142 @@
 import copy
+import fcntl
+import functools
+import json
 import logging
-from typing import Dict, List
+import os
+import tempfile
+import time
+from multiprocessing.pool import ThreadPool
+from typing import Dict, List, Optional, Tuple
 
-from processor import get_mc_directory_client
+from processor import base_dir, get_mc_directory_client
 
 logger = logging.getLogger(__name__)
 
+# collection domain lists are cached on disk, so they are shared by every process (and run) on this host
+DOMAIN_CACHE_DIR = os.environ.get(
+    "DOMAIN_CACHE_DIR", os.path.join(base_dir, "files", "cache")
+)
+DOMAIN_CACHE_TTL_SECS = int(
+    os.environ.get("DOMAIN_CACHE_TTL_SECS", 24 * 60 * 60)
+)  # after this we check if the collection changed
+DOMAIN_CACHE_MAX_AGE_SECS = int(
+    os.environ.get("DOMAIN_CACHE_MAX_AGE_SECS", 7 * 24 * 60 * 60)
+)  # after this we list the whole collection again, even if it looks unchanged
+COLLECTION_THREADS = 8  # collections resolved in parallel
 
-def _domains_for_collection(cid: int) -> List[str]:
+
+def _domains_for_collection(cid: int) -> Tuple[List[str], int]:
+    """
+    :return: the domain names in the collection, and how many sources the directory says it has
+    """
     limit = 1000
     offset = 0
     sources = []
+    source_count = 0
     mc_directory_api = get_mc_directory_client()
     while True:
         response = mc_directory_api.source_list(
             collection_id=cid, limit=limit, offset=offset
         )
+        source_count = response.get("count", source_count)
         # for now we need to remove any sources that have a url_search_string because they are not supported in the API
         # (wildcard search bug on the IA side)
         sources += [r for r in response["results"] if r["url_search_string"] is None]
         if response["next"] is None:
             break
         offset += limit
-    return [
+    domains = [
         s["name"] for s in sources if s["name"] is not None
     ]  # grab just the domain names
+    return domains, source_count
+
+
+def _collection_source_count(cid: int) -> Optional[int]:
+    """
+    A cheap check of how many sources are in a collection (one tiny page), to see if a cached list is still good.
+    """
+    mc_directory_api = get_mc_directory_client()
+    response = mc_directory_api.source_list(collection_id=cid, limit=1, offset=0)
+    return response.get("count")
+
+
+def _cache_path(cid: int, cache_dir: str) -> str:
+    return os.path.join(cache_dir, f"collection-{cid}.json")
+
+
+def _read_cache(path: str) -> Optional[Dict]:
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def _write_cache(path: str, entry: Dict) -> None:
+    # write to a temp file and rename it into place, so readers never see a half-written file
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".tmp")
+    try:
+        with os.fdopen(fd, "w") as f:
+            json.dump(entry, f)
+        os.replace(tmp_path, path)
+    except Exception:
+        os.unlink(tmp_path)
+        raise
+
+
+def domains_for_collection(
+    cid: int,
+    cache_dir: str = DOMAIN_CACHE_DIR,
+    ttl_secs: int = DOMAIN_CACHE_TTL_SECS,
+    max_age_secs: int = DOMAIN_CACHE_MAX_AGE_SECS,
+) -> List[str]:
+    """
+    The domains in a collection, from the disk cache if we have a fresh copy. Once the copy is older than `ttl_secs`
+    we ask the directory how many sources the collection has, and only page through the whole list again if that
+    changed. The count can't tell us about a source being swapped for another one, so once the list itself is older
+    than `max_age_secs` we page through it again anyway. A lock per collection means that if several processes want
+    the same collection, only one of them fetches it and the rest wait and read the result.
+    """
+    os.makedirs(cache_dir, exist_ok=True)
+    path = _cache_path(cid, cache_dir)
+    with open(path + ".lock", "w") as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            entry = _read_cache(path)
+            now = time.time()
+            if entry is not None and now - entry["fetched_at"] < ttl_secs:
+                return entry["domains"]
+            if entry is not None:
+                # caches written before we tracked when the list was last paged through count from their last check
+                entry.setdefault("listed_at", entry["fetched_at"])
+            if entry is not None and now - entry["listed_at"] < max_age_secs:
+                source_count = _collection_source_count(cid)
+                if source_count is not None and source_count == entry["source_count"]:
+                    logger.debug(f"Collection {cid}: unchanged, keeping cached domains")
+                    entry["fetched_at"] = now
+                    _write_cache(path, entry)
+                    return entry["domains"]
+            domains, source_count = _domains_for_collection(cid)
+            _write_cache(
+                path,
+                dict(
+                    collection_id=cid,
+                    domains=domains,
+                    source_count=source_count,
+                    fetched_at=now,
+                    listed_at=now,
+                ),
+            )
+            return domains
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
 
 
 def _domains_for_project(collection_ids: List[int]) -> List[str]:
     all_domains = []
     for cid in collection_ids:  # fetch all the domains in each collection
-        all_domains += _domains_for_collection(
-            cid
-        )  # remove cache because Prefect failing to serials with thread lock error :-(
+        all_domains += domains_for_collection(cid)
     return list(set(all_domains))  # make them unique
 
 
@@ -44,3 +148,38 @@ def fetch_domains_for_projects(project: Dict) -> Dict:
     updated_project = copy.copy(project)
     updated_project["domains"] = domains
     return updated_project
+
+
+def add_domains_to_projects(
+    projects: List[Dict], cache_dir: str = DOMAIN_CACHE_DIR
+) -> List[Dict]:
+    """
+    Look up the domains for every project, resolving each collection only once no matter how many projects use it.
+    :param projects:
+    :param cache_dir: where the collection domain lists are cached
+    :return: copies of the projects, each with a `domains` list
+    """
+    collection_ids = sorted({cid for p in projects for cid in p["media_collections"]})
+    with ThreadPool(COLLECTION_THREADS) as pool:
+        collection_domains = dict(
+            zip(
+                collection_ids,
+                pool.map(
+                    functools.partial(domains_for_collection, cache_dir=cache_dir),
+                    collection_ids,
+                ),
+            )
+        )
+    logger.info(
+        f"Resolved {len(collection_ids)} collections for {len(projects)} projects"
+    )
+    updated_projects = []
+    for p in projects:
+        domains = set()
+        for cid in p["media_collections"]:
+            domains.update(collection_domains[cid])
+        logger.info(f"Project {p['id']}/{p['title']}: found {len(domains)} domains")
+        updated_project = copy.copy(p)
+        updated_project["domains"] = list(domains)
+        updated_projects.append(updated_project)
+    return updated_projects
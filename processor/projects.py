@@ -4,9 +4,10 @@ import logging
 import os
 import sys
 import time
-from typing import Dict, List
+from typing import Dict, List, Set, Tuple, Union
 
 import dateparser
+import mcmetadata.urls as urls
 import pytz
 import requests
 
@@ -14,6 +15,7 @@ import processor.apiclient as apiclient
 import processor.classifiers as classifiers
 import processor.database as database
 import processor.database.projects_db as projects_db
+import processor.database.stories_db as stories_db
 from processor import (
     FEMINICIDE_API_KEY,
     SOURCE_MEDIA_CLOUD,
@@ -43,6 +45,111 @@ def with_countries(all_projects: List[Dict]) -> List[Dict]:
     ]
 
 
+def _canonical_query_value(value):
+    if isinstance(value, str):
+        # same query, even if it was typed with curly quotes or different spacing
+        return " ".join(value.replace("“", '"').replace("”", '"').split())
+    if isinstance(value, list):
+        return tuple(sorted(value))  # collections or domains, in any order
+    return value
+
+
+def query_key(project: Dict, fields: List[str]) -> Tuple:
+    """
+    :return: a canonical key for the query a project sends to a source, built from the project fields it depends on
+    """
+    key = []
+    for field in fields:
+        value = _canonical_query_value(project.get(field))
+        if field in ["language", "newscatcher_country"] and value is not None:
+            value = value.lower()
+        key.append(value)
+    return tuple(key)
+
+
+def coalesce_queries(project_list: List[Dict], fields: List[str]) -> List[List[Dict]]:
+    """
+    Group the projects that would send exactly the same query to a source (regional variants of one partner often
+    do), so each distinct query is only run once and its results are fanned out to every project in the group.
+    :param project_list:
+    :param fields: the project fields the source's query is built from
+    :return: groups of projects, in the order they first appear; the first project in each group is used to query
+    """
+    groups: Dict[Tuple, List[Dict]] = {}
+    for p in project_list:
+        groups.setdefault(query_key(p, fields), []).append(p)
+    if len(groups) < len(project_list):
+        logger.info(
+            "  Coalesced {} projects into {} distinct queries".format(
+                len(project_list), len(groups)
+            )
+        )
+    return list(groups.values())
+
+
+def group_start_end_dates(
+    group: List[Dict],
+    session_maker,
+    day_offset: int,
+    day_window: int,
+    source: str,
+) -> (dt.datetime, dt.datetime):
+    """
+    The widest query window any project in a coalesced group needs (see `query_start_end_dates`).
+    """
+    dates = [
+        query_start_end_dates(p, session_maker, day_offset, day_window, source)
+        for p in group
+    ]
+    return min(d[0] for d in dates), max(d[1] for d in dates)
+
+
+def group_recent_normalized_urls(
+    session_maker, group: List[Dict], last_n_days: int
+) -> Tuple[Dict[int, Set[str]], Set[str]]:
+    """
+    The recently processed URLs for each project in a coalesced group.
+    :return: the normalized URLs for each project id, and the ones every project in the group already has (which the
+             shared query can skip outright)
+    """
+    with session_maker() as session:
+        by_project = {
+            p["id"]: set(
+                stories_db.project_story_normalized_urls(session, p, last_n_days)
+            )
+            for p in group
+        }
+    return by_project, set.intersection(*by_project.values())
+
+
+def fan_out_stories(
+    stories: List[Dict],
+    group: List[Dict],
+    recent_urls_by_project: Dict[int, Set[str]],
+    max_stories: Union[int, Dict[int, int]],
+) -> Dict[int, List[Dict]]:
+    """
+    Hand the stories found by a coalesced query out to each project in the group, as copies tagged with that
+    project's id, leaving out the ones each project has processed recently.
+    :param stories: story dicts with a `url`
+    :param group:
+    :param recent_urls_by_project: from `group_recent_normalized_urls`
+    :param max_stories: the most stories to give any one project, or each project's own cap (see
+                        `processor.story_caps`)
+    :return: the stories for each project id
+    """
+    normalized_urls = [urls.normalize_url(s["url"]) for s in stories]
+    stories_by_project = {}
+    for p in group:
+        recent_urls = recent_urls_by_project[p["id"]]
+        stories_by_project[p["id"]] = [
+            dict(s, project_id=p["id"])
+            for s, u in zip(stories, normalized_urls)
+            if u not in recent_urls
+        ][: max_stories[p["id"]] if isinstance(max_stories, dict) else max_stories]
+    return stories_by_project
+
+
 def load_project_list(
     force_reload: bool = False,
     overwrite_last_story=False,
@@ -0,0 +1,140 @@
+import fcntl
+import logging
+import os
+import tempfile
+import threading
+import time
+
+import processor
+
+logger = logging.getLogger(__name__)
+
+# calls per second allowed to each provider, shared by all the processes on this host
+PROVIDER_RATE_LIMITS = {
+    processor.SOURCE_MEDIA_CLOUD: float(os.environ.get("MC_CALLS_PER_SEC", 2)),
+    processor.SOURCE_WAYBACK_MACHINE: float(os.environ.get("WM_CALLS_PER_SEC", 10)),
+    processor.SOURCE_NEWSDATA: float(os.environ.get("ND_CALLS_PER_SEC", 0.5)),
+}
+# where the shared bucket state files live (they need to be on the same host as all the processes using them)
+RATE_LIMIT_DIR = os.environ.get("RATE_LIMIT_DIR", tempfile.gettempdir())
+
+
+class TokenBucket:
+    """
+    A thread-safe token bucket, shared by all the threads making calls to one provider. Each call takes a token, and
+    tokens refill at `rate` per second up to `capacity`, so calls go out at the provider's limit no matter how many
+    threads are making them.
+    """
+
+    def __init__(self, rate: float, capacity: float = 1):
+        """
+        :param rate: tokens added per second (ie. the allowed calls per second)
+        :param capacity: the most tokens that can build up (ie. how big a burst is allowed)
+        """
+        self.rate = rate
+        self.capacity = capacity
+        self.waited_secs = 0.0  # total time callers have spent waiting for a token
+        self._tokens = capacity
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _refill(self, now: float) -> None:
+        self._tokens = min(
+            self.capacity, self._tokens + (now - self._updated) * self.rate
+        )
+        self._updated = now
+
+    def acquire(self, tokens: float = 1) -> float:
+        """
+        Block until there are enough tokens, then take them.
+        :return: how many seconds we waited
+        """
+        waited = 0.0
+        while True:
+            with self._lock:
+                self._refill(time.monotonic())
+                if self._tokens >= tokens:
+                    self._tokens -= tokens
+                    self.waited_secs += waited
+                    return waited
+                wait_secs = (tokens - self._tokens) / self.rate
+            time.sleep(wait_secs)
+            waited += wait_secs
+
+
+class SharedTokenBucket:
+    """
+    A token bucket shared by every process (and thread) on the host, so a `multiprocessing.Pool` can be sized for
+    throughput without going over the provider's limit. The bucket state lives in a small file that is locked (with
+    `flock`) while a token is taken. It is safe to pass into child processes.
+    """
+
+    def __init__(
+        self,
+        name: str,
+        rate: float,
+        capacity: float = 1,
+        directory: str = RATE_LIMIT_DIR,
+    ):
+        """
+        :param name: the provider name; everything using the same name shares the same bucket
+        :param rate: tokens added per second (ie. the allowed calls per second)
+        :param capacity: the most tokens that can build up (ie. how big a burst is allowed)
+        :param directory: where to keep the bucket state file
+        """
+        self.name = name
+        self.rate = rate
+        self.capacity = capacity
+        self.path = os.path.join(directory, f"ratelimit-{name}.state")
+        self.waited_secs = 0.0  # total time callers in this process have spent waiting
+
+    def _take(self, tokens: float) -> float:
+        """
+        Take the tokens if they are there.
+        :return: 0 if we got them, otherwise how long to wait before there will be enough
+        """
+        fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+        with os.fdopen(fd, "r+") as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                # wall clock, because it has to mean the same thing in every process
+                now = time.time()
+                state = f.read().split()
+                if len(state) == 2:
+                    available = float(state[0]) + (now - float(state[1])) * self.rate
+                    available = min(self.capacity, available)
+                else:
+                    available = self.capacity
+                wait_secs = 0.0
+                if available >= tokens:
+                    available -= tokens
+                else:
+                    wait_secs = (tokens - available) / self.rate
+                f.seek(0)
+                f.truncate()
+                f.write(f"{available} {now}")
+                f.flush()
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+        return wait_secs
+
+    def acquire(self, tokens: float = 1) -> float:
+        """
+        Block until there are enough tokens, then take them.
+        :return: how many seconds we waited
+        """
+        waited = 0.0
+        while True:
+            wait_secs = self._take(tokens)
+            if wait_secs == 0:
+                self.waited_secs += waited
+                return waited
+            time.sleep(wait_secs)
+            waited += wait_secs
+
+
+def shared_rate_limiter(provider: str) -> SharedTokenBucket:
+    """
+    :return: the host-wide rate limiter for a provider (one of the processor.SOURCE_* names)
+    """
+    return SharedTokenBucket(provider, PROVIDER_RATE_LIMITS[provider])
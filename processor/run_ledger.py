@@ -0,0 +1,134 @@
+import collections
+import datetime as dt
+import logging
+import os
+import threading
+from typing import Dict, List, Optional, Tuple
+
+import processor.database as database
+import processor.database.runs_db as runs_db
+
+logger = logging.getLogger(__name__)
+
+# story statuses, in the order they move through a run
+LISTED = "listed"
+FETCHED = "fetched"
+FAILED = "failed"
+QUEUED = "queued"
+DONE_STATUSES = [QUEUED, FAILED]  # stories a resumed run doesn't need to touch again
+
+RUN_LEDGER_ENABLED = os.environ.get("RUN_LEDGER_ENABLED", "true").lower() == "true"
+LEDGER_FLUSH_SIZE = 500  # write status changes to the DB in batches of this many
+# runs older than this are deleted when a new one starts; keep enough for `run_planner.HISTORY_RUNS` daily runs
+RUN_LEDGER_KEEP_DAYS = int(os.environ.get("RUN_LEDGER_KEEP_DAYS", 7))
+
+
+def default_run_id(source: str) -> str:
+    """
+    A run id to use if none was set in the FETCH_RUN_ID env var; one per source per day, so a restarted dyno picks up
+    the run from earlier in the same day.
+    """
+    return os.environ.get("FETCH_RUN_ID", f"{source}-{dt.date.today().isoformat()}")
+
+
+class RunLedger:
+    """
+    Checkpoints each phase of a fetch run in the DB (listed stories per project, then fetched, failed and queued
+    status per story), so if the run is interrupted, running again with the same run id picks up where it stopped
+    instead of listing and downloading everything again. Texts aren't saved, so stories that were fetched but not yet
+    queued will be fetched again.
+    """
+
+    def __init__(self, source: str, run_id: Optional[str] = None):
+        self.source = source
+        self.run_id = run_id or default_run_id(source)
+        self._lock = threading.Lock()
+        # (project_id, url) -> status that still needs to be written to the DB
+        self._pending: Dict[Tuple[int, str], str] = {}
+        Session = database.get_session_maker()
+        with Session() as session:
+            self.resuming = runs_db.start_run(session, self.run_id, source)
+            if self.resuming:
+                self._listed = runs_db.listed_stories(session, self.run_id)
+                self._statuses = runs_db.story_statuses(session, self.run_id)
+            else:
+                self._listed = {}
+                self._statuses = {}
+                pruned = runs_db.prune_runs(
+                    session,
+                    source,
+                    dt.datetime.now() - dt.timedelta(days=RUN_LEDGER_KEEP_DAYS),
+                )
+                if pruned:
+                    logger.info(f"Deleted {pruned} old {source} runs from the ledger")
+        if self.resuming:
+            logger.info(
+                "Resuming run {} ({} projects already listed, {} stories already done)".format(
+                    self.run_id,
+                    len(self._listed),
+                    len([s for s in self._statuses.values() if s in DONE_STATUSES]),
+                )
+            )
+
+    def listed_stories(self, project_id: int) -> Optional[List[Dict]]:
+        """
+        :return: the stories listed for the project earlier in this run, or None if it hasn't been listed yet
+        """
+        return self._listed.get(project_id)
+
+    def record_listed(
+        self, project_id: int, stories: List[Dict], list_secs: Optional[float] = None
+    ) -> None:
+        Session = database.get_session_maker()
+        with Session() as session:
+            runs_db.add_listed_project(
+                session, self.run_id, project_id, stories, LISTED, list_secs
+            )
+        with self._lock:
+            self._listed[project_id] = stories
+            for s in stories:
+                self._statuses[(project_id, s["url"])] = LISTED
+
+    def status(self, story: Dict) -> Optional[str]:
+        return self._statuses.get((story["project_id"], story["url"]))
+
+    def remaining(self, stories: List[Dict]) -> List[Dict]:
+        """
+        :return: the stories that haven't already been queued (or failed) earlier in this run
+        """
+        return [s for s in stories if self.status(s) not in DONE_STATUSES]
+
+    def mark(self, stories: List[Dict], status: str) -> None:
+        """
+        Record a status change for some stories. These are written in batches, so call `flush` (or `finish`) at the end.
+        """
+        with self._lock:
+            for s in stories:
+                key = (s["project_id"], s["url"])
+                self._statuses[key] = status
+                self._pending[key] = status  # only the latest status needs writing
+            if len(self._pending) >= LEDGER_FLUSH_SIZE:
+                self._flush()
+
+    def _flush(self) -> None:
+        keys_by_status = collections.defaultdict(list)
+        for key, status in self._pending.items():
+            keys_by_status[status].append(key)
+        self._pending = {}
+        if len(keys_by_status) == 0:
+            return
+        Session = database.get_session_maker()
+        with Session() as session:
+            for status, keys in keys_by_status.items():
+                runs_db.update_story_statuses(session, self.run_id, keys, status)
+
+    def flush(self) -> None:
+        with self._lock:
+            self._flush()
+
+    def finish(self) -> None:
+        self.flush()
+        Session = database.get_session_maker()
+        with Session() as session:
+            runs_db.finish_run(session, self.run_id)
+        logger.info(f"Finished run {self.run_id}")
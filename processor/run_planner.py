@@ -0,0 +1,207 @@
+import logging
+import os
+import statistics
+import threading
+import time
+from typing import Dict, List, Optional
+
+import processor.database as database
+import processor.database.runs_db as runs_db
+
+logger = logging.getLogger(__name__)
+
+RUN_DEADLINE_SECS = int(
+    os.environ.get("FETCH_RUN_DEADLINE_SECS", 0)
+)  # how long a fetch run can take (0 for no deadline)
+LIST_TIME_SHARE = float(
+    os.environ.get("FETCH_LIST_TIME_SHARE", 0.5)
+)  # for sources that fetch text after listing, the part of the run's time that listing gets
+MIN_PROJECT_SECS = int(
+    os.environ.get("FETCH_MIN_PROJECT_SECS", 15)
+)  # every query gets at least this long, as long as the deadline hasn't passed
+DEFAULT_PROJECT_SECS = (
+    60  # expected time for a query when no project has any history yet
+)
+HISTORY_RUNS = 5  # how many recent runs to look at to judge how long a project takes
+
+
+def expected_secs(
+    groups: List[List[Dict]], history: Dict[int, float]
+) -> Dict[int, float]:
+    """
+    How long we expect each (coalesced) query to take, from how long its projects took to list in recent runs.
+    Queries we have no history for are expected to take as long as the typical one.
+    :param groups: from `projects.coalesce_queries`
+    :param history: project id to recent listing time (see `runs_db.project_list_secs`)
+    :return: the id of each group's first project to its expected seconds
+    """
+    known = [secs for secs in history.values() if secs]
+    default = statistics.median(known) if known else DEFAULT_PROJECT_SECS
+    expected = {}
+    for group in groups:
+        group_history = [history[p["id"]] for p in group if history.get(p["id"])]
+        expected[group[0]["id"]] = max(group_history) if group_history else default
+    return expected
+
+
+def run_deadline(
+    start_time: float, deadline_secs: float, share: float = 1.0
+) -> Optional[float]:
+    """
+    :param start_time: epoch secs the run started
+    :param deadline_secs: how long the whole run can take, 0 for no deadline
+    :param share: the part of that time this step gets (eg. `LIST_TIME_SHARE`)
+    :return: epoch secs the step has to be done by, or None if there's no deadline
+    """
+    if not deadline_secs:
+        return None
+    return start_time + deadline_secs * share
+
+
+def plan_run(
+    source: str, groups: List[List[Dict]], deadline: float, workers: int = 1
+) -> "RunPlanner":
+    """
+    :param source: one of the processor.SOURCE_* names, to look up how long its projects took in recent runs
+    :param groups: from `projects.coalesce_queries`
+    :param deadline: epoch secs the queries have to be done by
+    :param workers: how many queries run at once
+    :return: a planner for this run's queries
+    """
+    Session = database.get_session_maker()
+    with Session() as session:
+        history = runs_db.project_list_secs(session, source, HISTORY_RUNS)
+    planner = RunPlanner(deadline, expected_secs(groups, history), workers)
+    logger.info(
+        "{}: {} queries to list in {:.0f} secs ({} with history)".format(
+            source,
+            len(groups),
+            max(0.0, deadline - time.time()),
+            len([g for g in groups if any(p["id"] in history for p in g)]),
+        )
+    )
+    return planner
+
+
+class RunPlanner:
+    """
+    Splits the time before a run's deadline across its queries, so one slow query (a giant domain list, a broken
+    site) can't stretch the whole run out. When a query starts it gets a share of the worker-time that is left, in
+    proportion to how long we expect it to take compared to the queries still waiting; whatever a query doesn't use
+    stays in the pool for the ones after it. Queries stop paging once they are out of time, and we report which
+    ones were cut. Safe to share between threads.
+    """
+
+    def __init__(
+        self,
+        deadline: float,
+        expected: Dict[int, float],
+        workers: int = 1,
+        min_secs: float = MIN_PROJECT_SECS,
+    ):
+        """
+        :param deadline: epoch secs the run has to be done by
+        :param expected: query key (the id of the group's first project) to expected seconds
+        :param workers: how many queries run at once
+        :param min_secs: the least time any query gets (unless the deadline is closer than that)
+        """
+        self.deadline = deadline
+        self._expected = dict(expected)
+        self._workers = workers
+        self._min_secs = min_secs
+        self._waiting = set(expected.keys())
+        self._running = set()
+        self._started: Dict[int, float] = {}
+        self._budgets: Dict[int, float] = {}
+        self._used: Dict[int, float] = {}
+        self._cut: Dict[int, float] = {}  # key -> secs it had run for when it was cut
+        self._lock = threading.Lock()
+
+    def start(self, key: int, now: Optional[float] = None) -> float:
+        """
+        A query is starting, so give it its share of the time that is left.
+        :return: its budget, in seconds
+        """
+        now = time.time() if now is None else now
+        with self._lock:
+            self._waiting.discard(key)
+            # what's left, less the time still promised to the queries that are running
+            promised = sum(
+                max(0.0, self._started[k] + self._budgets[k] - now)
+                for k in self._running
+            )
+            left = max(0.0, self.deadline - now)
+            capacity = max(0.0, left * self._workers - promised)
+            waiting_expected = self._expected[key] + sum(
+                self._expected[k] for k in self._waiting
+            )
+            share = capacity * self._expected[key] / waiting_expected
+            budget = min(max(share, self._min_secs), left)
+            self._started[key] = now
+            self._budgets[key] = budget
+            self._running.add(key)
+            return budget
+
+    def out_of_time(self, key: int, now: Optional[float] = None) -> bool:
+        """
+        :return: True if the query has used up its budget (or the run is past its deadline), so it should stop paging
+        """
+        now = time.time() if now is None else now
+        with self._lock:
+            started = self._started.get(key, now)
+            if (now - started < self._budgets.get(key, 0)) and (now < self.deadline):
+                return False
+            self._cut.setdefault(key, now - started)
+            return True
+
+    def finish(self, key: int, now: Optional[float] = None) -> None:
+        """
+        A query is done (or was skipped); any time it didn't use goes back to the pool.
+        """
+        now = time.time() if now is None else now
+        with self._lock:
+            self._waiting.discard(key)
+            if key in self._running:
+                self._running.discard(key)
+                self._used[key] = now - self._started[key]
+
+    def was_cut(self, key: int) -> bool:
+        with self._lock:
+            return key in self._cut
+
+    def cut_report(self) -> List[Dict]:
+        """
+        :return: the queries that were cut short, with `key`, `expected` secs and `used` secs
+        """
+        with self._lock:
+            return [
+                dict(
+                    key=key,
+                    expected=self._expected.get(key),
+                    used=self._used.get(key, secs),
+                )
+                for key, secs in sorted(self._cut.items())
+            ]
+
+    def log_report(self, source: str) -> str:
+        """
+        Log which queries were cut short.
+        :return: the same report as text, for the email
+        """
+        cut = self.cut_report()
+        if not cut:
+            return ""
+        lines = [
+            "Project {}: cut short after {:.0f} secs (usually takes {:.0f} secs)".format(
+                c["key"], c["used"], c["expected"]
+            )
+            for c in cut
+        ]
+        logger.warning(
+            "{}: {} of {} queries were cut short by the run deadline".format(
+                source, len(cut), len(self._expected)
+            )
+        )
+        for line in lines:
+            logger.warning("  " + line)
+        return "\n" + "\n".join(lines) + "\n"
@@ -0,0 +1,116 @@
+import collections
+import itertools
+import logging
+import math
+import os
+import random
+from typing import Callable, Hashable, List, Optional, TypeVar
+
+logger = logging.getLogger(__name__)
+
+SAMPLING_FACTOR = float(
+    os.environ.get("STORY_SAMPLING_FACTOR", 3)
+)  # sample a query once it matches this many times its story cap (0 turns sampling off)
+POOL_FACTOR = float(
+    os.environ.get("STORY_SAMPLING_POOL_FACTOR", 3)
+)  # when sampling, list up to this many times the cap to pick the sample from
+
+T = TypeVar("T")
+_MISSING = object()
+
+
+def needs_sampling(
+    total_hits: Optional[int], cap: int, factor: float = SAMPLING_FACTOR
+) -> bool:
+    """
+    :param total_hits: how many stories the query matches (None if we don't know)
+    :param cap: the most stories we want from it
+    :param factor:
+    :return: True if the query is so broad that taking the first `cap` stories in API order would be arbitrary
+    """
+    if (not factor) or (total_hits is None) or (cap <= 0):
+        return False
+    return total_hits > cap * factor
+
+
+def pool_size(cap: int, total_hits: int, pool_factor: float = POOL_FACTOR) -> int:
+    """
+    :return: how many stories to list to pick a sample of `cap` from
+    """
+    return max(cap, min(total_hits, int(cap * pool_factor)))
+
+
+def sample_rate(sample_size: int, total_hits: int) -> float:
+    """
+    :return: the fraction of the stories the query matched that we kept, to record with each of them
+    """
+    if total_hits <= 0:
+        return 1.0
+    return min(1.0, sample_size / total_hits)
+
+
+def allocate(size: int, counts: List[int]) -> List[int]:
+    """
+    Split a sample (or pool) across the parts of a query in proportion to how many stories each one matches, so the
+    parts the API happens to return last get their share too.
+    :param size: how many stories to take in all
+    :param counts: how many stories each part matches
+    :return: how many to take from each part (adding up to `size`, or to all of them if there aren't that many)
+    """
+    total = sum(counts)
+    if total <= 0:
+        return [0] * len(counts)
+    size = min(size, total)
+    exact = [size * count / total for count in counts]
+    shares = [math.floor(e) for e in exact]
+    # the parts with the biggest fractions left over get the rest, one each
+    by_remainder = sorted(
+        range(len(counts)), key=lambda i: exact[i] - shares[i], reverse=True
+    )
+    for i in by_remainder[: size - sum(shares)]:
+        shares[i] += 1
+    return shares
+
+
+def _interleave(lists: List[List[T]]) -> List[T]:
+    # one from each list in turn, until they all run out
+    return [
+        item
+        for items in itertools.zip_longest(*lists, fillvalue=_MISSING)
+        for item in items
+        if item is not _MISSING
+    ]
+
+
+def stratified_sample(
+    items: List[T],
+    size: int,
+    day_of: Callable[[T], Hashable],
+    media_of: Callable[[T], Hashable],
+    rng: Optional[random.Random] = None,
+) -> List[T]:
+    """
+    Pick `size` items spread evenly across the days they were published on, and within each day across the media
+    sources that published them, so no day or outlet is dropped just because of where the API happened to sort it.
+    Days and sources with fewer items than their even share give their leftover to the rest.
+    :param items: the pool to sample from
+    :param size:
+    :param day_of: the day an item was published
+    :param media_of: the media source an item is from
+    :param rng: for picking within each day and source
+    :return: the sample (all of `items` if there aren't more than `size`)
+    """
+    if len(items) <= size:
+        return list(items)
+    rng = rng or random
+    by_day = collections.defaultdict(lambda: collections.defaultdict(list))
+    for item in items:
+        by_day[day_of(item)][media_of(item)].append(item)
+    days = []
+    for day in sorted(by_day, key=str):
+        media = list(by_day[day].values())
+        for media_items in media:
+            rng.shuffle(media_items)
+        rng.shuffle(media)
+        days.append(_interleave(media))
+    return _interleave(days)[:size]
@@ -0,0 +1,192 @@
+import datetime as dt
+from typing import Callable, Dict, Iterator, List, Optional
+
+import processor.story_caps as story_caps
+from processor.database.models import ProjectHistory
+
+
+class Page(list):
+    """
+    A page of raw items from `Source.list_pages`. Sources that know how many stories the whole query (or part) matches
+    should yield these instead of plain lists, so over-broad queries can be sampled (see `processor.sampling`).
+    """
+
+    def __init__(self, items: List[Dict], total_hits: Optional[int] = None):
+        super().__init__(items)
+        self.total_hits = total_hits
+
+
+class QueryPart:
+    """
+    A piece of a project's query that can be paged through on its own, like a slice of its date window or a shard of
+    its domains (see `Source.query_parts`). The parts of a query cover all of it, without overlapping.
+    """
+
+    def __init__(
+        self,
+        start_date: dt.datetime,
+        end_date: dt.datetime,
+        count: Optional[int] = None,
+        **options,
+    ):
+        self.start_date = start_date
+        self.end_date = end_date
+        self.count = count  # how many stories it matches, if the source counted them
+        self.options = options  # anything else the source needs to query it
+        self.quota: Optional[int] = (
+            None  # when sampling, how many new stories to list from it (set by the driver)
+        )
+
+
+class Source:
+    """
+    A news provider we list stories from. A subclass only says how to page through the results of a project's query
+    (maybe split into parts) and how to turn the items the provider returns into our story dicts;
+    `processor.sources.driver.list_stories` does the rest the same way for every provider (coalescing queries, running
+    them in parallel, rate limiting, skipping URLs we've seen, sampling, capping and batching stories per project,
+    history and metrics).
+    """
+
+    name: str = None  # one of the processor.SOURCE_* names
+    query_fields: List[str] = [
+        "search_terms",
+        "language",
+    ]  # projects with the same values for these share a query
+    day_offset = 0
+    day_window = 1
+    max_stories_per_project = 500  # the cap for a typical project; each project gets its own (see `story_caps`)
+    pool_size = 4  # queries run in parallel
+    part_threads = 1  # parts of one query paged through in parallel
+    page_size: Optional[int] = (
+        None  # stories per page; a part being sampled is split up while its share is bigger than this
+    )
+    rate_limiter = None  # a TokenBucket or SharedTokenBucket shared by every query, or None if there is no limit
+    recent_url_days = 14  # skip URLs a project has processed this recently
+    incremental = (
+        False  # if True, pages come newest first and we stop at the history cursor
+    )
+    cursor_overlap = dt.timedelta(
+        hours=2
+    )  # look back this far past the cursor, in case stories are published out of order
+    has_text = (
+        False  # if False, call `fetch_text` for the listed stories before queueing them
+    )
+
+    def query_parts(
+        self,
+        project: Dict,
+        start_date: dt.datetime,
+        end_date: dt.datetime,
+        before_request: Callable[[], bool],
+    ) -> List[QueryPart]:
+        """
+        Optional, for sources that can split a query up (eg. by date, or by domain): the parts are paged through in
+        parallel, and a query that needs sampling gets its sample from each part in proportion to how many stories it
+        has. Sources that can count a part cheaply should; otherwise the driver counts it from its first page.
+        :param before_request: call this right before each API call (eg. to count a part), and stop if it returns False
+        :return: the parts of the query (none if there is nothing to query)
+        """
+        return [QueryPart(start_date, end_date)]
+
+    def split_part(
+        self,
+        project: Dict,
+        part: QueryPart,
+        before_request: Callable[[], bool],
+    ) -> List[QueryPart]:
+        """
+        When sampling, a part we only list some of the stories from would give us the top of its results in whatever
+        order the API sorts them (eg. by domain), so we split it into smaller parts that each get a share of the
+        sample. Sources should count the new parts if they can (see `query_parts`). By default a part that spans more
+        than a day is split into days.
+        :param before_request: call this right before each API call (eg. to count a part), and stop if it returns False
+        :return: the smaller parts, or just this one if it can't be split
+        """
+        days = []
+        day_start = part.start_date
+        while day_start < part.end_date:
+            day_end = min(day_start + dt.timedelta(days=1), part.end_date)
+            days.append(QueryPart(day_start, day_end, **part.options))
+            day_start = day_end
+        return days if len(days) > 1 else [part]
+
+    def list_pages(
+        self,
+        project: Dict,
+        part: QueryPart,
+        cursor: Optional[dt.datetime],
+        before_request: Callable[[], bool],
+    ) -> Iterator[List[Dict]]:
+        """
+        Page through the results of one part of a project's query, one API call per page.
+        :param project: the project to build the query from
+        :param part: the dates (and anything else) to limit the query to, from `query_parts`
+        :param cursor: in incremental mode, the publish date we've already listed back to (otherwise None)
+        :param before_request: call this right before each API call, and stop if it returns False; it waits for the
+                               rate limiter and keeps track of the page budget
+        :return: pages of raw items, as the provider returns them (as `Page`s, if it says how many there are in all)
+        """
+        raise NotImplementedError
+
+    def normalize(self, item: Dict, project: Dict) -> Dict:
+        """
+        :return: a story dict (with at least `url`, `title` and `source`) for a raw item from `list_pages`
+        """
+        raise NotImplementedError
+
+    def item_date(self, item: Dict) -> dt.datetime:
+        """
+        :return: when a raw item was published (naive, in UTC)
+        """
+        raise NotImplementedError
+
+    def complete_stories(self, group: List[Dict], stories: List[Dict]) -> List[Dict]:
+        """
+        Optional, for sources that list some stories without the text they could have come with: called with each
+        batch of new stories (for the coalesced group) before they're handed out, to fill in their `story_text`.
+        :return: the stories that have it now (the same dicts)
+        """
+        return stories
+
+    def fetch_text(
+        self, stories: List[Dict], on_story: Callable[[Dict], None], **kwargs
+    ) -> int:
+        """
+        Optional, for sources that don't list stories with their text: fetch it, handing each story to `on_story`
+        once it has its `story_text`. Takes an optional `ledger` (see `RunLedger`), and an optional `deadline` in epoch
+        secs to stop fetching by.
+        :return: the number of stories we got text for
+        """
+        raise NotImplementedError
+
+    def history_cursor(self, history: ProjectHistory) -> Optional[dt.datetime]:
+        """
+        :return: the latest publish date saved for this source in a project's history, if it keeps one
+        """
+        return None
+
+    def page_budgets(self, project_list: List[Dict]) -> Dict[int, Optional[int]]:
+        """
+        :return: the most pages each project's query may fetch this run (None for no limit)
+        """
+        return {p["id"]: None for p in project_list}
+
+    def story_caps(self, project_list: List[Dict]) -> Dict[int, int]:
+        """
+        :return: the most stories to hand to each project this run
+        """
+        return story_caps.story_caps(
+            self.name, self.max_stories_per_project, project_list
+        )
+
+    def max_stories(self, page_budget: Optional[int]) -> Optional[int]:
+        """
+        :return: the most stories a query's page budget can get it (None for no limit beyond the projects' caps)
+        """
+        return None
+
+    def record_usage(self, group: List[Dict], pages: int, stories: int) -> None:
+        """
+        Called once a query is done, with the pages it fetched and the stories handed out to its projects.
+        """
+        pass
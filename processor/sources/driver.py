@@ -0,0 +1,672 @@
+import datetime as dt
+import itertools
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict, Iterator, List, Optional, Tuple
+
+import mcmetadata.urls as urls
+import pytz
+
+import processor.database as database
+import processor.database.projects_db as projects_db
+import processor.projects as projects
+import processor.sampling as sampling
+import processor.util as util
+from processor.run_ledger import RunLedger
+from processor.run_planner import RunPlanner, plan_run
+from processor.sources import QueryPart, Source
+
+logger = logging.getLogger(__name__)
+
+# takes a batch of new stories for one project (to queue them, or to hold on to them until their text is fetched) and
+# returns how many it kept; called from the worker threads, so it has to be thread-safe
+StoryHandler = Callable[[Dict, List[Dict]], int]
+
+
+class _ListingMetrics:
+    """
+    Counts for the whole run, added to by every query's worker thread.
+    """
+
+    def __init__(self):
+        self.counts = dict(queries=0, requests=0, pages=0, items=0, skipped=0)
+        self._lock = threading.Lock()
+
+    def add(self, **counts) -> None:
+        with self._lock:
+            for name, value in counts.items():
+                self.counts[name] += value
+
+
+def _history_cursors(
+    source: Source, session_maker, group: List[Dict]
+) -> Dict[int, Optional[dt.datetime]]:
+    with session_maker() as session:
+        histories = {p["id"]: projects_db.get_history(session, p["id"]) for p in group}
+    return {
+        pid: (source.history_cursor(h) if h else None) for pid, h in histories.items()
+    }
+
+
+def _project_results(
+    group: List[Dict],
+    handed_out: Dict[int, int],
+    page_count: int,
+    secs: float,
+    caps: Dict[int, int],
+    error: Optional[Exception] = None,
+    skipped: bool = False,
+    cut: bool = False,
+    sampling_rate: Optional[float] = None,
+) -> List[Dict]:
+    # one summary for the email per project, even though a coalesced group shares its pages
+    results = []
+    for p in group:
+        story_count = handed_out[p["id"]]
+        project_email_message = "Project {} - {}:\n".format(p["id"], p["title"])
+        if skipped:
+            project_email_message += "    skipped, nothing left in the budget\n\n"
+        elif error is not None:
+            project_email_message += (
+                "    failed to count and/or retrieve stories with {}\n\n".format(error)
+            )
+        else:
+            logger.info(
+                "  found {} new stories for project {}/{} (in {} pages)".format(
+                    story_count, p["id"], p["title"], page_count
+                )
+            )
+            warnings = ""
+            if story_count > (caps[p["id"]] * 0.8):  # try to get our attention
+                warnings += "(⚠️️️ query might be too broad)"
+            if cut:
+                warnings += "(⚠️️️ cut short by the run deadline)"
+            if sampling_rate is not None:
+                warnings += "(sampled {:.1%} of the matching stories)".format(
+                    sampling_rate
+                )
+            project_email_message += (
+                "    found {} new stories (over {} pages) {}\n\n".format(
+                    story_count, page_count, warnings
+                )
+            )
+        results.append(
+            dict(
+                project_id=p["id"],
+                email_text=project_email_message,
+                stories=story_count,
+                pages=page_count,
+                secs=secs,
+                cut=cut,
+            )
+        )
+    return results
+
+
+def _update_history(
+    source: Source, session_maker, cursors: Dict[int, dt.datetime]
+) -> None:
+    if not cursors:
+        return
+    with session_maker() as session:
+        for project_id, date in cursors.items():
+            projects_db.update_history(session, project_id, date, source.name)
+
+
+def _naive_utc(date: dt.datetime) -> dt.datetime:
+    # our saved cursors are naive UTC, but the query dates are marked as UTC
+    if date.tzinfo is not None:
+        return date.astimezone(pytz.UTC).replace(tzinfo=None)
+    return date
+
+
+class _PartListing:
+    """
+    How far we've got paging through one part of a group's query.
+    """
+
+    def __init__(self, part: QueryPart):
+        self.part = part
+        self.found = 0  # new stories listed from it
+        self.reached_cursor = False
+        self.complete = True  # did we list all of it (back to the cursor, or to the end of its results)?
+        self.error: Optional[Exception] = None
+        self.pages: Optional[Iterator[List[Dict]]] = None  # once we've started paging
+        self.first_page: Optional[List[Dict]] = (
+            None  # if we looked at it to count the part
+        )
+
+
+def _list_group(
+    source: Source,
+    group: List[Dict],
+    page_budget: Optional[int],
+    caps: Dict[int, int],
+    on_stories: StoryHandler,
+    ledger: Optional[RunLedger],
+    metrics: _ListingMetrics,
+    planner: Optional[RunPlanner] = None,
+) -> List[Dict]:
+    """
+    Run the query shared by a coalesced group of projects once, handing the new stories on each page out to each of
+    the projects in it. If the source splits the query into parts (see `Source.query_parts`) they're paged through in
+    parallel. If the query matches far more stories than the projects can use, each part lists its share of a bigger
+    pool instead, and we hand out a sample spread across days and media sources once we're done paging.
+    :return: a result summary for each project in the group
+    """
+    p = group[0]  # every project in the group has the same query
+    # the query keeps going while any project in the group could use more stories (and the budget allows)
+    max_stories = max(caps[gp["id"]] for gp in group)
+    if source.max_stories(page_budget) is not None:
+        max_stories = min(max_stories, source.max_stories(page_budget))
+    handed_out = {gp["id"]: 0 for gp in group}
+    list_start = time.time()
+    if ledger:
+        # projects already listed earlier in this run aren't queried again
+        listed = [ledger.listed_stories(gp["id"]) for gp in group]
+        if None not in listed:
+            for gp, project_stories in zip(group, listed):
+                handed_out[gp["id"]] = on_stories(gp, project_stories)
+            if planner is not None:
+                # it won't be queried, so the time it was expected to take goes to the others
+                planner.finish(p["id"])
+            return _project_results(group, handed_out, 0, 0, caps)
+    if page_budget == 0:
+        if planner is not None:
+            planner.finish(p["id"])
+        return _project_results(group, handed_out, 0, 0, caps, skipped=True)
+    logger.info(
+        "Checking project {}/{}{}".format(
+            p["id"],
+            p["title"],
+            (" (for {} projects)".format(len(group)) if len(group) > 1 else ""),
+        )
+    )
+    Session = database.get_session_maker()
+    listed_by_project = {gp["id"]: [] for gp in group}
+    # the parts are paged through in their own threads, and share these
+    lock = threading.Lock()
+    hand_out_lock = threading.Lock()
+    found = 0  # new stories the query found, before they are handed out to the projects
+    requests = 0
+    page_count = 0
+    latest_pub_date = None
+    sampling_rate = None
+    pool = []  # (item, story) pairs to sample from
+
+    def before_request() -> bool:
+        # every API call for the query goes through here (counts too), so together they stick to its page budget, its
+        # share of the run time and the rate limit
+        nonlocal requests
+        with lock:
+            if ((page_budget is not None) and (requests >= page_budget)) or (
+                (planner is not None) and planner.out_of_time(p["id"])
+            ):
+                return False
+            requests += 1
+        if source.rate_limiter is not None:
+            source.rate_limiter.acquire()
+        return True
+
+    def part_full(listing: _PartListing) -> bool:
+        # when sampling each part lists its own share of the pool, otherwise the query stops once it has enough
+        if listing.part.quota is not None:
+            return listing.found >= listing.part.quota
+        return found >= max_stories
+
+    def part_before_request(listing: _PartListing) -> Callable[[], bool]:
+        # stop before spending a call on a page we won't use (called from the prefetch thread, see below)
+        def check() -> bool:
+            if listing.reached_cursor:
+                return False
+            with lock:
+                full = part_full(listing)
+            if full:
+                # a part that has listed its share of the sample is done with, but not one cut off by the cap
+                listing.complete = listing.part.quota is not None
+                return False
+            if not before_request():
+                listing.complete = False
+                return False
+            return True
+
+        return check
+
+    def start_paging(listing: _PartListing) -> None:
+        listing.pages = iter(
+            source.list_pages(p, listing.part, cursor, part_before_request(listing))
+        )
+
+    def stop_paging(listing: _PartListing) -> None:
+        if listing.pages is not None:
+            listing.pages.close()
+
+    def count_part(listing: _PartListing) -> None:
+        # a part the source didn't count gets counted from its first page (which we hang on to for listing it)
+        if listing.part.count is not None:
+            return
+        start_paging(listing)
+        try:
+            listing.first_page = next(listing.pages, None)
+        except Exception as e:
+            logger.exception(
+                "  Couldn't retrieve stories in part of project {}. {}".format(
+                    p["id"], e
+                )
+            )
+            listing.error = e
+            listing.complete = False
+            return
+        listing.part.count = getattr(listing.first_page, "total_hits", None)
+
+    def stratify(listing: _PartListing) -> List[_PartListing]:
+        # A part we'd only list some of would give us the top of its results in the API's sort order, which can have
+        # nothing to do with what we want the sample spread over (eg. Wayback sorts by domain, so the pool would be
+        # the first few domains). So we split it into smaller parts, each with its own share of the pool, for as long
+        # as those shares are still about a page or more.
+        part = listing.part
+        if (
+            (listing.error is not None)
+            or (source.page_size is None)
+            or (part.quota <= source.page_size)
+            or (part.quota >= part.count)
+        ):
+            return [listing]
+        strata = [
+            _PartListing(sub_part)
+            for sub_part in source.split_part(p, part, before_request)
+        ]
+        if len(strata) < 2:
+            return [listing]
+        for stratum in strata:
+            count_part(stratum)
+        counts = [stratum.part.count for stratum in strata]
+        if None in counts:
+            # can't tell how to share it out, so list it as it is
+            for stratum in strata:
+                stop_paging(stratum)
+            return [listing]
+        stop_paging(listing)
+        for stratum, quota in zip(strata, sampling.allocate(part.quota, counts)):
+            stratum.part.quota = quota
+        return [sub for stratum in strata for sub in stratify(stratum)]
+
+    def hand_out(pairs: List[Tuple[Dict, Dict]]) -> None:
+        stories = source.complete_stories(group, [story for _, story in pairs])
+        item_dates = {id(story): source.item_date(item) for item, story in pairs}
+        with hand_out_lock:
+            for gp in group:
+                # in incremental mode a project only gets the stories since its own cursor (the query pages back to
+                # the oldest one in the group)
+                project_cursor = (
+                    history_cursors[gp["id"]] if source.incremental else None
+                )
+                since_cursor = [
+                    s
+                    for s in stories
+                    if (project_cursor is None)
+                    or (item_dates[id(s)] >= project_cursor - source.cursor_overlap)
+                ]
+                project_stories = projects.fan_out_stories(
+                    since_cursor, [gp], recent_urls_by_project, caps
+                )[gp["id"]][: max(0, caps[gp["id"]] - handed_out[gp["id"]])]
+                if not project_stories:
+                    continue
+                recent_urls_by_project[gp["id"]].update(
+                    urls.normalize_url(s["url"]) for s in project_stories
+                )
+                handed_out[gp["id"]] += on_stories(gp, project_stories)
+                listed_by_project[gp["id"]] += project_stories
+
+    def new_stories_by_page(listing: _PartListing):
+        # This runs in the prefetch thread, right where `list_pages` asks `before_request` for the next page, so that
+        # check sees every story found so far rather than lagging a page or two behind. Sources that charge per call
+        # (eg. NewsData) would otherwise pay for pages we throw away.
+        nonlocal found, latest_pub_date, page_count
+        pages = listing.pages
+        if listing.first_page is not None:
+            pages = itertools.chain([listing.first_page], pages)
+        for page in pages:
+            with lock:
+                page_count += 1
+            metrics.add(pages=1, items=len(page))
+            if not page:
+                return
+            logger.debug("  {} - page: {} stories".format(p["id"], len(page)))
+            page_latest_pub_date = max(source.item_date(item) for item in page)
+            new_pairs = []
+            with lock:
+                latest_pub_date = (
+                    page_latest_pub_date
+                    if latest_pub_date is None
+                    else max(latest_pub_date, page_latest_pub_date)
+                )
+                for item in page:
+                    if part_full(listing):
+                        listing.complete = listing.part.quota is not None
+                        break
+                    if (cursor is not None) and (source.item_date(item) < cursor):
+                        # sorted newest first, so everything after this is older too
+                        listing.reached_cursor = True
+                        break
+                    story = source.normalize(item, p)
+                    normalized_url = urls.normalize_url(story["url"])
+                    # skip URLs we've processed recently (or already saw earlier in this run)
+                    if normalized_url in seen_urls:
+                        metrics.add(skipped=1)
+                        continue
+                    seen_urls.add(normalized_url)
+                    new_pairs.append((item, story))
+                    found += 1
+                    listing.found += 1
+            yield new_pairs
+
+    def list_part(listing: _PartListing) -> None:
+        if listing.pages is None:
+            start_paging(listing)
+        # the next page is fetched in the background while we hand out this one
+        pages = util.prefetch(new_stories_by_page(listing))
+        try:
+            for pairs in pages:
+                if sampling_rate is None:
+                    hand_out(pairs)
+                else:
+                    with lock:
+                        pool.extend(pairs)
+        except Exception as e:
+            # keep what the other parts list; the cursor won't move past this one, so the next run tries it again
+            logger.exception(
+                "  Couldn't retrieve stories in part of project {}. {}".format(
+                    p["id"], e
+                )
+            )
+            listing.error = e
+            listing.complete = False
+        finally:
+            pages.close()
+
+    cut = False
+    if planner is not None:
+        planner.start(p["id"])
+    try:
+        start_date, end_date = projects.group_start_end_dates(
+            group, Session, source.day_offset, source.day_window, source.name
+        )
+        history_cursors = _history_cursors(source, Session, group)
+        # in incremental mode we page back to the oldest cursor in the group (minus some overlap, in case stories show
+        # up late); a project we haven't listed before gets the whole window
+        cursor = None
+        if source.incremental and None not in history_cursors.values():
+            cursor = min(history_cursors.values()) - source.cursor_overlap
+            start_date = max(start_date, pytz.UTC.localize(cursor))
+        # list recent urls once, so we don't hand out stories the projects have processed already (add_stories would
+        # drop them later anyway, but only after we'd spent time on them); with a coalesced group the query can only
+        # skip the ones every project in it has already
+        recent_urls_by_project, seen_urls = projects.group_recent_normalized_urls(
+            Session, group, source.recent_url_days
+        )
+        listings = [
+            _PartListing(part)
+            for part in source.query_parts(p, start_date, end_date, before_request)
+        ]
+        for listing in listings:
+            count_part(listing)
+        counts = [listing.part.count for listing in listings]
+        total_hits = None if None in counts else sum(counts)
+        if sampling.needs_sampling(total_hits, max_stories):
+            # each part lists its share of the pool, so the sample comes from across all of them
+            sampling_rate = sampling.sample_rate(max_stories, total_hits)
+            quotas = sampling.allocate(
+                sampling.pool_size(max_stories, total_hits), counts
+            )
+            for listing, quota in zip(listings, quotas):
+                listing.part.quota = quota
+            listings = [
+                stratum for listing in listings for stratum in stratify(listing)
+            ]
+            logger.info(
+                "  {} - {} matching stories, sampling {} from a pool of {} across {} parts".format(
+                    p["id"],
+                    total_hits,
+                    max_stories,
+                    sum(listing.part.quota for listing in listings),
+                    len(listings),
+                )
+            )
+        to_list = []
+        for listing in listings:
+            if listing.error is not None:
+                continue
+            if (listing.part.count == 0) or (listing.part.quota == 0):
+                # nothing to page through in a part with no stories, or none in the sample
+                stop_paging(listing)
+                continue
+            to_list.append(listing)
+        if len(to_list) <= 1:
+            for listing in to_list:
+                list_part(listing)
+        else:
+            with ThreadPoolExecutor(max_workers=source.part_threads) as executor:
+                list(executor.map(list_part, to_list))
+        failed = [listing for listing in listings if listing.error is not None]
+        if listings and (len(failed) == len(listings)):
+            raise failed[0].error
+        if sampling_rate is not None:
+            sample = sampling.stratified_sample(
+                pool,
+                max_stories,
+                day_of=lambda pair: source.item_date(pair[0]).date(),
+                media_of=lambda pair: pair[1].get("media_url"),
+            )
+            hand_out(
+                [
+                    (item, dict(story, sampling_rate=sampling_rate))
+                    for item, story in sample
+                ]
+            )
+        cut = (planner is not None) and planner.was_cut(p["id"])
+        if failed:
+            logger.error(
+                "  {} - failed to list {} of {} parts of the query".format(
+                    p["id"], len(failed), len(listings)
+                )
+            )
+        if (latest_pub_date is not None) and source.incremental:
+            # A part that stopped early (at the cap, its page budget or the deadline, or on an error) didn't page all
+            # the way back to the cursor, so moving the cursor past its start would skip the stories in between for
+            # good. It moves up to there, and the next run pages back to it again. The cursor never goes backwards,
+            # or past now (in case a source puts a bad date on a story).
+            safe_cursor = min(
+                [latest_pub_date, dt.datetime.utcnow()]
+                + [
+                    _naive_utc(listing.part.start_date)
+                    for listing in listings
+                    if not listing.complete
+                ]
+            )
+            query_start = _naive_utc(start_date)
+            cursors = {}
+            for gp in group:
+                previous_cursor = history_cursors[gp["id"]]
+                if safe_cursor > max(query_start, previous_cursor or query_start):
+                    cursors[gp["id"]] = safe_cursor
+            if len(cursors) < len(group):
+                logger.info(
+                    f"  {p['id']} - stopped before reaching the cursor, leaving it where it was"
+                )
+            _update_history(source, Session, cursors)
+        elif (latest_pub_date is not None) and not (cut or failed):
+            latest_pub_date = min(latest_pub_date, dt.datetime.utcnow())
+            _update_history(
+                source, Session, {gp["id"]: latest_pub_date for gp in group}
+            )
+        if ledger and not (cut or failed):
+            # a query that was cut short gets listed again if the run is resumed
+            for gp in group:
+                ledger.record_listed(
+                    gp["id"], listed_by_project[gp["id"]], time.time() - list_start
+                )
+    except Exception as e:
+        logger.exception(
+            "  Couldn't count/retrieve stories in project {}. Skipping project for now. {}".format(
+                p["id"], e
+            )
+        )
+        return _project_results(
+            group,
+            handed_out,
+            page_count,
+            time.time() - list_start,
+            caps,
+            error=e,
+        )
+    finally:
+        if planner is not None:
+            planner.finish(p["id"])
+        metrics.add(queries=1, requests=requests)
+        source.record_usage(group, requests, sum(handed_out.values()))
+    return _project_results(
+        group,
+        handed_out,
+        page_count,
+        time.time() - list_start,
+        caps,
+        cut=cut,
+        sampling_rate=sampling_rate,
+    )
+
+
+def cut_text(results: List[Dict]) -> str:
+    """
+    :param results: from `list_stories`
+    :return: a note for the email about the projects that were cut short by the run deadline, if any were
+    """
+    cut = [r["project_id"] for r in results if r.get("cut")]
+    if not cut:
+        return ""
+    return "\nCut short by the run deadline: projects {}\n".format(
+        ", ".join(str(pid) for pid in cut)
+    )
+
+
+def fetch_cut_text(story_count: int, text_count: int, deadline: Optional[float]) -> str:
+    """
+    :param story_count: how many stories needed their text
+    :param text_count: how many got it
+    :param deadline: epoch secs the text had to be fetched by, if there was a deadline
+    :return: a note for the email if the run deadline stopped the fetching before it got to all of them
+    """
+    if (deadline is None) or (time.time() < deadline) or (text_count >= story_count):
+        return ""
+    return "\nOut of time fetching text: got it for {} of {} stories by the run deadline\n".format(
+        text_count, story_count
+    )
+
+
+def list_stories(
+    source: Source,
+    project_list: List[Dict],
+    on_stories: StoryHandler,
+    ledger: Optional[RunLedger] = None,
+    deadline: Optional[float] = None,
+) -> List[Dict]:
+    """
+    List the new stories for every project from a source. Projects that send the same query share one set of API
+    calls, the queries run in parallel (staying under the source's rate limit together), the next page of each one is
+    fetched while the current one is handed out, and each page's stories are handed to `on_stories` project by
+    project as soon as they're ready.
+    :param source:
+    :param project_list:
+    :param on_stories: takes each batch of new stories for a project
+    :param ledger: optional run ledger; projects already listed earlier in this run aren't queried again
+    :param deadline: optional epoch secs to be done listing by; the time is split across the queries (see
+                     `RunPlanner`) and any that run out stop paging
+    :return: a result summary for each project, with `email_text`, `stories`, `pages`, `secs` and `cut`
+    """
+    start_time = time.time()
+    budgets = source.page_budgets(project_list)
+    caps = source.story_caps(project_list)
+    groups = projects.coalesce_queries(project_list, source.query_fields)
+
+    def group_budget(group: List[Dict]) -> Optional[int]:
+        # a coalesced group gets the biggest budget any of its projects got
+        group_budgets = [budgets[p["id"]] for p in group]
+        return None if None in group_budgets else max(group_budgets)
+
+    # start with the queries with the biggest budgets, they're the ones most likely to produce stories
+    args_list = sorted(
+        [(group, group_budget(group)) for group in groups],
+        key=lambda args: float("inf") if args[1] is None else args[1],
+        reverse=True,
+    )
+    metrics = _ListingMetrics()
+    planner = (
+        plan_run(source.name, groups, deadline, source.pool_size)
+        if deadline is not None
+        else None
+    )
+    # this is all waiting on the API, DB and queue, so threads work well (and they share one DB connection pool)
+    with ThreadPoolExecutor(max_workers=source.pool_size) as executor:
+        results = list(
+            itertools.chain.from_iterable(
+                executor.map(
+                    lambda args: _list_group(
+                        source,
+                        args[0],
+                        args[1],
+                        caps,
+                        on_stories,
+                        ledger,
+                        metrics,
+                        planner,
+                    ),
+                    args_list,
+                )
+            )
+        )
+    logger.info(
+        "Listed {} stories for {} projects from {} in {:.0f} secs: {} queries, {} calls, {} pages, {} items, skipped {} "
+        "recent URLs, waited {:.0f} secs for the rate limiter".format(
+            sum(r["stories"] for r in results),
+            len(project_list),
+            source.name,
+            time.time() - start_time,
+            metrics.counts["queries"],
+            metrics.counts["requests"],
+            metrics.counts["pages"],
+            metrics.counts["items"],
+            metrics.counts["skipped"],
+            source.rate_limiter.waited_secs if source.rate_limiter else 0,
+        )
+    )
+    if planner is not None:
+        planner.log_report(source.name)
+    return results
+
+
+def collect_stories(
+    source: Source,
+    project_list: List[Dict],
+    ledger: Optional[RunLedger] = None,
+    deadline: Optional[float] = None,
+) -> Tuple[List[Dict], str]:
+    """
+    For sources whose text comes later (see `Source.fetch_text`): list the new stories for every project, and hold on
+    to them all.
+    :return: the stories, and a note for the email about any projects cut short by the deadline
+    """
+    combined_stories = []
+    lock = threading.Lock()
+
+    def collect(project: Dict, project_stories: List[Dict]) -> int:
+        with lock:
+            combined_stories.extend(project_stories)
+        return len(project_stories)
+
+    results = list_stories(source, project_list, collect, ledger, deadline)
+    logger.info(
+        "Fetched {} total URLs from {}".format(len(combined_stories), source.name)
+    )
+    return combined_stories, cut_text(results)
@@ -0,0 +1,99 @@
+import collections
+import logging
+import os
+import struct
+import tempfile
+import threading
+import zlib
+from typing import Dict, Iterator, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+# where to put the story text files (defaults to the system temp dir)
+STORY_BUFFER_DIR = os.environ.get("STORY_BUFFER_DIR", None)
+STORY_BUFFER_COMPRESS = (
+    os.environ.get("STORY_BUFFER_COMPRESS", "true").lower() == "true"
+)
+_LENGTH_PREFIX = struct.Struct(">I")
+
+
+class StoryBuffer:
+    """
+    Holds stories for a fetch run without keeping all their text in memory. The story dicts (metadata only) stay in
+    RAM, grouped by project, while each story's `story_text` is appended to a local file as a length-prefixed (and
+    optionally zlib compressed) record. Texts are read back one project at a time when it is time to queue them.
+    Use it as a context manager, or call `close`, so the file gets cleaned up.
+    """
+
+    def __init__(
+        self,
+        directory: Optional[str] = STORY_BUFFER_DIR,
+        compress: bool = STORY_BUFFER_COMPRESS,
+    ):
+        self._compress = compress
+        fd, self.path = tempfile.mkstemp(
+            prefix="story-buffer-", suffix=".bin", dir=directory
+        )
+        self._file = os.fdopen(fd, "w+b")
+        self._offset = 0
+        # project id -> list of (story metadata, offset of its text record)
+        self._stories: Dict[int, List[Tuple[Dict, int]]] = collections.defaultdict(list)
+        self._lock = threading.Lock()
+
+    def __enter__(self) -> "StoryBuffer":
+        return self
+
+    def __exit__(self, *args) -> None:
+        self.close()
+
+    def __len__(self) -> int:
+        return sum([len(stories) for stories in self._stories.values()])
+
+    def add(self, story: Dict) -> None:
+        """
+        Take in a story, moving its `story_text` out to disk.
+        """
+        data = story.pop("story_text").encode("utf-8")
+        if self._compress:
+            data = zlib.compress(data)
+        with self._lock:
+            offset = self._offset
+            self._file.write(_LENGTH_PREFIX.pack(len(data)))
+            self._file.write(data)
+            self._offset += _LENGTH_PREFIX.size + len(data)
+            self._stories[story["project_id"]].append((story, offset))
+
+    def _read_text(self, offset: int) -> str:
+        self._file.seek(offset)
+        (length,) = _LENGTH_PREFIX.unpack(self._file.read(_LENGTH_PREFIX.size))
+        data = self._file.read(length)
+        if self._compress:
+            data = zlib.decompress(data)
+        return data.decode("utf-8")
+
+    def project_ids(self) -> List[int]:
+        return list(self._stories.keys())
+
+    def project_stories(self, project_id: int) -> List[Dict]:
+        """
+        :return: copies of the stories for one project, with their `story_text` read back in
+        """
+        with self._lock:
+            self._file.flush()
+            stories = [
+                dict(story, story_text=self._read_text(offset))
+                for story, offset in self._stories.get(project_id, [])
+            ]
+            self._file.seek(self._offset)  # so the next `add` appends
+        return stories
+
+    def iter_projects(self) -> Iterator[Tuple[int, List[Dict]]]:
+        for project_id in self.project_ids():
+            yield project_id, self.project_stories(project_id)
+
+    def close(self) -> None:
+        if self._file.closed:
+            return
+        self._file.close()
+        os.remove(self.path)
+        logger.debug(f"Removed story buffer file {self.path}")
@@ -0,0 +1,125 @@
+import logging
+import os
+import statistics
+from typing import Dict, List, Optional, Tuple
+
+import processor.credit_budget as credit_budget
+import processor.database as database
+import processor.database.stories_db as stories_db
+
+logger = logging.getLogger(__name__)
+
+STORY_CAPS_ENABLED = (
+    os.environ.get("STORY_CAPS", "true").lower() == "true"
+)  # if False every project gets its source's default cap, like before
+YIELD_DAYS = 14  # how far back to look when judging how productive a project's query is
+MIN_STORY_CAP = int(
+    os.environ.get("STORY_CAP_MIN", 50)
+)  # even a project that hasn't had anything above threshold in a while still gets a look
+MAX_CAP_FACTOR = float(
+    os.environ.get("STORY_CAP_MAX_FACTOR", 2)
+)  # the most a productive project can get, as a multiple of its source's default cap
+CAPPED_SHARE = 0.8  # a project whose busiest recent day got this much of its cap was probably cut off by it
+
+
+def parse_overrides(spec: str) -> Dict[Tuple[int, Optional[str]], int]:
+    """
+    :param spec: comma-separated "<project id>[:<source>]=<cap>", eg. "12=2000,40:newscatcher=100"
+    :return: (project id, source or None for every source) to cap
+    """
+    overrides = {}
+    for item in spec.split(","):
+        if not item.strip():
+            continue
+        key, _, cap = item.partition("=")
+        project_id, _, source = key.strip().partition(":")
+        overrides[(int(project_id), source or None)] = int(cap)
+    return overrides
+
+
+OVERRIDES = parse_overrides(os.environ.get("STORY_CAP_OVERRIDES", ""))
+
+
+def project_cap(
+    default_cap: int,
+    stats: Optional[Dict[str, int]],
+    reference_yield: Optional[float],
+    min_cap: int,
+    max_cap: int,
+) -> int:
+    """
+    Scale a project's cap by how its yield (the fraction of its recent stories that were above threshold) compares
+    to the typical project's. A project we don't have enough history for keeps the default; one that hasn't had
+    anything above threshold or posted drops to the minimum; and one only goes over the default if it has actually
+    been running into its cap, since otherwise more room wouldn't get it any more stories.
+    :param default_cap: the source's cap for a typical project
+    :param stats: from `stories_db.project_story_stats`, or None if the project has no recent stories
+    :param reference_yield: the typical project's yield from this source (None if we don't know)
+    :param min_cap:
+    :param max_cap:
+    :return: the most stories to fetch for the project in one run
+    """
+    if stats is None:
+        return default_cap
+    project_yield = credit_budget.project_yield(stats["processed"], stats["above"])
+    if project_yield is None:
+        return default_cap
+    if (stats["above"] == 0) and (stats["posted"] == 0):
+        return min_cap
+    weight = (project_yield / reference_yield) if reference_yield else 1.0
+    cap = default_cap * weight
+    if (cap > default_cap) and (stats["busiest_day"] < default_cap * CAPPED_SHARE):
+        cap = default_cap
+    return int(round(min(max(cap, min_cap), max_cap)))
+
+
+def story_caps(
+    source: str,
+    default_cap: int,
+    project_list: List[Dict],
+    overrides: Optional[Dict[Tuple[int, Optional[str]], int]] = None,
+) -> Dict[int, int]:
+    """
+    The most stories each project can get from a source in one run, so fetching and classifying goes to the projects
+    that turn stories into results. All the fetchers get their caps from here.
+    :param source: one of the processor.SOURCE_* names
+    :param default_cap: the source's cap for a typical project
+    :param project_list:
+    :param overrides: fixed caps that win over the computed ones (defaults to the STORY_CAP_OVERRIDES env var)
+    :return: project id to cap
+    """
+    overrides = OVERRIDES if overrides is None else overrides
+    if STORY_CAPS_ENABLED:
+        Session = database.get_session_maker()
+        with Session() as session:
+            stats = stories_db.project_story_stats(session, source, YIELD_DAYS)
+    else:
+        stats = {}
+    known = [
+        credit_budget.project_yield(s["processed"], s["above"]) for s in stats.values()
+    ]
+    known = [y for y in known if y is not None]
+    reference_yield = statistics.median(known) if known else None
+    min_cap = min(MIN_STORY_CAP, default_cap)
+    max_cap = int(default_cap * MAX_CAP_FACTOR)
+    caps = {}
+    for p in project_list:
+        override = overrides.get((p["id"], source), overrides.get((p["id"], None)))
+        caps[p["id"]] = (
+            override
+            if override is not None
+            else project_cap(
+                default_cap, stats.get(p["id"]), reference_yield, min_cap, max_cap
+            )
+        )
+    if STORY_CAPS_ENABLED:
+        logger.info(
+            "  {} story caps: {} projects lowered, {} raised from {} (typical yield {})".format(
+                source,
+                len([c for c in caps.values() if c < default_cap]),
+                len([c for c in caps.values() if c > default_cap]),
+                default_cap,
+                "unknown" if reference_yield is None else f"{reference_yield:.2f}",
+            )
+        )
+    return caps
@@ -0,0 +1,36 @@
+import unittest
+
+from processor.crawl_stats import CrawlStats
+
+
+class TestCrawlStats(unittest.TestCase):
+    def test_summary(self):
+        stats = CrawlStats()
+        stats.record_response("http://a.com/1", "a.com", 200, 0.5, 1000, 0)
+        stats.record_extraction("http://a.com/1", "a.com", 0.1, True)
+        stats.record_response("http://b.com/1", "b.com", 200, 4.0, 3000, 1)
+        stats.record_extraction("http://b.com/1", "b.com", 0.2, False)
+        stats.record_response("http://b.com/2", "b.com", 404, 2.0, 10, 0)
+        stats.record_failure("http://b.com/2", "b.com", "HttpError404")
+        stats.record_failure("http://c.com/1", "c.com", "TimeoutError")
+        summary = stats.summary()
+        assert summary["urls"] == 4
+        assert summary["responses"] == 3
+        assert summary["extracted"] == 1
+        assert summary["bytes"] == 4010
+        assert summary["redirects"] == 1
+        assert summary["failures"] == {"HttpError404": 1, "TimeoutError": 1}
+        assert summary["slow_domains"][0]["domain"] == "b.com"
+        assert summary["slow_domains"][0]["median_latency"] == 3.0
+        assert sum(summary["throughput"]) == 4
+
+    def test_merge(self):
+        stats = CrawlStats()
+        shard_stats = CrawlStats()
+        shard_stats.record_response("http://a.com/1", "a.com", 200, 0.5, 1000, 0)
+        stats.merge(shard_stats.records(), shard_stats.started)
+        assert stats.summary()["responses"] == 1
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,52 @@
+import datetime as dt
+import unittest
+
+from processor.credit_budget import allocate, project_yield, run_budget
+
+
+class TestRunBudget(unittest.TestCase):
+    def test_even_spread(self):
+        # 3000 credits over the 30 days of June is 100 a day
+        assert run_budget(3000, 0, 0, dt.date(2025, 6, 1)) == 100
+        assert run_budget(3000, 0, 0, dt.date(2025, 6, 1), runs_per_day=4) == 25
+
+    def test_carry_over(self):
+        # nothing spent for the first half of the month, so the rest of the days get twice as much
+        assert run_budget(3000, 0, 0, dt.date(2025, 6, 16)) == 200
+        # and what an earlier run today didn't use is still there for this one
+        assert run_budget(3000, 50, 50, dt.date(2025, 6, 16)) == 150
+
+    def test_overspent(self):
+        assert run_budget(3000, 3100, 0, dt.date(2025, 6, 20)) == 0
+
+
+class TestAllocate(unittest.TestCase):
+    def test_by_yield(self):
+        allocation = allocate(20, {1: 0.6, 2: 0.3, 3: 0.1}, floor=1, max_credits=100)
+        assert sum(allocation.values()) == 20
+        assert allocation[1] > allocation[2] > allocation[3] >= 1
+
+    def test_floor(self):
+        # even a project that never yields anything gets the floor
+        allocation = allocate(10, {1: 0.5, 2: 0.0}, floor=2, max_credits=100)
+        assert allocation == {1: 8, 2: 2}
+        # and if there isn't enough for everyone, the best projects get it first
+        allocation = allocate(2, {1: 0.1, 2: 0.9, 3: 0.5}, floor=1, max_credits=100)
+        assert allocation == {1: 0, 2: 1, 3: 1}
+
+    def test_max_credits(self):
+        allocation = allocate(100, {1: 0.9, 2: 0.1}, floor=1, max_credits=20)
+        assert allocation == {1: 20, 2: 20}
+
+    def test_unknown_yield(self):
+        # projects we don't know about yet are treated as average
+        assert project_yield(5, 5) is None
+        allocation = allocate(
+            30, {1: 0.2, 2: 0.4, 3: project_yield(5, 5)}, floor=0, max_credits=100
+        )
+        assert sum(allocation.values()) == 30
+        assert allocation[1] < allocation[3] < allocation[2]
+
+
+if __name__ == "__main__":
+    unittest.main()
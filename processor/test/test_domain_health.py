@@ -0,0 +1,103 @@
+import datetime as dt
+import unittest
+
+import processor.domain_health as domain_health
+from processor.domain_health import DomainHealthTracker
+
+
+class TestDomainHealthTracker(unittest.TestCase):
+    def test_circuit_opens_after_consecutive_failures(self):
+        tracker = DomainHealthTracker()
+        for _ in range(domain_health.CIRCUIT_FAILURE_THRESHOLD - 1):
+            tracker.record_failure("slow.com", "TimeoutError")
+        assert not tracker.is_open("slow.com")
+        tracker.record_failure("slow.com", "TimeoutError")
+        assert tracker.is_open("slow.com")
+        assert tracker.updated_records()[0]["last_failure_class"] == "TimeoutError"
+
+    def test_success_closes_circuit(self):
+        tracker = DomainHealthTracker()
+        for _ in range(domain_health.CIRCUIT_FAILURE_THRESHOLD):
+            tracker.record_failure("blocked.com", "HttpError403")
+        assert tracker.is_open("blocked.com")
+        tracker.record_success("blocked.com", 1.5)
+        assert not tracker.is_open("blocked.com")
+        assert tracker.success_rate("blocked.com") < 0.5
+
+    def test_filter_domain_groups(self):
+        long_ago = dt.datetime.now() - dt.timedelta(
+            hours=domain_health.CIRCUIT_PROBE_HOURS + 1
+        )
+        tracker = DomainHealthTracker(
+            [
+                dict(
+                    domain="closed.com",
+                    success_count=10,
+                    failure_count=0,
+                    consecutive_failures=0,
+                    median_latency=1.0,
+                    last_failure_class=None,
+                    last_failure_date=None,
+                    circuit_opened_date=None,
+                ),
+                dict(
+                    domain="open.com",
+                    success_count=0,
+                    failure_count=10,
+                    consecutive_failures=10,
+                    median_latency=None,
+                    last_failure_class="TimeoutError",
+                    last_failure_date=dt.datetime.now(),
+                    circuit_opened_date=dt.datetime.now(),
+                ),
+                dict(
+                    domain="probe.com",
+                    success_count=0,
+                    failure_count=10,
+                    consecutive_failures=10,
+                    median_latency=None,
+                    last_failure_class="TimeoutError",
+                    last_failure_date=long_ago,
+                    circuit_opened_date=long_ago,
+                ),
+            ]
+        )
+        groups = [
+            ["http://closed.com/1", "http://closed.com/2"],
+            ["http://open.com/1", "http://open.com/2"],
+            ["http://probe.com/1", "http://probe.com/2", "http://probe.com/3"],
+            ["http://new.com/1"],
+        ]
+        allowed = tracker.filter_domain_groups(groups)
+        assert allowed == [
+            ["http://closed.com/1", "http://closed.com/2"],
+            ["http://probe.com/1"],
+            ["http://new.com/1"],
+        ]
+        assert tracker.skipped == {"open.com": 2, "probe.com": 2}
+
+    def test_finish_run_smooths_latency(self):
+        tracker = DomainHealthTracker()
+        for latency in [1.0, 2.0, 9.0]:
+            tracker.record_success("example.com", latency)
+        tracker.finish_run()
+        assert tracker.median_latency("example.com") == 2.0
+        tracker.record_success("example.com", 4.0)
+        tracker.finish_run()
+        assert tracker.median_latency("example.com") == 3.0
+
+    def test_merge_run(self):
+        # pretend a child crawl process saw these
+        child = DomainHealthTracker()
+        child.record_success("example.com", 2.0)
+        child.record_skip("bad.com", 3)
+        child.finish_run()
+        parent = DomainHealthTracker()
+        parent.merge_run(child.updated_records(), dict(child.skipped))
+        assert parent.median_latency("example.com") == 2.0
+        assert parent.skipped == {"bad.com": 3}
+        assert [r["domain"] for r in parent.updated_records()] == ["example.com"]
+
+
+if __name__ == "__main__":
+    unittest.main()
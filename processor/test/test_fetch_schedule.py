@@ -0,0 +1,39 @@
+import calendar
+import random
+import unittest
+
+from processor.fetch_schedule import SourceSchedule
+
+
+def _epoch(*args) -> float:
+    return float(calendar.timegm((*args, 0, 0, 0)))
+
+
+class TestSourceSchedule(unittest.TestCase):
+    def test_parse(self):
+        s = SourceSchedule.parse("newscatcher", "24@22")
+        assert s.interval_secs == 24 * 60 * 60
+        assert s.offset_secs == 22 * 60 * 60
+        assert SourceSchedule.parse("newscatcher", "6").offset_secs == 0
+        assert not SourceSchedule.parse("newscatcher", "0").enabled
+
+    def test_next_run(self):
+        s = SourceSchedule("media-cloud", 24, 22, jitter_secs=0)
+        slot, due = s.next_run(_epoch(2025, 10, 1, 21, 59))
+        assert slot == due == _epoch(2025, 10, 1, 22, 0)
+        # just after a slot starts, the next one is tomorrow
+        slot, _ = s.next_run(_epoch(2025, 10, 1, 22, 0))
+        assert slot == _epoch(2025, 10, 2, 22, 0)
+        assert s.slot_start(_epoch(2025, 10, 2, 3, 0)) == _epoch(2025, 10, 1, 22, 0)
+
+    def test_jitter(self):
+        s = SourceSchedule("media-cloud", 6, jitter_secs=300)
+        rng = random.Random(1)
+        for _ in range(20):
+            slot, due = s.next_run(_epoch(2025, 10, 1, 7, 30), rng)
+            assert slot == _epoch(2025, 10, 1, 12, 0)
+            assert slot <= due <= slot + 300
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -1,7 +1,29 @@
+import os
+import threading
+import time
 import unittest
-from typing import Dict
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, List, Optional
+from unittest import mock
 
-from processor.fetcher import fetch_all_html, group_urls_by_domain
+import scrapy
+from scrapy.exceptions import StopDownload
+from scrapy.http import Headers
+
+from processor.crawl_stats import CrawlStats
+from processor.domain_health import DomainHealthTracker
+from processor.fetcher import (
+    OVERSIZE_DROP,
+    OVERSIZE_TRUNCATE,
+    UrlSpider,
+    _crawl_in_processes,
+    _mime_type,
+    _url_priorities,
+    balance_domain_groups,
+    fetch_all_html,
+    group_urls_by_domain,
+    order_domain_groups,
+)
 
 # random samples from our real database
 sample_urls = [
@@ -120,6 +142,224 @@ class TestUrlSpider(unittest.TestCase):
         grouped_urls = group_urls_by_domain(sample_urls)
         self.assertEqual(grouped_urls, expected_output)
 
+    def test_order_domain_groups(self):
+        domain_list = group_urls_by_domain(domain_sample_urls)
+        # with no history, biggest domains go first
+        ordered = order_domain_groups(domain_list)
+        assert [len(g) for g in ordered] == [4, 3, 3, 2, 1]
+        assert "coloradocommunitymedia.com" in ordered[0][0]
+        # with history, a slow domain with fewer URLs can jump ahead
+        tracker = DomainHealthTracker()
+        tracker.record_success("colombotelegraph.com", 30)
+        tracker.record_success("coloradocommunitymedia.com", 1)
+        tracker.finish_run()
+        ordered = order_domain_groups(domain_list, tracker)
+        domains = [group[0].split("/")[2] for group in ordered]
+        assert domains.index("colombotelegraph.com") < domains.index(
+            "coloradocommunitymedia.com"
+        )
+
+    def test_balance_domain_groups(self):
+        ordered = order_domain_groups(group_urls_by_domain(domain_sample_urls))
+        batches = balance_domain_groups(ordered, 2)
+        # all URLs are kept, and each domain stays within one batch
+        assert sorted(batches[0] + batches[1]) == sorted(domain_sample_urls)
+        assert sorted([len(b) for b in batches]) == [6, 7]
+        for group in ordered:
+            assert any(set(group).issubset(set(b)) for b in batches)
+
+
+class TestBodyLimits(unittest.TestCase):
+    def _spider(self, **kwargs) -> UrlSpider:
+        spider = UrlSpider(None, [], max_body_bytes=100, **kwargs)
+        spider.crawler = mock.Mock()
+        return spider
+
+    def _counted(self, spider: UrlSpider) -> list:
+        return [c.args[0] for c in spider.crawler.stats.inc_value.call_args_list]
+
+    def test_mime_type(self):
+        assert _mime_type(Headers({"Content-Type": "text/html"})) == "text/html"
+        assert (
+            _mime_type(Headers({"Content-Type": "Text/HTML; charset=UTF-8"}))
+            == "text/html"
+        )
+        assert _mime_type(Headers({})) is None
+        assert _mime_type(Headers({"Content-Type": ""})) is None
+
+    def test_content_type(self):
+        spider = self._spider()
+        request = scrapy.Request("https://example.com/story.pdf")
+        with self.assertRaises(StopDownload) as cm:
+            spider.on_headers_received(
+                Headers({"Content-Type": "application/pdf"}), 10, request, spider
+            )
+        assert cm.exception.fail is True
+        assert self._counted(spider) == ["fetcher/dropped_content_type"]
+        # allowed types, and responses that don't say what they are, keep going
+        spider.on_headers_received(
+            Headers({"Content-Type": "text/html; charset=utf-8"}), 10, request, spider
+        )
+        spider.on_headers_received(Headers({}), 10, request, spider)
+        assert self._counted(spider) == ["fetcher/dropped_content_type"]
+
+    def test_content_length(self):
+        headers = Headers({"Content-Type": "text/html"})
+        # when dropping, we stop as soon as the headers say it is too big
+        spider = self._spider(oversize_policy=OVERSIZE_DROP)
+        request = scrapy.Request("https://example.com/huge")
+        with self.assertRaises(StopDownload) as cm:
+            spider.on_headers_received(headers, 1000, request, spider)
+        assert cm.exception.fail is True
+        assert self._counted(spider) == ["fetcher/dropped_oversize"]
+        # when truncating we want the start of the body, so we let it stream in
+        spider = self._spider(oversize_policy=OVERSIZE_TRUNCATE)
+        spider.on_headers_received(headers, 1000, request, spider)
+        spider.on_headers_received(headers, None, request, spider)
+        assert self._counted(spider) == []
+
+    def test_streamed_body_truncate(self):
+        spider = self._spider(oversize_policy=OVERSIZE_TRUNCATE)
+        request = scrapy.Request("https://example.com/live-blog")
+        spider.on_bytes_received(b"x" * 60, request, spider)
+        with self.assertRaises(StopDownload) as cm:
+            spider.on_bytes_received(b"x" * 60, request, spider)
+        assert cm.exception.fail is False  # the partial body still gets parsed
+        assert request.meta["truncated"] is True
+        assert request.meta["body_bytes"] == 120
+        assert self._counted(spider) == ["fetcher/truncated"]
+
+    def test_retry_starts_count_over(self):
+        spider = self._spider(oversize_policy=OVERSIZE_DROP)
+        headers = Headers({"Content-Type": "text/html"})
+        request = scrapy.Request("https://example.com/flaky")
+        spider.on_headers_received(headers, None, request, spider)
+        spider.on_bytes_received(b"x" * 80, request, spider)
+        # the connection drops, and the retry gets a copy of the meta with the count so far
+        retry = request.replace(meta=dict(request.meta))
+        spider.on_headers_received(headers, None, retry, spider)
+        spider.on_bytes_received(b"x" * 80, retry, spider)
+        assert retry.meta["body_bytes"] == 80
+        assert self._counted(spider) == []
+
+    def test_streamed_body_drop(self):
+        spider = self._spider(oversize_policy=OVERSIZE_DROP)
+        request = scrapy.Request("https://example.com/live-blog")
+        spider.on_bytes_received(b"x" * 100, request, spider)  # right at the budget
+        with self.assertRaises(StopDownload) as cm:
+            spider.on_bytes_received(b"x", request, spider)
+        assert cm.exception.fail is True
+        assert "truncated" not in request.meta
+        assert self._counted(spider) == ["fetcher/dropped_oversize"]
+
+
+class _PageHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.startswith("/slow"):
+            time.sleep(0.2)
+        # big enough that a handful of them fill the pipe between the crawl processes and the parent
+        body = "<html><body><p>{}</p>{}</body></html>".format(
+            self.path, "x" * 50000
+        ).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "text/html")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+def _die_on_request(story_data: Dict) -> Optional[Dict]:
+    # runs in the crawl process (so it has to be module-level), and takes the whole process down like a crash would
+    if "/die" in story_data["final_url"]:
+        os._exit(1)
+    return story_data
+
+
+def _empty_extraction(story_data: Dict) -> Dict:
+    # like an extractor that found no article on the page
+    text = "" if "/empty" in story_data["final_url"] else story_data["content"]
+    return dict(original_url=story_data["original_url"], text_content=text)
+
+
+class TestCrawlInProcesses(unittest.TestCase):
+    def setUp(self):
+        self.counts = {}
+        self.crawl_stats = CrawlStats()
+        # one server per port, so they count as two domains and end up in different processes
+        self.servers = [
+            ThreadingHTTPServer(("127.0.0.1", 0), _PageHandler) for _ in range(2)
+        ]
+        for server in self.servers:
+            threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    def tearDown(self):
+        for server in self.servers:
+            server.shutdown()
+            server.server_close()
+
+    def _urls(self, server: ThreadingHTTPServer, paths: List[str]) -> List[str]:
+        return ["http://127.0.0.1:{}/{}".format(server.server_port, p) for p in paths]
+
+    def _crawl(
+        self, urls: List[str], preprocess=None, deadline: Optional[float] = None
+    ) -> List[str]:
+        fetched = []
+        domain_list = group_urls_by_domain(urls)
+        crawl = threading.Thread(
+            target=lambda *args: self.counts.update(_crawl_in_processes(*args)),
+            args=(
+                domain_list,
+                _url_priorities(domain_list),
+                lambda story: fetched.append(story["original_url"]),
+                preprocess,
+                1,
+                2,
+                None,
+                self.crawl_stats,
+                {},
+                deadline,
+            ),
+            daemon=True,
+        )
+        crawl.start()
+        crawl.join(timeout=120)
+        assert not crawl.is_alive(), "the parent hung waiting for its crawl processes"
+        return fetched
+
+    def test_every_url_once(self):
+        urls = self._urls(self.servers[0], [f"a{i}" for i in range(20)])
+        urls += self._urls(self.servers[1], [f"b{i}" for i in range(20)])
+        fetched = self._crawl(urls)
+        # nothing lost or repeated, and all ~2MB came through the queue before the children were joined
+        assert sorted(fetched) == sorted(urls)
+
+    def test_child_dies(self):
+        healthy = self._urls(self.servers[0], [f"a{i}" for i in range(5)])
+        dying = self._urls(self.servers[1], ["die"])
+        fetched = self._crawl(healthy + dying, preprocess=_die_on_request)
+        assert sorted(fetched) == sorted(healthy)
+
+    def test_empty_extraction(self):
+        urls = self._urls(self.servers[0], ["a", "empty"])
+        fetched = self._crawl(urls, preprocess=_empty_extraction)
+        # both pages came back, but only one had any text in it
+        assert sorted(fetched) == sorted(urls)
+        extracted = {r["url"]: r["extracted"] for r in self.crawl_stats.records()}
+        assert extracted == {urls[0]: True, urls[1]: False}
+
+    def test_deadline(self):
+        urls = self._urls(self.servers[0], [f"slow{i}" for i in range(300)])
+        start = time.time()
+        fetched = self._crawl(urls, deadline=start + 3)
+        # it stops at the deadline, only finishing what was already handed to the downloader (at most
+        # CONCURRENT_REQUESTS of them) rather than waiting on all 300 slow pages at 5 at a time
+        assert time.time() - start < 30
+        assert len(fetched) < len(urls) / 2
+        assert self.counts["timed_out"] == 1
+
 
 if __name__ == "__main__":
     unittest.main()
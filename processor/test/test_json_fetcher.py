@@ -0,0 +1,90 @@
+import json
+import threading
+import time
+import unittest
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import processor.json_fetcher as json_fetcher
+
+
+class ContentHandler(BaseHTTPRequestHandler):
+    flaky_hits = 0
+
+    def do_GET(self):
+        if self.path.startswith("/slow"):
+            time.sleep(0.2)
+        if self.path == "/flaky" and ContentHandler.flaky_hits == 0:
+            ContentHandler.flaky_hits += 1
+            self.send_response(503)
+            self.end_headers()
+            return
+        if self.path == "/missing":
+            self.send_response(404)
+            self.end_headers()
+            return
+        body = json.dumps(dict(snippet=f"text of {self.path}", html="<p>big</p>"))
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.end_headers()
+        self.wfile.write(body.encode("utf-8"))
+
+    def log_message(self, *args):
+        pass
+
+
+class TestFetchAllJson(unittest.TestCase):
+    def setUp(self):
+        self._delay = json_fetcher.RETRY_BASE_DELAY_SECS
+        json_fetcher.RETRY_BASE_DELAY_SECS = 0.01
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), ContentHandler)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.base_url = f"http://127.0.0.1:{self.server.server_port}"
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        json_fetcher.RETRY_BASE_DELAY_SECS = self._delay
+
+    def test_fetch_all_json(self):
+        urls = [f"{self.base_url}/{i}" for i in range(20)]
+        urls += [f"{self.base_url}/flaky", f"{self.base_url}/missing"]
+        results = {}
+
+        def handle_parse(response_data):
+            results[response_data["original_url"]] = response_data["content"]
+
+        summary = json_fetcher.fetch_all_json(
+            urls, handle_parse, fields=["snippet"], concurrency=4
+        )
+        assert summary["fetched"] == 21
+        assert summary["failed"] == 1
+        assert results[f"{self.base_url}/3"] == dict(snippet="text of /3")
+        assert f"{self.base_url}/flaky" in results  # retried after the 503
+        assert summary["crawl_stats"].summary()["failures"] == {"HTTPError": 1}
+
+    def test_deadline(self):
+        urls = [f"{self.base_url}/slow{i}" for i in range(20)]
+        fetched = []
+        start = time.time()
+        summary = json_fetcher.fetch_all_json(
+            urls,
+            lambda response_data: fetched.append(response_data["original_url"]),
+            concurrency=2,
+            deadline=start + 0.5,
+        )
+        # it stops handing out URLs at the deadline, and only waits for the ones already in flight
+        assert time.time() - start < 2
+        assert 0 < summary["fetched"] < len(urls)
+        assert summary["fetched"] + summary["unfetched"] == len(urls)
+        assert set(fetched) <= set(urls)
+
+    def test_past_deadline(self):
+        summary = json_fetcher.fetch_all_json(
+            [f"{self.base_url}/1"], lambda _: None, deadline=time.time() - 1
+        )
+        assert summary["fetched"] == 0
+        assert summary["unfetched"] == 1
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,91 @@
+import tempfile
+import unittest
+from unittest import mock
+
+import processor.mcdirectory as mcdirectory
+
+
+class FakeDirectoryApi:
+    def __init__(self, collections):
+        self.collections = collections
+        self.calls = 0
+
+    def source_list(self, collection_id, limit, offset):
+        self.calls += 1
+        names = self.collections[collection_id]
+        page = names[offset : offset + limit]
+        return dict(
+            count=len(names),
+            next=None if offset + limit >= len(names) else "more",
+            results=[dict(name=n, url_search_string=None) for n in page],
+        )
+
+
+class TestDomainCache(unittest.TestCase):
+    def setUp(self):
+        self.cache_dir = tempfile.mkdtemp()
+        self.api = FakeDirectoryApi(
+            {1: [f"site{i}.com" for i in range(1500)], 2: ["a.com", "b.com"]}
+        )
+        patcher = mock.patch.object(
+            mcdirectory, "get_mc_directory_client", return_value=self.api
+        )
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_cached(self):
+        domains = mcdirectory.domains_for_collection(1, cache_dir=self.cache_dir)
+        assert len(domains) == 1500
+        assert self.api.calls == 2
+        assert (
+            mcdirectory.domains_for_collection(1, cache_dir=self.cache_dir) == domains
+        )
+        assert self.api.calls == 2
+
+    def test_conditional_refresh(self):
+        mcdirectory.domains_for_collection(2, cache_dir=self.cache_dir)
+        # past the TTL, but the collection hasn't changed, so just one quick check
+        domains = mcdirectory.domains_for_collection(
+            2, cache_dir=self.cache_dir, ttl_secs=0
+        )
+        assert sorted(domains) == ["a.com", "b.com"]
+        assert self.api.calls == 2
+        # the collection changed, so it is fetched again
+        self.api.collections[2].append("c.com")
+        domains = mcdirectory.domains_for_collection(
+            2, cache_dir=self.cache_dir, ttl_secs=0
+        )
+        assert sorted(domains) == ["a.com", "b.com", "c.com"]
+        assert self.api.calls == 4
+
+    def test_max_age(self):
+        mcdirectory.domains_for_collection(2, cache_dir=self.cache_dir)
+        # a source swapped for another leaves the count the same, so only a full listing picks it up
+        self.api.collections[2] = ["a.com", "c.com"]
+        domains = mcdirectory.domains_for_collection(
+            2, cache_dir=self.cache_dir, ttl_secs=0
+        )
+        assert sorted(domains) == ["a.com", "b.com"]
+        assert self.api.calls == 2
+        domains = mcdirectory.domains_for_collection(
+            2, cache_dir=self.cache_dir, ttl_secs=0, max_age_secs=0
+        )
+        assert sorted(domains) == ["a.com", "c.com"]
+        assert self.api.calls == 3
+
+    def test_projects_share_collections(self):
+        projects = [
+            dict(id=1, title="one", media_collections=[1, 2]),
+            dict(id=2, title="two", media_collections=[2]),
+        ]
+        updated = mcdirectory.add_domains_to_projects(
+            projects, cache_dir=self.cache_dir
+        )
+        assert len(updated[0]["domains"]) == 1502
+        assert sorted(updated[1]["domains"]) == ["a.com", "b.com"]
+        assert self.api.calls == 3  # each collection once
+        assert "domains" not in projects[0]
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -66,6 +66,50 @@ class TestProjects(unittest.TestCase):
         for s in trimmed_stories:
             assert s["confidence"] >= project["min_confidence"]
 
+    def test_coalesce_queries(self):
+        query_fields = ["search_terms", "language", "media_collections"]
+        project_list = [
+            dict(
+                id=1,
+                search_terms="“femicide”  OR murder",
+                language="EN",
+                media_collections=[2, 1],
+            ),
+            dict(id=2, search_terms="kidnapping", language="en", media_collections=[1]),
+            dict(
+                id=3,
+                search_terms='"femicide" OR murder',
+                language="en",
+                media_collections=[1, 2],
+            ),
+        ]
+        groups = projects.coalesce_queries(project_list, query_fields)
+        assert [[p["id"] for p in g] for g in groups] == [[1, 3], [2]]
+
+    def test_fan_out_stories(self):
+        group = [dict(id=1), dict(id=2)]
+        stories = [dict(url=f"https://example.com/{i}", project_id=1) for i in range(4)]
+        recent_urls_by_project = {1: set(), 2: {"http://example.com/1"}}
+        stories_by_project = projects.fan_out_stories(
+            stories, group, recent_urls_by_project, 3
+        )
+        assert [s["url"] for s in stories_by_project[1]] == [
+            s["url"] for s in stories[:3]
+        ]
+        assert [s["url"] for s in stories_by_project[2]] == [
+            "https://example.com/0",
+            "https://example.com/2",
+            "https://example.com/3",
+        ]
+        assert all(s["project_id"] == 2 for s in stories_by_project[2])
+        assert all(s["project_id"] == 1 for s in stories)  # originals aren't changed
+        # each project can have its own cap
+        stories_by_project = projects.fan_out_stories(
+            stories, group, recent_urls_by_project, {1: 1, 2: 2}
+        )
+        assert len(stories_by_project[1]) == 1
+        assert len(stories_by_project[2]) == 2
+
 
 if __name__ == "__main__":
     unittest.main()
@@ -0,0 +1,51 @@
+import itertools
+import multiprocessing
+import tempfile
+import threading
+import time
+import unittest
+from typing import List
+
+from processor.ratelimit import SharedTokenBucket, TokenBucket
+
+
+def _take_tokens(bucket: SharedTokenBucket) -> List[float]:
+    times = []
+    for _ in range(5):
+        bucket.acquire()
+        times.append(time.time())
+    return times
+
+
+class TestTokenBucket(unittest.TestCase):
+    def test_shared_across_threads(self):
+        bucket = TokenBucket(rate=20, capacity=1)
+        start = time.monotonic()
+        threads = [
+            threading.Thread(target=lambda: [bucket.acquire() for _ in range(5)])
+            for _ in range(4)
+        ]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        # 20 calls at 20/sec, with the first one free, should take just under a second in total
+        assert time.monotonic() - start >= 0.9
+        assert bucket.waited_secs > 0
+
+
+class TestSharedTokenBucket(unittest.TestCase):
+    def test_shared_across_processes(self):
+        with tempfile.TemporaryDirectory() as directory:
+            bucket = SharedTokenBucket("test", rate=20, directory=directory)
+            # spawn, because forking a process that has already run other tests (and their threads) can hang
+            with multiprocessing.get_context("spawn").Pool(4) as pool:
+                results = pool.map(_take_tokens, [bucket] * 4)
+        # each process on its own could go faster, but together they should stay at 20/sec
+        times = sorted(itertools.chain.from_iterable(results))
+        for i in range(len(times) - 10):
+            assert times[i + 10] - times[i] >= 0.45
+
+
+if __name__ == "__main__":
+    unittest.main()
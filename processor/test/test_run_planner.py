@@ -0,0 +1,42 @@
+import unittest
+
+from processor.run_planner import RunPlanner, expected_secs
+
+
+class TestRunPlanner(unittest.TestCase):
+    def test_expected_secs(self):
+        groups = [[dict(id=1), dict(id=2)], [dict(id=3)], [dict(id=4)]]
+        expected = expected_secs(groups, {1: 10, 2: 40, 3: 100})
+        # a coalesced group takes as long as its slowest project; no history means a typical query
+        assert expected == {1: 40, 3: 100, 4: 40}
+
+    def test_budgets_follow_expected_time(self):
+        planner = RunPlanner(1000, {1: 100, 2: 300}, workers=1, min_secs=0)
+        assert planner.start(1, now=0) == 250
+        # project 1 finished early, so project 2 gets the rest
+        planner.finish(1, now=50)
+        assert planner.start(2, now=50) == 950
+
+    def test_cut(self):
+        planner = RunPlanner(100, {1: 10, 2: 10}, workers=2, min_secs=0)
+        planner.start(1, now=0)
+        assert planner.start(2, now=0) == 100
+        assert not planner.out_of_time(1, now=60)
+        assert planner.out_of_time(1, now=101)
+        planner.finish(1, now=101)
+        planner.finish(2, now=30)
+        assert planner.was_cut(1) and not planner.was_cut(2)
+        assert planner.cut_report() == [dict(key=1, expected=10, used=101)]
+
+    def test_min_secs(self):
+        planner = RunPlanner(100, {1: 1000, 2: 1}, workers=1, min_secs=5)
+        planner.start(1, now=0)
+        # project 1 has all the time, but project 2 still gets a look (as long as the deadline hasn't passed)
+        assert planner.start(2, now=10) == 5
+        # but nothing runs past the deadline
+        planner = RunPlanner(100, {1: 10}, workers=1, min_secs=5)
+        assert planner.start(1, now=98) == 2
+
+
+if __name__ == "__main__":
+    unittest.main()
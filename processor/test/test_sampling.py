@@ -0,0 +1,54 @@
+import collections
+import random
+import unittest
+
+import processor.sampling as sampling
+
+
+class TestSampling(unittest.TestCase):
+    def test_needs_sampling(self):
+        assert not sampling.needs_sampling(None, 100, 3)
+        assert not sampling.needs_sampling(300, 100, 3)
+        assert sampling.needs_sampling(301, 100, 3)
+        assert not sampling.needs_sampling(10000, 100, 0)  # turned off
+
+    def test_pool_and_rate(self):
+        assert sampling.pool_size(100, 10000, 3) == 300
+        assert sampling.pool_size(100, 200, 3) == 200
+        assert sampling.sample_rate(100, 10000) == 0.01
+        assert sampling.sample_rate(100, 50) == 1.0
+
+    def test_allocate(self):
+        assert sampling.allocate(10, [50, 30, 20]) == [5, 3, 2]
+        assert sampling.allocate(10, [1, 1, 1]) == [1, 1, 1]  # only 3 to take
+        assert sum(sampling.allocate(100, [333, 333, 334])) == 100
+        assert sampling.allocate(10, [0, 0]) == [0, 0]
+
+    def test_stratified_sample(self):
+        # one day and one outlet dominate the pool, the way an API's sort order might
+        items = [dict(day=1, media="big", i=i) for i in range(80)]
+        items += [dict(day=1, media="small", i=i) for i in range(5)]
+        items += [dict(day=d, media="other", i=i) for d in [2, 3] for i in range(10)]
+        sample = sampling.stratified_sample(
+            items,
+            30,
+            day_of=lambda s: s["day"],
+            media_of=lambda s: s["media"],
+            rng=random.Random(1),
+        )
+        assert len(sample) == 30
+        by_day = collections.Counter(s["day"] for s in sample)
+        assert by_day == {1: 10, 2: 10, 3: 10}
+        by_media = collections.Counter(s["media"] for s in sample if s["day"] == 1)
+        assert by_media == {"big": 5, "small": 5}
+        # days with too few to fill their share leave it to the rest
+        sample = sampling.stratified_sample(
+            items, 60, day_of=lambda s: s["day"], media_of=lambda s: s["media"]
+        )
+        assert collections.Counter(s["day"] for s in sample) == {1: 40, 2: 10, 3: 10}
+        # nothing to drop
+        assert sampling.stratified_sample(items, 500, len, len) == items
+
+
+if __name__ == "__main__":
+    unittest.main()
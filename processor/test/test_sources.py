@@ -0,0 +1,385 @@
+import datetime as dt
+import time
+import unittest
+from unittest import mock
+
+import processor.sources as sources
+import processor.sources.driver as driver
+from processor.run_planner import RunPlanner
+
+START = dt.datetime(2025, 10, 1, 12, 0, 0)
+
+
+class FakeSource(sources.Source):
+    name = "fake"
+
+    def __init__(self, pages, page_budget=None, incremental=False):
+        self.pages = pages
+        self.page_budget = page_budget
+        self.incremental = incremental
+        self.requests = 0
+        self.usage = []
+        self.caps = {}
+
+    def list_pages(self, project, part, cursor, before_request):
+        for page in self.pages:
+            if not before_request():
+                return
+            self.requests += 1
+            yield page
+
+    def normalize(self, item, project):
+        return dict(url=item["url"], title=item["url"], source=self.name)
+
+    def item_date(self, item):
+        return item["date"]
+
+    def history_cursor(self, history):
+        return history
+
+    def page_budgets(self, project_list):
+        return {p["id"]: self.page_budget for p in project_list}
+
+    def story_caps(self, project_list):
+        return {p["id"]: self.caps.get(p["id"], 100) for p in project_list}
+
+    def record_usage(self, group, pages, stories):
+        self.usage.append((group[0]["id"], pages, stories))
+
+
+class FakePartsSource(FakeSource):
+    part_threads = 2
+
+    def __init__(self, parts, **kwargs):
+        super().__init__([], **kwargs)
+        self.parts = parts
+
+    def query_parts(self, project, start_date, end_date, before_request):
+        return self.parts
+
+    def list_pages(self, project, part, cursor, before_request):
+        for page in part.options["pages"]:
+            if not before_request():
+                return
+            if isinstance(page, Exception):
+                raise page
+            self.requests += 1
+            yield page
+
+
+class FakeShardedSource(FakeSource):
+    """
+    Like the Wayback Machine: results come sorted by domain, and a part can be split by domain.
+    """
+
+    page_size = 2
+
+    def __init__(self, items_by_domain, **kwargs):
+        super().__init__([], **kwargs)
+        self.items_by_domain = items_by_domain
+
+    def _part(self, start_date, end_date, domains):
+        count = sum(len(self.items_by_domain[d]) for d in domains)
+        return sources.QueryPart(start_date, end_date, count, domains=domains)
+
+    def query_parts(self, project, start_date, end_date, before_request):
+        return [self._part(start_date, end_date, sorted(self.items_by_domain))]
+
+    def split_part(self, project, part, before_request):
+        domains = part.options["domains"]
+        if len(domains) < 2:
+            return [part]
+        half = len(domains) // 2
+        return [
+            self._part(part.start_date, part.end_date, domains[:half]),
+            self._part(part.start_date, part.end_date, domains[half:]),
+        ]
+
+    def list_pages(self, project, part, cursor, before_request):
+        items = [i for d in part.options["domains"] for i in self.items_by_domain[d]]
+        for start in range(0, len(items), self.page_size):
+            if not before_request():
+                return
+            self.requests += 1
+            yield items[start : start + self.page_size]
+
+    def normalize(self, item, project):
+        return dict(super().normalize(item, project), media_url=item["domain"])
+
+
+def _items(start, count):
+    # newest first, an hour apart
+    return [
+        dict(url=f"https://example.com/{i}", date=START - dt.timedelta(hours=i))
+        for i in range(start, start + count)
+    ]
+
+
+class TestListStories(unittest.TestCase):
+    def setUp(self):
+        self.recent_urls = {1: set(), 2: {"http://example.com/1"}, 3: set()}
+        self.history = {1: None, 2: None, 3: None}
+        self.updates = []
+        patches = [
+            mock.patch.object(driver.database, "get_session_maker"),
+            mock.patch.object(
+                driver.projects,
+                "group_start_end_dates",
+                return_value=(
+                    (START - dt.timedelta(days=4)).replace(tzinfo=dt.timezone.utc),
+                    START.replace(tzinfo=dt.timezone.utc),
+                ),
+            ),
+            mock.patch.object(
+                driver.projects,
+                "group_recent_normalized_urls",
+                side_effect=lambda session_maker, group, days: (
+                    {p["id"]: set(self.recent_urls[p["id"]]) for p in group},
+                    set.intersection(*[self.recent_urls[p["id"]] for p in group]),
+                ),
+            ),
+            mock.patch.object(
+                driver,
+                "_history_cursors",
+                side_effect=lambda source, session_maker, group: {
+                    p["id"]: self.history[p["id"]] for p in group
+                },
+            ),
+            mock.patch.object(
+                driver.projects_db,
+                "update_history",
+                side_effect=lambda session, pid, date, source: self.updates.append(
+                    (pid, date)
+                ),
+            ),
+        ]
+        for patcher in patches:
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        self.project_list = [
+            dict(id=1, title="one", search_terms="femicide", language="en"),
+            dict(id=2, title="two", search_terms="femicide", language="EN"),
+            dict(id=3, title="three", search_terms="kidnapping", language="en"),
+        ]
+        self.handed = {}
+
+    def _on_stories(self, project, stories):
+        self.handed.setdefault(project["id"], []).extend(stories)
+        return len(stories)
+
+    def test_list_stories(self):
+        source = FakeSource(
+            [_items(0, 3), _items(0, 3) + _items(3, 3), _items(6, 3)], page_budget=2
+        )
+        results = driver.list_stories(source, self.project_list, self._on_stories)
+        # projects 1 and 2 share a query, and the repeated stories on the second page are skipped
+        assert sorted(u[0] for u in source.usage) == [1, 3]
+        assert source.requests == 4  # two pages for each query, that's the budget
+        assert [s["url"] for s in self.handed[1]] == [
+            f"https://example.com/{i}" for i in range(6)
+        ]
+        assert "https://example.com/1" not in [s["url"] for s in self.handed[2]]
+        assert all(s["project_id"] == 2 for s in self.handed[2])
+        assert {r["project_id"]: r["stories"] for r in results} == {1: 6, 2: 5, 3: 6}
+        assert sorted(pid for pid, _ in self.updates) == [1, 2, 3]
+        assert all(date == START for _, date in self.updates)
+
+    def test_no_extra_requests(self):
+        source = FakeSource([_items(i, 2) for i in range(0, 20, 2)])
+        source.caps = {3: 4}
+
+        def slow_on_stories(project, stories):
+            # the next page is prefetched while this runs, but it shouldn't be once we have enough
+            time.sleep(0.2)
+            return self._on_stories(project, stories)
+
+        driver.list_stories(source, self.project_list[2:], slow_on_stories)
+        assert len(self.handed[3]) == 4
+        assert source.requests == 2
+        assert source.usage == [(3, 2, 4)]
+
+    def test_incremental(self):
+        self.history = {1: START - dt.timedelta(hours=2), 2: None, 3: None}
+        source = FakeSource(
+            [_items(0, 3), _items(3, 3), _items(6, 3)], incremental=True
+        )
+        driver.list_stories(source, self.project_list[:1], self._on_stories)
+        # stops at the cursor, less the overlap
+        assert [s["url"] for s in self.handed[1]] == [
+            f"https://example.com/{i}" for i in range(5)
+        ]
+        assert self.updates == [(1, START)]
+
+    def test_incremental_stops_early(self):
+        self.history = {1: START - dt.timedelta(hours=20), 2: None, 3: None}
+        source = FakeSource(
+            [_items(0, 3), _items(3, 3), _items(6, 3)], incremental=True
+        )
+        source.caps = {1: 4}
+        driver.list_stories(source, self.project_list[:1], self._on_stories)
+        # the cap stopped us well before the cursor, so moving it would skip the stories in between
+        assert len(self.handed[1]) == 4
+        assert self.updates == []
+        # same if we run out of pages in the budget
+        self.handed = {}
+        source = FakeSource(
+            [_items(0, 3), _items(3, 3), _items(6, 3)], page_budget=2, incremental=True
+        )
+        driver.list_stories(source, self.project_list[:1], self._on_stories)
+        assert len(self.handed[1]) == 6
+        assert self.updates == []
+        # but running out of results is as good as reaching it
+        source = FakeSource([_items(0, 3), _items(3, 3)], incremental=True)
+        driver.list_stories(source, self.project_list[:1], self._on_stories)
+        assert self.updates == [(1, START)]
+
+    def test_nothing_in_budget(self):
+        source = FakeSource([_items(0, 3)], page_budget=0)
+        results = driver.list_stories(source, self.project_list, self._on_stories)
+        assert source.requests == 0
+        assert all(r["stories"] == 0 for r in results)
+        assert "skipped" in results[0]["email_text"]
+
+    def test_deadline(self):
+        self.history = {1: START - dt.timedelta(hours=2), 2: None, 3: None}
+        source = FakeSource([_items(0, 3)], incremental=True)
+        with mock.patch.object(
+            driver,
+            "plan_run",
+            side_effect=lambda name, groups, deadline, workers: RunPlanner(
+                deadline, {g[0]["id"]: 1 for g in groups}, workers, min_secs=0
+            ),
+        ):
+            results = driver.list_stories(
+                source, self.project_list[:1], self._on_stories, deadline=time.time()
+            )
+        # out of time before the first page, so the cursor stays where it was
+        assert source.requests == 0
+        assert results[0]["cut"]
+        assert "cut short" in results[0]["email_text"]
+        assert self.updates == []
+        assert "1" in driver.cut_text(results)
+
+    def test_skipped_queries_finish_in_planner(self):
+        planners = []
+
+        def plan_run(name, groups, deadline, workers):
+            planners.append(
+                RunPlanner(deadline, {g[0]["id"]: 1 for g in groups}, workers)
+            )
+            return planners[-1]
+
+        source = FakeSource([_items(0, 3)], page_budget=0)
+        with mock.patch.object(driver, "plan_run", side_effect=plan_run):
+            driver.list_stories(
+                source,
+                self.project_list,
+                self._on_stories,
+                deadline=time.time() + 60,
+            )
+        # nothing in the budget, so they don't hold on to a share of the time the other queries could use
+        assert planners[0]._waiting == set()
+
+    def test_story_caps(self):
+        source = FakeSource([_items(0, 3), _items(3, 3), _items(6, 3)])
+        source.caps = {1: 4, 2: 2}
+        results = driver.list_stories(source, self.project_list[:2], self._on_stories)
+        # the shared query keeps going until the project with the bigger cap is full
+        assert len(self.handed[1]) == 4
+        assert len(self.handed[2]) == 2
+        assert {r["project_id"]: r["stories"] for r in results} == {1: 4, 2: 2}
+
+    def test_sampling(self):
+        # a query that matches far more than the cap: list a pool of three times the cap, then sample it
+        pages = [sources.Page(_items(i, 2), total_hits=1000) for i in range(0, 20, 2)]
+        source = FakeSource(pages)
+        source.caps = {3: 2}
+        results = driver.list_stories(source, self.project_list[2:], self._on_stories)
+        assert len(self.handed[3]) == 2
+        assert all(s["sampling_rate"] == 0.002 for s in self.handed[3])
+        assert results[0]["stories"] == 2
+        assert "sampled" in results[0]["email_text"]
+
+    def test_query_parts(self):
+        self.history = {1: START - dt.timedelta(hours=10), 2: None, 3: None}
+        older = sources.QueryPart(
+            START - dt.timedelta(hours=12),
+            START - dt.timedelta(hours=5),
+            5,
+            pages=[_items(5, 5)],
+        )
+        newer = sources.QueryPart(
+            START - dt.timedelta(hours=5),
+            START,
+            5,
+            pages=[_items(0, 2), RuntimeError("down")],
+        )
+        source = FakePartsSource([older, newer], incremental=True)
+        results = driver.list_stories(source, self.project_list[:1], self._on_stories)
+        # the part that worked still hands out its stories
+        assert len(self.handed[1]) == 7
+        assert results[0]["stories"] == 7
+        # but the cursor can only move up to the start of the one that failed
+        assert self.updates == [(1, START - dt.timedelta(hours=5))]
+
+    def test_sampling_parts(self):
+        # each part lists its share of the pool, in proportion to how many stories it has
+        big = sources.QueryPart(
+            START - dt.timedelta(days=1),
+            START,
+            900,
+            pages=[_items(0, 10), _items(20, 10), _items(30, 10)],
+        )
+        small = sources.QueryPart(
+            START - dt.timedelta(days=2),
+            START - dt.timedelta(days=1),
+            100,
+            pages=[_items(10, 10)],
+        )
+        source = FakePartsSource([big, small])
+        source.caps = {3: 5}
+        driver.list_stories(source, self.project_list[2:], self._on_stories)
+        assert (big.quota, small.quota) == (14, 1)
+        assert source.requests == 3
+        assert len(self.handed[3]) == 5
+        assert all(s["sampling_rate"] == 0.005 for s in self.handed[3])
+
+    def test_sampling_late_domains(self):
+        # sorted by domain, the first stories in the results would all be from the first domain or two
+        domains = ["a.com", "b.com", "c.com", "d.com"]
+        source = FakeShardedSource(
+            {
+                d: [
+                    dict(url=f"https://{d}/{i}", date=START, domain=d)
+                    for i in range(10)
+                ]
+                for d in domains
+            }
+        )
+        source.caps = {3: 4}
+        driver.list_stories(source, self.project_list[2:], self._on_stories)
+        # but each domain gets its share of the pool, so the sample has them all
+        assert len(self.handed[3]) == 4
+        assert sorted(s["media_url"] for s in self.handed[3]) == domains
+
+    def test_split_part_by_day(self):
+        part = sources.QueryPart(
+            START - dt.timedelta(days=2, hours=12), START, 100, country="us"
+        )
+        days = FakeSource([]).split_part(None, part, lambda: True)
+        assert [(d.start_date, d.end_date) for d in days] == [
+            (
+                START - dt.timedelta(days=2, hours=12),
+                START - dt.timedelta(days=1, hours=12),
+            ),
+            (START - dt.timedelta(days=1, hours=12), START - dt.timedelta(hours=12)),
+            (START - dt.timedelta(hours=12), START),
+        ]
+        assert all(
+            (d.count is None) and (d.options == dict(country="us")) for d in days
+        )
+        assert FakeSource([]).split_part(None, days[0], lambda: True) == [days[0]]
+
+
+if __name__ == "__main__":
+    unittest.main()
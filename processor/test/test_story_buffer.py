@@ -0,0 +1,31 @@
+import os
+import unittest
+
+from processor.story_buffer import StoryBuffer
+
+
+class TestStoryBuffer(unittest.TestCase):
+    def test_round_trip(self):
+        for compress in [True, False]:
+            with StoryBuffer(compress=compress) as story_buffer:
+                story = dict(url="http://a.com/1", project_id=1, story_text="uno")
+                story_buffer.add(story)
+                assert "story_text" not in story  # the text lives on disk now
+                story_buffer.add(
+                    dict(url="http://b.com/1", project_id=2, story_text="dos ñ")
+                )
+                assert story_buffer.project_stories(2)[0]["story_text"] == "dos ñ"
+                # make sure adding after a read still appends
+                story_buffer.add(
+                    dict(url="http://a.com/2", project_id=1, story_text="tres")
+                )
+                project_stories = story_buffer.project_stories(1)
+                assert [s["story_text"] for s in project_stories] == ["uno", "tres"]
+                assert len(story_buffer) == 3
+                assert story_buffer.project_stories(3) == []
+                path = story_buffer.path
+            assert not os.path.exists(path)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,75 @@
+import unittest
+from unittest import mock
+
+import processor.story_caps as story_caps
+
+
+def _stats(processed, above, posted=None, busiest_day=0):
+    return dict(
+        processed=processed,
+        above=above,
+        posted=above if posted is None else posted,
+        busiest_day=busiest_day,
+    )
+
+
+class TestStoryCaps(unittest.TestCase):
+    def test_parse_overrides(self):
+        assert story_caps.parse_overrides("") == {}
+        assert story_caps.parse_overrides("12=2000, 40:newscatcher=100") == {
+            (12, None): 2000,
+            (40, "newscatcher"): 100,
+        }
+
+    def test_project_cap(self):
+        # not enough history to judge yet
+        assert story_caps.project_cap(500, None, 0.2, 50, 1000) == 500
+        assert story_caps.project_cap(500, _stats(5, 1), 0.2, 50, 1000) == 500
+        # nothing useful lately
+        assert story_caps.project_cap(500, _stats(400, 0), 0.2, 50, 1000) == 50
+        # half as productive as the typical project
+        assert story_caps.project_cap(500, _stats(400, 40), 0.2, 50, 1000) == 250
+        # more productive, but it never ran into its cap so it wouldn't get more stories anyway
+        assert (
+            story_caps.project_cap(
+                500, _stats(400, 160, busiest_day=100), 0.2, 50, 1000
+            )
+            == 500
+        )
+        # more productive and cut off by its cap, up to the max
+        assert (
+            story_caps.project_cap(
+                500, _stats(400, 120, busiest_day=500), 0.2, 50, 1000
+            )
+            == 750
+        )
+        assert (
+            story_caps.project_cap(
+                500, _stats(400, 400, busiest_day=500), 0.2, 50, 1000
+            )
+            == 1000
+        )
+
+    def test_story_caps(self):
+        stats = {
+            1: _stats(100, 10),
+            2: _stats(100, 20),
+            3: _stats(100, 30),
+            4: _stats(100, 0),
+        }
+        project_list = [dict(id=pid) for pid in [1, 2, 3, 4, 5]]
+        with (
+            mock.patch.object(story_caps.database, "get_session_maker"),
+            mock.patch.object(
+                story_caps.stories_db, "project_story_stats", return_value=stats
+            ),
+        ):
+            caps = story_caps.story_caps(
+                "newscatcher", 500, project_list, overrides={(5, "newscatcher"): 20}
+            )
+        # the typical yield is the median, 0.15
+        assert caps == {1: 333, 2: 500, 3: 500, 4: 50, 5: 20}
+
+
+if __name__ == "__main__":
+    unittest.main()
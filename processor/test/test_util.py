@@ -41,3 +41,20 @@ class TestUtil(unittest.TestCase):
         assert unique_stories[5]["title"] == "Story 27"
         assert unique_stories[6]["title"] == "Story 100"
         assert unique_stories[7]["title"] == "Story 102"
+
+    def test_prefetch(self):
+        def pages():
+            for i in range(5):
+                yield i
+
+        assert list(util.prefetch(pages())) == [0, 1, 2, 3, 4]
+
+        def failing_pages():
+            yield 1
+            raise ValueError("bad page")
+
+        results = []
+        with self.assertRaises(ValueError):
+            for page in util.prefetch(failing_pages()):
+                results.append(page)
+        assert results == [1]
@@ -1,5 +1,9 @@
 import logging
-from typing import Dict, List
+import queue
+import threading
+from typing import Dict, Generator, Iterable, List, TypeVar
+
+T = TypeVar("T")
 
 logger = logging.getLogger(__name__)
 
@@ -13,6 +17,49 @@ def chunks(lst, n):
         yield lst[i : i + n]
 
 
+def prefetch(iterable: Iterable[T], depth: int = 1) -> Generator[T, None, None]:
+    """
+    Pull items from `iterable` in a background thread, staying up to `depth` items ahead of the caller. Useful for
+    paging through an API, so the next page request is in flight while the caller works on the current page. Any
+    exception from the iterable is raised to the caller. Call `close()` on the result to stop early.
+    """
+    items = queue.Queue(maxsize=depth)
+    stop = threading.Event()
+    done = object()  # sentinel for the end of the iterable
+
+    def put(entry) -> bool:
+        # give up if the caller has stopped listening, so this thread doesn't hang around forever
+        while not stop.is_set():
+            try:
+                items.put(entry, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def producer():
+        try:
+            for item in iterable:
+                if not put((item, None)):
+                    return
+            put((done, None))
+        except Exception as e:
+            put((done, e))
+
+    thread = threading.Thread(target=producer, daemon=True)
+    thread.start()
+    try:
+        while True:
+            item, error = items.get()
+            if error is not None:
+                raise error
+            if item is done:
+                return
+            yield item
+    finally:
+        stop.set()
+
+
 def remove_duplicate_by_title_media_id(stories: List[Dict]) -> List[Dict]:
     """
     Remove duplicate stories based on matching title and media_id. Keeps only one story for
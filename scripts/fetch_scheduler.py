@@ -0,0 +1,186 @@
+# ruff: noqa: E402
+
+import importlib
+import logging
+import multiprocessing
+import os
+import signal
+import sys
+import threading
+import time
+from typing import Dict, List, Tuple
+
+# Disable loggers prior to package imports
+import processor
+
+processor.disable_package_loggers()
+
+import processor.fetcher as fetcher
+import processor.projects as projects
+import processor.run_planner as run_planner
+from processor.classifiers import download_models
+from processor.fetch_schedule import SourceSchedule
+
+# the fetch job for each source, and when to run it: "<interval hours>@<hours past midnight UTC>", or "0" to turn it off
+FETCHERS = {
+    processor.SOURCE_MEDIA_CLOUD: (
+        "scripts.queue_mediacloud_stories",
+        os.environ.get("FETCH_SCHEDULE_MC", "24@22"),
+    ),
+    processor.SOURCE_WAYBACK_MACHINE: (
+        "scripts.queue_wayback_stories",
+        os.environ.get("FETCH_SCHEDULE_WM", "24@1"),
+    ),
+    processor.SOURCE_NEWSDATA: (
+        "scripts.queue_newsdata_stories",
+        os.environ.get("FETCH_SCHEDULE_ND", "24@3"),
+    ),
+    processor.SOURCE_NEWSCATCHER: (
+        "scripts.queue_newscatcher_stories",
+        os.environ.get("FETCH_SCHEDULE_NC", "24@5"),
+    ),
+}
+MAX_CONCURRENT_RUNS = int(
+    os.environ.get("FETCH_MAX_CONCURRENT_RUNS", 2)
+)  # a due source waits for a free spot
+PROJECT_RELOAD_SECS = int(os.environ.get("FETCH_PROJECT_RELOAD_SECS", 60 * 60))
+MODEL_CHECK_SECS = int(os.environ.get("FETCH_MODEL_CHECK_SECS", 60 * 60))
+RUN_ON_START = (
+    os.environ.get("FETCH_RUN_ON_START", "false").lower() == "true"
+)  # run every source right away, instead of waiting for its first slot
+RETRY_SECS = 5 * 60  # if we can't get the models or projects, try again this much later
+TICK_SECS = 30
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+
+class FetchScheduler:
+    """
+    Runs each source's fetch job on its schedule, inside this one long-lived process. The fetch modules, their API
+    clients and rate limiters, the DB connection pool, the classifier models and the project list all stay loaded
+    between runs, instead of each run paying to set them up again as a cold process. A source never runs twice at
+    once; if its next slot comes up while it is still going, that slot is skipped.
+    """
+
+    def __init__(self, schedules: List[SourceSchedule]):
+        self._schedules = [s for s in schedules if s.enabled]
+        self._modules = {
+            s.source: importlib.import_module(FETCHERS[s.source][0])
+            for s in self._schedules
+        }
+        self._next_runs: Dict[str, Tuple[float, float]] = {}  # source -> (slot, due)
+        self._threads: Dict[str, threading.Thread] = {}
+        self._models_checked_at = 0.0
+        self._projects_loaded_at = 0.0
+        now = time.time()
+        for s in self._schedules:
+            self._next_runs[s.source] = (
+                (s.slot_start(now), now) if RUN_ON_START else s.next_run(now)
+            )
+            logger.info(
+                "  {} runs every {:g} hours, next at {}".format(
+                    s.source,
+                    s.interval_secs / 60 / 60,
+                    time.strftime(
+                        "%Y-%m-%d %H:%M UTC", time.gmtime(self._next_runs[s.source][1])
+                    ),
+                )
+            )
+
+    def refresh(self, now: float) -> bool:
+        """
+        Make sure the models and the project list aren't stale before a run starts.
+        :return: False if we couldn't get the models, so the run shouldn't go ahead
+        """
+        if now - self._models_checked_at >= MODEL_CHECK_SECS:
+            # important to do because there might be new models on the server!
+            logger.info("  Checking for any new models we need")
+            if not download_models():
+                return False
+            self._models_checked_at = now
+        if now - self._projects_loaded_at >= PROJECT_RELOAD_SECS:
+            projects.load_project_list(force_reload=True, overwrite_last_story=False)
+            self._projects_loaded_at = now
+        return True
+
+    def _run(self, source: str, deadline_secs: float) -> None:
+        start_time = time.time()
+        try:
+            self._modules[source].run(force_reload=False, deadline_secs=deadline_secs)
+        except Exception as e:
+            logger.exception(f"{source} run failed: {e}")
+        logger.info(
+            "{} run finished after {:.0f} mins".format(
+                source, (time.time() - start_time) / 60
+            )
+        )
+
+    def running(self) -> List[str]:
+        return [source for source, t in self._threads.items() if t.is_alive()]
+
+    def tick(self, now: float) -> None:
+        """
+        Start any runs that are due.
+        """
+        for s in self._schedules:
+            slot, due = self._next_runs[s.source]
+            if now < due:
+                continue
+            running = self.running()
+            if s.source in running:
+                self._next_runs[s.source] = s.next_run(now)
+                logger.warning(
+                    "Skipping the {} run for {}, the last one is still going".format(
+                        s.source, time.strftime("%Y-%m-%d %H:%M", time.gmtime(slot))
+                    )
+                )
+                continue
+            if len(running) >= MAX_CONCURRENT_RUNS:
+                continue  # still due, so it starts once another run finishes
+            if not self.refresh(now):
+                logger.error(f"Couldn't get the models, will try {s.source} again soon")
+                self._next_runs[s.source] = (slot, now + RETRY_SECS)
+                continue
+            self._next_runs[s.source] = s.next_run(now)
+            # without a deadline of its own, a run has to be done by its next slot, so it doesn't end up skipped
+            deadline_secs = run_planner.RUN_DEADLINE_SECS or max(
+                0.0, self._next_runs[s.source][0] - now
+            )
+            logger.info(f"Starting {s.source} run")
+            # a daemon thread, so we can shut down without waiting for it (the run ledger lets it resume)
+            thread = threading.Thread(
+                target=self._run,
+                args=(s.source, deadline_secs),
+                name=s.source,
+                daemon=True,
+            )
+            self._threads[s.source] = thread
+            thread.start()
+
+    def run_forever(self, stop: threading.Event) -> None:
+        while not stop.is_set():
+            self.tick(time.time())
+            stop.wait(TICK_SECS)
+        running = self.running()
+        if running:
+            logger.info("Stopping with runs still going: {}".format(", ".join(running)))
+
+
+if __name__ == "__main__":
+    logger.info("Starting fetch scheduler")
+    # a Twisted reactor can't be restarted once it stops, so each crawl needs to happen in child processes
+    fetcher.FETCHER_PROCESSES = max(1, fetcher.FETCHER_PROCESSES)
+    # runs go on in threads next to each other here, with warm DB pools and locks held, so never fork a child from
+    # one of them; any process pool a fetcher starts gets a fresh interpreter instead
+    multiprocessing.set_start_method("spawn")
+    schedules = [
+        SourceSchedule.parse(source, spec) for source, (_, spec) in FETCHERS.items()
+    ]
+    scheduler = FetchScheduler(schedules)
+    if not scheduler.refresh(time.time()):
+        sys.exit(1)
+    stop_event = threading.Event()
+    signal.signal(signal.SIGTERM, lambda signum, frame: stop_event.set())
+    signal.signal(signal.SIGINT, lambda signum, frame: stop_event.set())
+    scheduler.run_forever(stop_event)
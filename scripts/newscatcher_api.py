@@ -3,6 +3,7 @@ import logging
 from typing import Any, Dict, List, Optional
 
 import requests
+import requests.adapters
 import requests.exceptions
 from requests_ratelimiter import LimiterAdapter
 
@@ -13,19 +14,26 @@ logger = logging.getLogger(__name__)
 logger.setLevel(logging.INFO)
 
 
-def create_session(rate_limit: Optional[int] = 1) -> requests.Session:
+def create_session(
+    rate_limit: Optional[int] = 1, pool_size: int = 10
+) -> requests.Session:
     """
     Create a requests session with a rate limiter.
 
     Args:
-        rate_limit (Optional[int]): The number of requests allowed per second where the default is 1.
+        rate_limit (Optional[int]): The number of requests allowed per second where the default is 1. Pass None if
+            the caller does its own rate limiting.
+        pool_size (int): How many connections to keep open (ie. how many threads will be sharing the session).
 
     Returns:
         requests.Session: A configured requests session
     """
     session = requests.Session()
-    limiter = LimiterAdapter(per_second=rate_limit)
-    session.mount("https://", limiter)
+    if rate_limit is None:
+        adapter = requests.adapters.HTTPAdapter(pool_maxsize=pool_size)
+    else:
+        adapter = LimiterAdapter(per_second=rate_limit, pool_maxsize=pool_size)
+    session.mount("https://", adapter)
 
     return session
 
@@ -39,6 +47,8 @@ def search_stories(
     page: int = 1,
     page_size: int = 200,
     session: Optional[requests.Session] = None,
+    sort_by: Optional[str] = None,
+    date_format: str = "%Y-%m-%d",
 ) -> Dict[str, Any]:
     """
     Fetch stories from the Newscatcher API based on provided parameters.
@@ -52,6 +62,9 @@ def search_stories(
         end_date (datetime): the end date for the search.
         page (int, optional): The page number to fetch where the default is 1.
         page_size (int, optional): The number of results per page where the default is 200.
+        sort_by (str, optional): "relevancy" (the API's default), "date" (newest first) or "rank".
+        date_format (str, optional): How to send the start and end dates; include the time to search from a precise
+            moment rather than the start of the day.
 
     Returns:
         Dict[str, Any]: The JSON response containing the stories if successful.
@@ -61,10 +74,12 @@ def search_stories(
         "lang": language.lower(),
         "countries": countries,
         "page_size": page_size,
-        "from_": start_date.strftime("%Y-%m-%d"),
-        "to_": end_date.strftime("%Y-%m-%d"),
+        "from_": start_date.strftime(date_format),
+        "to_": end_date.strftime(date_format),
         "page": page,
     }
+    if sort_by is not None:
+        params["sort_by"] = sort_by
 
     # create session if one isn't passed
     if session is None:
@@ -2,11 +2,12 @@
 
 import datetime as dt
 import logging
-import multiprocessing
+import math
 import os
 import sys
 import time
-from typing import Dict, List
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict, Iterator, List, Optional, Tuple
 
 import pytz
 
@@ -16,206 +17,413 @@ import processor
 processor.disable_package_loggers()
 
 
+import mcmetadata.urls as urls
+import mediacloud.api
+
 import processor.database as database
-import processor.database.projects_db as projects_db
 import processor.database.stories_db as stories_db
 import processor.projects as projects
+import processor.ratelimit as ratelimit
+import processor.run_planner as run_planner
+import processor.sources as sources
+import processor.sources.driver as driver
 import processor.tasks.classification as classification_tasks
 import scripts.tasks as tasks
 from processor import get_mc_client
 from processor.classifiers import download_models
+from processor.database.models import ProjectHistory
 
-POOL_SIZE = int(os.environ.get("MC_POOL_SIZE", 3))
+# threads processing projects at once
+POOL_SIZE = int(os.environ.get("MC_POOL_SIZE", 8))
 DAY_OFFSET = 1  # stories are ingested within a day of discovery
 DAY_WINDOW = 4  # don't look for stories too old (DEFAULT_DAY_OFFSET + DEFAULT_DAY_WINDOW at most)
 STORIES_PER_PAGE = 1000
-MAX_STORIES_PER_PROJECT = 5000
+MAX_STORIES_PER_PROJECT = (
+    5000  # for a typical project, each one gets its own cap (see processor.story_caps)
+)
+# list stories without text first, and only fetch text for the ones we haven't already seen; this saves a lot of
+# bandwidth for projects that find many of the same stories day to day
+TWO_PHASE_FETCH = os.environ.get("MC_TWO_PHASE_FETCH", "false").lower() == "true"
+TEXT_FETCH_THREADS = int(os.environ.get("MC_TEXT_FETCH_THREADS", 4))
+# broad queries get their indexed_date window split into slices of about this many stories, paged in parallel
+SLICE_MAX_STORIES = int(os.environ.get("MC_SLICE_MAX_STORIES", 2000))
+SLICE_THREADS = int(os.environ.get("MC_SLICE_THREADS", 4))
+MIN_SLICE_WINDOW = dt.timedelta(minutes=30)  # don't split windows smaller than this
 
+QUERY_FIELDS = [
+    "search_terms",
+    "language",
+    "media_collections",
+]  # projects with the same values for these share a query
 INCLUSIVE_RANGE_START = "{"
 EXCLUSIVE_RANGE_END = "]"
+# every worker thread (and any other fetcher process on this host) shares this, so we stay under the API's limit
+rate_limiter = ratelimit.shared_rate_limiter(processor.SOURCE_MEDIA_CLOUD)
 
 logger = logging.getLogger(__name__)
 
 
-def load_projects_task() -> List[Dict]:
+def load_projects_task(force_reload: bool = True) -> List[Dict]:
     project_list = projects.load_project_list(
-        force_reload=True, overwrite_last_story=False
+        force_reload=force_reload, overwrite_last_story=False
     )
     logger.info("  Checking {} projects".format(len(project_list)))
     # return [p for p in project_list if p["id"] == 177]
     return project_list
 
 
-def _process_project_task(args: Dict) -> Dict:
-    project, page_size, max_stories = args
+def _fetch_new_story_texts(
+    mc: mediacloud.api.SearchApi, group: List[Dict], stories: List[Dict]
+) -> List[Dict]:
+    """
+    Two-phase fetch: drop the listed (unexpanded) stories we already have in the DB for every project in the
+    (coalesced) group, then fetch the text for just the new ones.
+    :return: the new stories, with `text` filled in (any we couldn't get text for are left out)
+    """
+    project = group[0]
+    normalized_urls = [urls.normalize_url(s["url"].rstrip("/")) for s in stories]
     Session = database.get_session_maker()
-    # here confusingly start_date is a useful indexed_date, but end_date is a useful publication_date
-    start_date, end_date = projects.query_start_end_dates(
-        project,
-        Session,
-        DAY_OFFSET,
-        DAY_WINDOW,
-        processor.SOURCE_MEDIA_CLOUD,
-    )
-    utc = pytz.UTC
-    # indexed_date filter should be from last search until now
-    indexed_start = start_date
-    indexed_end = utc.localize(dt.datetime.now())
-    # published_date filter should be the day window for recency (this is stored in MC as date, not datetime)
-    pub_start_date = dt.date.today() - dt.timedelta(days=(DAY_OFFSET + DAY_WINDOW))
-    pub_end_date = end_date.date()
-    project_email_message = ""
-    logger.info("Checking project {}/{}".format(project["id"], project["title"]))
-    logger.debug("  {} stories/page up to {}".format(page_size, max_stories))
-    project_email_message += "Project {} - {}:\n".format(
-        project["id"], project["title"]
+    with Session() as session:
+        existing = set.intersection(
+            *[
+                stories_db.project_existing_normalized_urls(
+                    session, gp["id"], normalized_urls
+                )
+                for gp in group
+            ]
+        )
+    new_stories = [s for s, u in zip(stories, normalized_urls) if u not in existing]
+
+    def fetch_text(story: Dict) -> Optional[Dict]:
+        rate_limiter.acquire()
+        try:
+            story["text"] = mc.story(story["id"])["text"]
+            return story
+        except Exception as e:
+            logger.warning(f"  Couldn't fetch text for story {story['id']}: {e}")
+            return None
+
+    with ThreadPoolExecutor(max_workers=TEXT_FETCH_THREADS) as executor:
+        stories_with_text = [s for s in executor.map(fetch_text, new_stories) if s]
+    logger.info(
+        "    {} - fetched text for {} new stories (of {} listed)".format(
+            project["id"], len(stories_with_text), len(stories)
+        )
     )
-    # setup queries to filter by language too, so we only get stories the model can process
-    indexed_date_query_clause = f"indexed_date:{INCLUSIVE_RANGE_START}{indexed_start.isoformat()} TO {indexed_end.isoformat()}{EXCLUSIVE_RANGE_END}"
-    q = f"({project['search_terms']}) AND language:{project['language'].lower()} AND {indexed_date_query_clause}"
+    return stories_with_text
+
 
-    # see how many stories
-    mc = get_mc_client()
-    try:
-        total_stories = mc.story_count(
+def _story_pages(
+    mc: mediacloud.api.SearchApi,
+    q: str,
+    pub_start_date: dt.date,
+    pub_end_date: dt.date,
+    collection_ids: List[int],
+    before_request: Callable[[], bool],
+    expanded: bool = not TWO_PHASE_FETCH,
+) -> Iterator[List[Dict]]:
+    """
+    Page through the stories matching a query, one page at a time.
+    :param before_request: called before each page, stops paging if it returns False
+    :param expanded: if True the stories come with their text
+    """
+    page_token = None
+    while before_request():
+        page_of_stories, page_token = mc.story_list(
             q,
             pub_start_date,
             pub_end_date,
-            collection_ids=project["media_collections"],
-        )["relevant"]
-    except Exception as e:
-        logger.error(
-            "  Couldn't count stories in project {}. Skipping project for now. {}".format(
-                project["id"], e
+            collection_ids=collection_ids,
+            pagination_token=page_token,
+            page_size=STORIES_PER_PAGE,
+            sort_order="desc",
+            expanded=expanded,
+        )
+        yield page_of_stories
+        if (page_token is None) or (len(page_of_stories) == 0):
+            return
+
+
+def _naive_utc(date: dt.datetime) -> dt.datetime:
+    # MC dates and our saved cursors are UTC, but not always marked as such
+    if date.tzinfo is not None:
+        return date.astimezone(pytz.UTC).replace(tzinfo=None)
+    return date
+
+
+def _project_query(
+    project: Dict, indexed_start: dt.datetime, indexed_end: dt.datetime
+) -> str:
+    # setup queries to filter by language too, so we only get stories the model can process
+    indexed_date_query_clause = f"indexed_date:{INCLUSIVE_RANGE_START}{indexed_start.isoformat()} TO {indexed_end.isoformat()}{EXCLUSIVE_RANGE_END}"
+    return f"({project['search_terms']}) AND language:{project['language'].lower()} AND {indexed_date_query_clause}"
+
+
+def _count_stories(
+    mc: mediacloud.api.SearchApi,
+    q: str,
+    pub_start_date: dt.date,
+    pub_end_date: dt.date,
+    collection_ids: List[int],
+) -> int:
+    return mc.story_count(
+        q, pub_start_date, pub_end_date, collection_ids=collection_ids
+    )["relevant"]
+
+
+def _slice_indexed_window(
+    mc: mediacloud.api.SearchApi,
+    project: Dict,
+    indexed_start: dt.datetime,
+    indexed_end: dt.datetime,
+    story_count: int,
+    pub_start_date: dt.date,
+    pub_end_date: dt.date,
+    before_request: Callable[[], bool],
+) -> List[Tuple[dt.datetime, dt.datetime, int]]:
+    """
+    Split the indexed_date window into sub-windows of at most SLICE_MAX_STORIES stories each (based on story counts),
+    so broad queries can be paged through in parallel instead of through one long cursor. Any slice that is still too
+    big gets split again.
+    :param before_request: called before each count; if it returns False the window is left as it is
+    :return: (start, end, story count) for each slice, oldest first
+    """
+    if (story_count <= SLICE_MAX_STORIES) or (
+        indexed_end - indexed_start < MIN_SLICE_WINDOW * 2
+    ):
+        return [(indexed_start, indexed_end, story_count)]
+    slice_count = min(
+        math.ceil(story_count / SLICE_MAX_STORIES),
+        int((indexed_end - indexed_start) / MIN_SLICE_WINDOW),
+    )
+    step = (indexed_end - indexed_start) / slice_count
+    windows = [
+        (
+            indexed_start + step * i,
+            indexed_end if i == slice_count - 1 else indexed_start + step * (i + 1),
+        )
+        for i in range(slice_count)
+    ]
+    counts = []
+    for start, end in windows:
+        if not before_request():
+            return [(indexed_start, indexed_end, story_count)]
+        counts.append(
+            _count_stories(
+                mc,
+                _project_query(project, start, end),
+                pub_start_date,
+                pub_end_date,
+                project["media_collections"],
             )
         )
-        project_email_message += "    failed to count with {}\n\n".format(e)
-        return dict(
-            email_text=project_email_message,
-            stories=0,
-            pages=0,
+    slices = []
+    for (start, end), count in zip(windows, counts):
+        if count > 0:
+            slices += _slice_indexed_window(
+                mc,
+                project,
+                start,
+                end,
+                count,
+                pub_start_date,
+                pub_end_date,
+                before_request,
+            )
+    return slices
+
+
+class MediaCloudSource(sources.Source):
+    name = processor.SOURCE_MEDIA_CLOUD
+    query_fields = QUERY_FIELDS
+    day_offset = DAY_OFFSET
+    day_window = DAY_WINDOW
+    max_stories_per_project = MAX_STORIES_PER_PROJECT
+    pool_size = POOL_SIZE
+    part_threads = SLICE_THREADS
+    page_size = STORIES_PER_PAGE
+    rate_limiter = rate_limiter
+    # the cursor is the latest indexed_date we've listed everything before, and the query starts right there
+    incremental = True
+    cursor_overlap = dt.timedelta(0)
+    has_text = True
+
+    def query_parts(
+        self,
+        project: Dict,
+        start_date: dt.datetime,
+        end_date: dt.datetime,
+        before_request: Callable[[], bool],
+    ) -> List[sources.QueryPart]:
+        # here confusingly start_date is a useful indexed_date, but end_date is a useful publication_date
+        utc = pytz.UTC
+        indexed_start = utc.localize(_naive_utc(start_date))
+        indexed_end = utc.localize(dt.datetime.now())
+        # published_date filter should be the day window for recency (this is stored in MC as date, not datetime)
+        pub_start_date = dt.date.today() - dt.timedelta(days=(DAY_OFFSET + DAY_WINDOW))
+        pub_end_date = end_date.date()
+        # see how many stories
+        mc = get_mc_client()
+        if not before_request():
+            return []
+        total_stories = _count_stories(
+            mc,
+            _project_query(project, indexed_start, indexed_end),
+            pub_start_date,
+            pub_end_date,
+            project["media_collections"],
         )
-    logger.info("  Project {}: {} total stories".format(project["id"], total_stories))
-    # page through stories with text
-    story_count = 0
-    page_count = 0
-    more_stories = True
-    page_token = None
-    latest_indexed_date = dt.datetime.today() - dt.timedelta(weeks=2)  # a while ago
-    while more_stories and (story_count < max_stories):
+        logger.info(
+            "  Project {}: {} total stories".format(project["id"], total_stories)
+        )
+        # broad queries get split up by indexed_date, so we can page through the slices in parallel
         try:
-            page_of_stories, page_token = mc.story_list(
-                q,
+            slices = _slice_indexed_window(
+                mc,
+                project,
+                indexed_start,
+                indexed_end,
+                total_stories,
                 pub_start_date,
                 pub_end_date,
-                collection_ids=project["media_collections"],
-                pagination_token=page_token,
-                page_size=STORIES_PER_PAGE,
-                sort_order="desc",
-                expanded=True,
-            )
-            logger.info(
-                "    {} - page {}: ({}) stories".format(
-                    project["id"], page_count, len(page_of_stories)
-                )
+                before_request,
             )
         except Exception as e:
-            logger.error(
-                "  Story list error on project {}. Skipping project for now. {}".format(
+            logger.warning(
+                "  Couldn't slice project {}, paging through it all at once. {}".format(
                     project["id"], e
                 )
             )
-            more_stories = False
-            continue  # fail gracefully by going to the next project; maybe next cron run it'll work?
-        if len(page_of_stories) > 0:
-            page_latest_indexed_date = max([s["indexed_date"] for s in page_of_stories])
-
-            # Make sure we are offset-naive for compatibility
-            try:
-                if page_latest_indexed_date.tzinfo is not None:
-                    page_latest_indexed_date = page_latest_indexed_date.replace(
-                        tzinfo=None
-                    )
-                if latest_indexed_date.tzinfo is not None:
-                    latest_indexed_date = latest_indexed_date.replace(tzinfo=None)
-            except AttributeError as e:
-                logger.error(f"Cannot process indexed dates: {e}")
-                raise
-
-            latest_indexed_date = max(latest_indexed_date, page_latest_indexed_date)
-            for s in page_of_stories:
-                s["source"] = processor.SOURCE_MEDIA_CLOUD
-                s["source_publish_date"] = str(s["publish_date"])
-                s["indexed_date"] = s["indexed_date"]
-                s["project_id"] = project["id"]
-                s["story_text"] = s["text"]
-                s["url"] = s["url"].rstrip("/")
-            page_count += 1
-            # and log that we got and queued them all
-            Session = database.get_session_maker()
-            with Session() as session:
-                stories_to_queue = stories_db.add_stories(
-                    session, page_of_stories, project, processor.SOURCE_MEDIA_CLOUD
-                )
-                story_count += len(stories_to_queue)
-                classification_tasks.classify_and_post_worker.delay(
-                    project, stories_to_queue
-                )
-                # important to write this update now, because we have queued up the task to process these stories
-                # the task queue will manage retrying with the stories if it fails with this batch
-                projects_db.update_history(
-                    session,
-                    project["id"],
-                    latest_indexed_date,  # this will be interpreted next time as GMT, so make sure it is(!)
-                    processor.SOURCE_MEDIA_CLOUD,
+            slices = [(indexed_start, indexed_end, total_stories)]
+        if len(slices) > 1:
+            logger.info(
+                "  Project {}: split into {} slices ({})".format(
+                    project["id"], len(slices), [count for _, _, count in slices]
                 )
-                more_stories = page_token is not None
-        else:
-            more_stories = False
-    logger.info(
-        "  queued {} stories for project {}/{} (in {} pages)".format(
-            story_count, project["id"], project["title"], page_count
+            )
+        return [
+            sources.QueryPart(
+                start,
+                end,
+                count,
+                pub_start_date=pub_start_date,
+                pub_end_date=pub_end_date,
+            )
+            for start, end, count in slices
+        ]
+
+    def split_part(
+        self,
+        project: Dict,
+        part: sources.QueryPart,
+        before_request: Callable[[], bool],
+    ) -> List[sources.QueryPart]:
+        # a slice being sampled is halved by indexed_date (and each half counted), so its share of the sample comes
+        # from all of it rather than just the stories at the top of the sort order
+        if part.end_date - part.start_date < MIN_SLICE_WINDOW * 2:
+            return [part]
+        middle = part.start_date + (part.end_date - part.start_date) / 2
+        halves = []
+        for start, end in [(part.start_date, middle), (middle, part.end_date)]:
+            if not before_request():
+                return [part]
+            count = _count_stories(
+                get_mc_client(),
+                _project_query(project, start, end),
+                part.options["pub_start_date"],
+                part.options["pub_end_date"],
+                project["media_collections"],
+            )
+            halves.append(sources.QueryPart(start, end, count, **part.options))
+        return halves
+
+    def list_pages(
+        self,
+        project: Dict,
+        part: sources.QueryPart,
+        cursor: Optional[dt.datetime],
+        before_request: Callable[[], bool],
+    ) -> Iterator[List[Dict]]:
+        return _story_pages(
+            get_mc_client(),
+            _project_query(project, part.start_date, part.end_date),
+            part.options["pub_start_date"],
+            part.options["pub_end_date"],
+            project["media_collections"],
+            before_request,
+            # Even a part we're sampling comes with its text: its pool is only a few pages, while fetching the text of
+            # the sample one story at a time would mean a call per story, all waiting on the same rate limiter.
+            expanded=not TWO_PHASE_FETCH,
         )
-    )
-    #  add a summary to the email we are generating
-    warnings = ""
-    if story_count > (max_stories * 0.8):  # try to get our attention in the email
-        warnings += "(⚠️️️ query might be too broad)"
-    project_email_message += "    found {} new stories (over {} pages) {}\n\n".format(
-        story_count, page_count, warnings
-    )
-    return dict(
-        email_text=project_email_message,
-        stories=story_count,
-        pages=page_count,
-    )
 
+    def normalize(self, item: Dict, project: Dict) -> Dict:
+        return dict(
+            item,
+            source=processor.SOURCE_MEDIA_CLOUD,
+            source_publish_date=str(item["publish_date"]),
+            project_id=project["id"],
+            story_text=item.get("text"),
+            url=item["url"].rstrip("/"),
+        )
 
-def process_projects_in_parallel(projects_list: List[Dict], pool_size: int):
-    args_list = [(p, STORIES_PER_PAGE, MAX_STORIES_PER_PROJECT) for p in projects_list]
-    with multiprocessing.Pool(pool_size) as pool:
-        results = pool.map(_process_project_task, args_list)
-    return results
+    def item_date(self, item: Dict) -> dt.datetime:
+        return _naive_utc(item["indexed_date"])
 
+    def history_cursor(self, history: ProjectHistory) -> Optional[dt.datetime]:
+        return history.latest_date_mc
 
-if __name__ == "__main__":
-    logger.info("Starting {} story fetch job".format(processor.SOURCE_MEDIA_CLOUD))
+    def complete_stories(self, group: List[Dict], stories: List[Dict]) -> List[Dict]:
+        # with a two-phase fetch, only pull down the text for the stories we haven't seen before
+        without_text = [s for s in stories if s["story_text"] is None]
+        if not without_text:
+            return stories
+        for s in _fetch_new_story_texts(get_mc_client(), group, without_text):
+            s["story_text"] = s["text"]
+        return [s for s in stories if s["story_text"] is not None]
 
-    # important to do because there might be new models on the server!
-    logger.info("  Checking for any new models we need")
-    models_downloaded = download_models()
-    logger.info(f"    models downloaded: {models_downloaded}")
-    if not models_downloaded:
-        sys.exit(1)
+
+def _queue_stories(project: Dict, project_stories: List[Dict]) -> int:
+    # we have the text already, so log them and queue them up for classification right away
+    Session = database.get_session_maker()
+    with Session() as session:
+        stories_to_queue = stories_db.add_stories(
+            session, project_stories, project, processor.SOURCE_MEDIA_CLOUD
+        )
+    if len(stories_to_queue) > 0:  # don't queue up unnecessary tasks
+        classification_tasks.classify_and_post_worker.delay(project, stories_to_queue)
+    return len(stories_to_queue)
+
+
+def process_projects(
+    projects_list: List[Dict], deadline: Optional[float] = None
+) -> List[Dict]:
+    return driver.list_stories(
+        MediaCloudSource(), projects_list, _queue_stories, deadline=deadline
+    )
+
+
+def run(
+    force_reload: bool = True, deadline_secs: float = run_planner.RUN_DEADLINE_SECS
+) -> None:
+    """
+    One fetch run, from listing the projects to sending the summary.
+    :param force_reload: get the latest project list from the main server first (the scheduler daemon keeps its own
+                         copy up to date, see scripts.fetch_scheduler)
+    :param deadline_secs: how long the run can take, 0 for no deadline (stories are queued as they're listed, so
+                          listing gets all of it)
+    """
+    logger.info("Starting {} story fetch job".format(processor.SOURCE_MEDIA_CLOUD))
     start_time = time.time()
     # logger.info("    will request {} stories/page (up to {})".format(stories_per_page, max_stories_per_project))
 
     # 1. list all the project we need to work on
-    projects_list = load_projects_task()
+    projects_list = load_projects_task(force_reload)
 
     # 2. process all the projects (in parallel)
     logger.info(f"Processing project in parallel {POOL_SIZE}")
-    project_results = process_projects_in_parallel(projects_list, POOL_SIZE)
+    project_results = process_projects(
+        projects_list, run_planner.run_deadline(start_time, deadline_secs)
+    )
 
     # 3. send email/slack_msg with results of operations
     logger.info(f"Total stories queued: {sum([p['stories'] for p in project_results])}")
@@ -229,3 +437,13 @@ if __name__ == "__main__":
         processor.SOURCE_MEDIA_CLOUD,
         start_time,
     )
+
+
+if __name__ == "__main__":
+    # important to do because there might be new models on the server!
+    logger.info("  Checking for any new models we need")
+    models_downloaded = download_models()
+    logger.info(f"    models downloaded: {models_downloaded}")
+    if not models_downloaded:
+        sys.exit(1)
+    run()
@@ -1,12 +1,13 @@
 # ruff: noqa: E402
 
+import collections
 import datetime as dt
-import itertools
 import logging
 import math
+import os
 import sys
 import time
-from typing import Dict, List
+from typing import Callable, Dict, Iterator, List, Optional, Tuple
 
 import dateparser
 
@@ -19,13 +20,20 @@ import mcmetadata as metadata
 import mcmetadata.urls as urls
 
 import processor.database as database
-import processor.database.projects_db as projects_db
-import processor.database.stories_db as stories_db
+import processor.database.domains_db as domains_db
 import processor.fetcher as fetcher
 import processor.projects as projects
+import processor.run_ledger as run_ledger
+import processor.run_planner as run_planner
+import processor.sources as sources
+import processor.sources.driver as driver
 import scripts.newscatcher_api as newscatcher_api
 import scripts.tasks as tasks
 from processor.classifiers import download_models
+from processor.database.models import ProjectHistory
+from processor.ratelimit import TokenBucket
+from processor.run_ledger import RunLedger
+from processor.story_buffer import StoryBuffer
 
 POOL_SIZE = 16  # parallel fetch for story URL lists (by project)
 PAGE_SIZE = 200
@@ -36,18 +44,30 @@ MAX_STORIES_PER_PROJECT = (
     500  # can't process all the stories for queries that are too big (keep this low)
 )
 MAX_CALLS_PER_SEC = 1  # throttle calls to newscatcher to avoid rate limiting
-DELAY_SECS = 1 / MAX_CALLS_PER_SEC
-
-# create requests session
-requests_session = newscatcher_api.create_session()
+INCREMENTAL_FETCH = (
+    os.environ.get("NC_INCREMENTAL_FETCH", "false").lower() == "true"
+)  # sort by date and only list stories published since the last run
+CURSOR_OVERLAP = dt.timedelta(
+    hours=2
+)  # look back this far past the cursor, in case stories are published out of order
+QUERY_FIELDS = [
+    "search_terms",
+    "language",
+    "newscatcher_country",
+]  # projects with the same values for these share a query
+
+# all the project workers share this, so together they stay under the limit
+rate_limiter = TokenBucket(MAX_CALLS_PER_SEC)
+# create requests session (rate limiting is handled by `rate_limiter` instead)
+requests_session = newscatcher_api.create_session(rate_limit=None, pool_size=POOL_SIZE)
 
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.DEBUG)
 
 
-def load_projects() -> List[Dict]:
+def load_projects(force_reload: bool = True) -> List[Dict]:
     project_list = projects.load_project_list(
-        force_reload=True, overwrite_last_story=False
+        force_reload=force_reload, overwrite_last_story=False
     )
     projects_with_countries = projects.with_countries(project_list)
     if len(projects_with_countries) == 0:
@@ -67,7 +87,11 @@ def load_projects() -> List[Dict]:
 
 
 def _fetch_results(
-    project: Dict, start_date: dt.datetime, end_date: dt.datetime, page: int = 1
+    project: Dict,
+    start_date: dt.datetime,
+    end_date: dt.datetime,
+    page: int = 1,
+    incremental: bool = False,
 ) -> Dict:
     terms_no_curlies = project["search_terms"].replace("“", '"').replace("”", '"')
 
@@ -81,6 +105,9 @@ def _fetch_results(
         page_size=PAGE_SIZE,
         page=page,
         session=requests_session,
+        # newest first, from the exact time of the cursor
+        sort_by="date" if incremental else None,
+        date_format="%Y-%m-%d %H:%M:%S" if incremental else "%Y-%m-%d",
     )
     if results is not None:
         return results
@@ -90,182 +117,211 @@ def _fetch_results(
         )  # a mockup of no results if fails, so we can handle transient errors better
 
 
-def _project_story_worker(p: Dict) -> List[Dict]:
-    project_stories = []
-    try:
-        db_session_maker = database.get_session_maker()
-        # here start_date ignores last query history, since sort is by relevancy; we're relying on robust URL de-duping
-        # to make sure we don't double up on stories (and keeping MAX_STORIES_PER_PROJECT low)
-        start_date, end_date = projects.query_start_end_dates(
-            p,
-            db_session_maker,
-            DEFAULT_DAY_OFFSET,
-            DEFAULT_DAY_WINDOW,
-            processor.SOURCE_NEWSCATCHER,
-        )
+class NewscatcherSource(sources.Source):
+    name = processor.SOURCE_NEWSCATCHER
+    query_fields = QUERY_FIELDS
+    # by default start_date ignores last query history, since sort is by relevancy; we're relying on robust URL
+    # de-duping to make sure we don't double up on stories (and keeping MAX_STORIES_PER_PROJECT low)
+    day_offset = DEFAULT_DAY_OFFSET
+    day_window = DEFAULT_DAY_WINDOW
+    max_stories_per_project = MAX_STORIES_PER_PROJECT
+    pool_size = POOL_SIZE
+    page_size = PAGE_SIZE
+    rate_limiter = rate_limiter
+    incremental = INCREMENTAL_FETCH
+    cursor_overlap = CURSOR_OVERLAP
+
+    def list_pages(
+        self,
+        project: Dict,
+        part: sources.QueryPart,
+        cursor: Optional[dt.datetime],
+        before_request: Callable[[], bool],
+    ) -> Iterator[List[Dict]]:
         page_number = 1
-        # fetch first page to get total hits, and use results
-        current_page = _fetch_results(p, start_date, end_date, page_number)
-        total_hits = current_page["total_hits"]
-        logger.info(
-            "Project {}/{} - {} total stories (since {})".format(
-                p["id"], p["title"], total_hits, start_date
+        while before_request():
+            current_page = _fetch_results(
+                project,
+                part.start_date,
+                part.end_date,
+                page_number,
+                cursor is not None,
             )
-        )
-        skipped_dupes = 0  # how many URLs do we filter out because they're already in the DB for this project recently
-        if total_hits > 0:
-            # list recent urls to filter so we don't fetch text extra if we've recently proceses already
-            # (and will be filtered out by add_stories call in later post-text-fetch step)
-            with db_session_maker() as db_session:
-                already_processed_normalized_urls = (
-                    stories_db.project_story_normalized_urls(db_session, p, 14)
-                )
-            # query page by page
-            latest_pub_date = dt.datetime.now() - dt.timedelta(weeks=50)
-            page_count = math.ceil(total_hits / PAGE_SIZE)
-            keep_going = True
-            while keep_going:
-                logger.debug(
-                    "  {} - page {}: {} stories".format(
-                        p["id"], page_number, len(current_page["articles"])
+            total_hits = current_page["total_hits"]
+            if page_number == 1:
+                logger.info(
+                    "Project {}/{} - {} total stories (since {})".format(
+                        project["id"], project["title"], total_hits, part.start_date
                     )
                 )
-                # track the latest date so we can use it tomorrow
-                page_latest_pub_date = [
-                    dateparser.parse(s["published_date"])
-                    for s in current_page["articles"]
-                ]
-                latest_pub_date = max(latest_pub_date, max(page_latest_pub_date))
-                # prep all the articles
-                for item in current_page["articles"]:
-                    if len(project_stories) > MAX_STORIES_PER_PROJECT:
-                        break
-                    real_url = item["link"]
-                    # skip URLs we've processed recently
-                    if (
-                        urls.normalize_url(real_url)
-                        in already_processed_normalized_urls
-                    ):
-                        skipped_dupes += 1
-                        continue
-                    # removing this check for now, because I'm not sure if stories are ordered consistently
-                    info = dict(
-                        url=real_url,
-                        source_publish_date=item["published_date"],
-                        title=item["title"],
-                        source=processor.SOURCE_NEWSCATCHER,
-                        project_id=p["id"],
-                        language=p["language"],
-                        authors=item["authors"],
-                        media_url=urls.canonical_domain(real_url),
-                        media_name=urls.canonical_domain(real_url),
-                        # too bad there isn't somewhere we can store the `id` (string)
-                    )
-                    project_stories.append(info)
-                if keep_going:  # check after page is processed
-                    keep_going = (page_number < page_count) and (
-                        len(project_stories) <= MAX_STORIES_PER_PROJECT
-                    )
-                    if keep_going:
-                        page_number += 1
-                        time.sleep(DELAY_SECS)
-                        current_page = _fetch_results(
-                            p, start_date, end_date, page_number
-                        )
-                        # stay below rate limiting
-            logger.info(
-                "  project {} - {} valid stories (skipped {}) (after {})".format(
-                    p["id"], len(project_stories), skipped_dupes, start_date
-                )
-            )
-            with db_session_maker() as db_session:
-                # note - right now this latest pub date isn't used, because the sort is by relevancy within the
-                # default time window
-                projects_db.update_history(
-                    db_session, p["id"], latest_pub_date, processor.SOURCE_NEWSCATCHER
-                )
-    except Exception as e:
-        # log error and continue on your way
-        logger.exception(f"Failed to process stories for project {p['id']}: {e}")
-    return project_stories[:MAX_STORIES_PER_PROJECT]
+            if total_hits == 0:
+                return
+            yield sources.Page(current_page["articles"], total_hits)
+            if page_number >= math.ceil(total_hits / PAGE_SIZE):
+                return
+            page_number += 1
+
+    def normalize(self, item: Dict, project: Dict) -> Dict:
+        real_url = item["link"]
+        return dict(
+            url=real_url,
+            source_publish_date=item["published_date"],
+            title=item["title"],
+            source=processor.SOURCE_NEWSCATCHER,
+            project_id=project["id"],
+            language=project["language"],
+            authors=item["authors"],
+            media_url=urls.canonical_domain(real_url),
+            media_name=urls.canonical_domain(real_url),
+            # too bad there isn't somewhere we can store the `id` (string)
+        )
+
+    def item_date(self, item: Dict) -> dt.datetime:
+        return dateparser.parse(item["published_date"])
+
+    def history_cursor(self, history: ProjectHistory) -> Optional[dt.datetime]:
+        return history.latest_date_nc
+
+    def fetch_text(
+        self,
+        stories: List[Dict],
+        on_story: Callable[[Dict], None],
+        ledger: Optional[RunLedger] = None,
+        deadline: Optional[float] = None,
+    ) -> int:
+        return fetch_text(stories, on_story, ledger, deadline)
+
 
+source = NewscatcherSource()
 
-def fetch_project_stories(project_list: List[Dict]) -> List[Dict]:
+
+def fetch_project_stories(
+    project_list: List[Dict],
+    ledger: Optional[RunLedger] = None,
+    deadline: Optional[float] = None,
+) -> Tuple[List[Dict], str]:
     """
-    Fetch stories in parallel by project. Efficient because it is mostly IO-bound. Would be smarter to use async calls
-    here but I don't think the underlying API call is async compatible yet.
+    Fetch the story URLs for every project (see `processor.sources.driver.collect_stories`).
     :param project_list:
-    :return:
+    :param ledger: optional run ledger; projects already listed earlier in this run aren't queried again
+    :param deadline: optional epoch secs to be done listing by
+    :return: the stories, and a note for the email about any projects cut short by the deadline
     """
-    lists_of_stories = []
-
-    for project in project_list:
-        # Call the story worker with the same session to avoid creating new connections
-        stories = _project_story_worker(project)
-        lists_of_stories.append(stories)
+    return driver.collect_stories(source, project_list, ledger, deadline)
 
-    # Flatten list of lists of stories into one big list
-    combined_stories = [s for s in itertools.chain.from_iterable(lists_of_stories)]
 
-    logger.info(
-        "Fetched {} total URLs from {}".format(
-            len(combined_stories), processor.SOURCE_NEWSCATCHER
-        )
+def _extract_story(response_data: Dict) -> Dict:
+    # Runs wherever the crawl runs (maybe a child process, so it has to be module-level), which spreads the CPU-heavy
+    # extraction across cores. Only send back what we need instead of the whole HTML.
+    story_metadata = metadata.extract(
+        response_data["original_url"], response_data["content"]
+    )
+    return dict(
+        original_url=response_data["original_url"],
+        text_content=story_metadata["text_content"],
+        publication_date=story_metadata["publication_date"],
     )
-
-    return combined_stories
 
 
-def fetch_text(stories: List[Dict]) -> List[Dict]:
-    stories_to_return = []
+def fetch_text(
+    stories: List[Dict],
+    on_story: Callable[[Dict], None],
+    ledger: Optional[RunLedger] = None,
+    deadline: Optional[float] = None,
+) -> int:
+    """
+    Fetch and extract the text for all the stories, handing each one to `on_story` as soon as it is ready.
+    :param ledger: optional run ledger to record which stories were fetched and which failed (including any the
+                   deadline stopped us getting to)
+    :param deadline: optional epoch secs to stop fetching by
+    :return: the number of stories we got text for
+    """
+    text_count = 0
+    # note that the url might be from multiple stories (from different projects), so we need to process all of them
+    stories_by_url = collections.defaultdict(list)
+    for s in stories:
+        stories_by_url[s["url"]].append(s)
 
     def handle_parse(response_data: Dict):
         # called for each story that successfully is fetched by Scrapy
-        nonlocal stories, stories_to_return
-        # note that the url might be from multiple stories, so we need to process it for all of them
-        matching_input_stories = [
-            s for s in stories if s["url"] == response_data["original_url"]
-        ]
-        for (
-            s
-        ) in (
-            matching_input_stories
-        ):  # find all matches, which could be with different URLs from different projects
-            story_metadata = metadata.extract(s["url"], response_data["content"])
-            s["story_text"] = story_metadata["text_content"]
-            s["publish_date"] = story_metadata[
+        nonlocal text_count
+        for s in stories_by_url[response_data["original_url"]]:
+            s["story_text"] = response_data["text_content"]
+            s["publish_date"] = response_data[
                 "publication_date"
             ]  # this is a date object
             # logger.debug(f"Handled URL: {s['url']}")
-            stories_to_return.append(s)
+            text_count += 1
+            if ledger:
+                ledger.mark([s], run_ledger.FETCHED)
+            on_story(s)
+
+    # skip domains that have been reliably failing on us, based on what we saw on previous runs
+    Session = database.get_session_maker()
+    with Session() as session:
+        domain_health = domains_db.load_domain_health(session)
 
     # download them all in parallel... will take a while (make it only unique URLs first)
-    fetcher.fetch_all_html(list(set([s["url"] for s in stories])), handle_parse)
+    fetch_summary = fetcher.fetch_all_html(
+        list(stories_by_url.keys()),
+        handle_parse,
+        domain_health=domain_health,
+        preprocess=_extract_story,
+        deadline=deadline,
+    )
+    # this might happen a long time after we last used the DB, so reset the pool first
+    Session = database.get_session_maker(reset_pool=True)
+    with Session() as session:
+        domains_db.save_domain_health(session, domain_health)
+    fetch_summary["crawl_stats"].save(processor.SOURCE_NEWSCATCHER)
+    if ledger:
+        ledger.mark(
+            [s for s in stories if ledger.status(s) == run_ledger.LISTED],
+            run_ledger.FAILED,
+        )
     logger.info(
-        "Fetched text for {} stories (failed on {})".format(
-            len(stories_to_return), len(stories) - len(stories_to_return)
+        "Fetched text for {} stories (failed on {}, skipped {} URLs from unhealthy domains)".format(
+            text_count,
+            len(stories) - text_count,
+            sum(fetch_summary["skipped_domains"].values()),
         )
     )
-    return stories_to_return
+    return text_count
 
 
-if __name__ == "__main__":
+def run(
+    force_reload: bool = True, deadline_secs: float = run_planner.RUN_DEADLINE_SECS
+) -> None:
+    """
+    One fetch run, from listing the projects to sending the summary.
+    :param force_reload: get the latest project list from the main server first (the scheduler daemon keeps its own
+                         copy up to date, see scripts.fetch_scheduler)
+    :param deadline_secs: how long the run can take, 0 for no deadline (listing gets `run_planner.LIST_TIME_SHARE` of
+                          it, the rest is left for fetching the text)
+    """
     logger.info("Starting {} story fetch job".format(processor.SOURCE_NEWSCATCHER))
-
-    # important to do because there might be new models on the server!
-    logger.info("  Checking for any new models we need")
-    models_downloaded = download_models()
-    logger.info(f"    models downloaded: {models_downloaded}")
-    if not models_downloaded:
-        sys.exit(1)
-
     start_time = time.time()
+    fetch_deadline = run_planner.run_deadline(start_time, deadline_secs)
 
     # 1. list all the project we need to work on
-    projects_list = load_projects()
-
-    # 2. fetch all the urls from for each project from newscatcher (in parallel)
-    all_stories = fetch_project_stories(projects_list)
+    projects_list = load_projects(force_reload)
+
+    # 2. fetch all the urls from for each project from newscatcher (in parallel), picking up where an interrupted run
+    # with the same run id left off
+    ledger = (
+        RunLedger(processor.SOURCE_NEWSCATCHER)
+        if run_ledger.RUN_LEDGER_ENABLED
+        else None
+    )
+    all_stories, cut_text = fetch_project_stories(
+        projects_list,
+        ledger,
+        run_planner.run_deadline(
+            start_time, deadline_secs, run_planner.LIST_TIME_SHARE
+        ),
+    )
+    if ledger:
+        all_stories = ledger.remaining(all_stories)
     unique_url_count = len(set([s["url"] for s in all_stories]))
     logger.info(
         "Found {} total stories, {} unique URLs".format(
@@ -274,20 +330,48 @@ if __name__ == "__main__":
     )
 
     # 3. fetch webpage text and parse all the stories (use scrapy to do this in parallel, dropping stories that fail)
-    stories_with_text = fetch_text(all_stories)
+    # 4. post batches of stories for classification
+    if tasks.STREAM_QUEUEING:
+        # queue them up as their text arrives, so classification overlaps with fetching
+        queuer = tasks.StreamingStoryQueuer(
+            projects_list, processor.SOURCE_NEWSCATCHER, ledger=ledger
+        )
+        text_count = source.fetch_text(
+            all_stories, queuer.add, ledger=ledger, deadline=fetch_deadline
+        )
+        results_data = queuer.finish()
+    else:
+        # keep the texts on disk until it is time to queue them, so memory doesn't grow with the size of the run
+        with StoryBuffer() as story_buffer:
+            text_count = source.fetch_text(
+                all_stories, story_buffer.add, ledger=ledger, deadline=fetch_deadline
+            )
+            results_data = tasks.queue_stories_for_classification(
+                projects_list, story_buffer, processor.SOURCE_NEWSCATCHER, ledger=ledger
+            )
+    if ledger:
+        ledger.finish()
+    results_data["email_text"] += cut_text + driver.fetch_cut_text(
+        len(all_stories), text_count, fetch_deadline
+    )
     logger.info(
         "Fetched {} stories with text, from {} attempted URLs".format(
-            len(stories_with_text), unique_url_count
+            text_count, unique_url_count
         )
     )
 
-    # 4. post batches of stories for classification
-    results_data = tasks.queue_stories_for_classification(
-        projects_list, stories_with_text, processor.SOURCE_NEWSCATCHER
-    )
-
     # 5. send email/slack_msg with results of operations
     tasks.send_combined_slack_message(
         results_data, processor.SOURCE_NEWSCATCHER, start_time
     )
     tasks.send_combined_email(results_data, processor.SOURCE_NEWSCATCHER, start_time)
+
+
+if __name__ == "__main__":
+    # important to do because there might be new models on the server!
+    logger.info("  Checking for any new models we need")
+    models_downloaded = download_models()
+    logger.info(f"    models downloaded: {models_downloaded}")
+    if not models_downloaded:
+        sys.exit(1)
+    run()
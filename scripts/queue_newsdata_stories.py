@@ -2,9 +2,11 @@
 
 import datetime as dt
 import logging
+import math
+import os
 import sys
 import time
-from typing import Dict, List
+from typing import Callable, Dict, Iterator, List, Optional
 
 import dateparser
 
@@ -13,13 +15,18 @@ import processor
 
 processor.disable_package_loggers()
 
-import mcmetadata.urls as urls
 from newsdataapi import NewsDataApiClient
 
+import processor.credit_budget as credit_budget
 import processor.database as database
-import processor.database.projects_db as projects_db
+import processor.database.credits_db as credits_db
 import processor.database.stories_db as stories_db
 import processor.projects as projects
+import processor.ratelimit as ratelimit
+import processor.run_planner as run_planner
+import processor.sources as sources
+import processor.sources.driver as driver
+import processor.story_caps as story_caps
 import processor.tasks.classification as classification_tasks
 import scripts.tasks as tasks
 from processor import NEWSDATA_API_KEY
@@ -34,14 +41,22 @@ DAY_WINDOW = (
 
 # we have 20,000 credits per month, at 50 articles per credit that's about 30,000 articles/day we can fetch
 # Oct'25 we have about 100 projects, that that's only 300 per project if they are all fully live and populated
-# but they're not so let's try 500 for now
+# but they're not, so the budget scheduler (see processor.credit_budget) spreads each run's share of the monthly
+# credits across projects by how many of their recent stories were above threshold
 PAGE_SIZE = 50  # per API spec that is max
 MAX_STORIES_PER_PROJECT = 500  # anyway we can't process all the stories for queries that are too big because we have to fetch full text
+BUDGET_SCHEDULING = os.environ.get("ND_BUDGET_SCHEDULING", "true").lower() == "true"
+QUERY_FIELDS = [
+    "search_terms",
+    "language",
+    "newscatcher_country",
+]  # projects with the same values for these share a query
 
 # Rate limit is  1800 credits every 15 minute, which is 90,000 articles / 15 minutes. That's more than we can
-# fetch each day given our account level, so we can set a low rate limit here
-MAX_CALLS_PER_SEC = 0.33333  # throttle calls to NewsData to avoid rate limiting
-DELAY_SECS = 1 / MAX_CALLS_PER_SEC  # may need to be further adjusted
+# fetch each day given our account level, so the host-wide limiter (ND_CALLS_PER_SEC) stays well under it while
+# projects are fetched in parallel
+rate_limiter = ratelimit.shared_rate_limiter(processor.SOURCE_NEWSDATA)
+POOL_SIZE = int(os.environ.get("ND_POOL_SIZE", 4))
 
 # initialize api client, maybe do this in processor initialization?
 newsdata_api = NewsDataApiClient(apikey=NEWSDATA_API_KEY)
@@ -50,192 +65,177 @@ logger = logging.getLogger(__name__)
 logger.setLevel(logging.INFO)
 
 
-def load_projects_task() -> List[Dict]:
+def load_projects_task(force_reload: bool = True) -> List[Dict]:
     project_list = projects.load_project_list(
-        force_reload=True, overwrite_last_story=False
+        force_reload=force_reload, overwrite_last_story=False
     )
     logger.info("  Checking {} projects".format(len(project_list)))
     # return [p for p in project_list if p['id'] == 166]
     return project_list
 
 
-def _project_story_worker(args: Dict) -> Dict:
-    p = args
+def plan_credits(project_list: List[Dict]) -> Dict[int, int]:
+    """
+    Decide how many credits (ie. pages) each project gets this run. Without budget scheduling every project gets
+    enough for its story cap (see processor.story_caps).
+    """
+    if not BUDGET_SCHEDULING:
+        caps = story_caps.story_caps(
+            processor.SOURCE_NEWSDATA, MAX_STORIES_PER_PROJECT, project_list
+        )
+        return {pid: math.ceil(cap / PAGE_SIZE) for pid, cap in caps.items()}
+    today = dt.date.today()
     Session = database.get_session_maker()
-    # build a time frame to search in
-    start_date, end_date = projects.query_start_end_dates(
-        p,
-        Session,
-        DAY_OFFSET,
-        DAY_WINDOW,
-        processor.SOURCE_NEWSDATA,
+    with Session() as session:
+        spent_this_month = credits_db.credits_spent(
+            session, processor.SOURCE_NEWSDATA, today.replace(day=1)
+        )
+        spent_today = credits_db.credits_spent(
+            session, processor.SOURCE_NEWSDATA, today
+        )
+        counts = credits_db.project_yields(
+            session, processor.SOURCE_NEWSDATA, credit_budget.YIELD_DAYS
+        )
+    budget = credit_budget.run_budget(
+        credit_budget.ND_MONTHLY_CREDITS, spent_this_month, spent_today, today
     )
-    # Newsdata.io takes strings as parameters and not datetime objects
-    from_date = start_date.strftime("%Y-%m-%d")
-    to_date = end_date.strftime("%Y-%m-%d")
-
-    project_email_message = ""
-    logger.info("Checking project {}/{}".format(p["id"], p["title"]))
-    logger.debug(
-        "  {} stories/page up to {}".format(PAGE_SIZE, MAX_STORIES_PER_PROJECT)
+    yields = {
+        p["id"]: credit_budget.project_yield(*counts.get(p["id"], (0, 0)))
+        for p in project_list
+    }
+    allocation = credit_budget.allocate(budget, yields)
+    logger.info(
+        "  Credit budget for this run: {} ({} spent this month, {} today); allocated {} to {} projects".format(
+            budget,
+            spent_this_month,
+            spent_today,
+            sum(allocation.values()),
+            len([c for c in allocation.values() if c > 0]),
+        )
     )
-    project_email_message += "Project {} - {}:\n".format(p["id"], p["title"])
-
-    terms_no_curlies = p["search_terms"].replace("“", '"').replace("”", '"')
-
-    # see how many stories and fetch them page by page
-    story_count = 0
-    page_count = 0
-    more_stories = True
-    page_token = None
-    latest_pub_date = dt.datetime.now() - dt.timedelta(weeks=50)  # a while ago
-    while more_stories and (story_count < MAX_STORIES_PER_PROJECT):
-        try:
-            # fetch stories and return results
+    return allocation
+
+
+class NewsDataSource(sources.Source):
+    name = processor.SOURCE_NEWSDATA
+    query_fields = QUERY_FIELDS
+    day_offset = DAY_OFFSET
+    day_window = DAY_WINDOW
+    max_stories_per_project = MAX_STORIES_PER_PROJECT
+    pool_size = POOL_SIZE
+    page_size = PAGE_SIZE
+    rate_limiter = rate_limiter
+    has_text = True  # we ask for the full content with each story
+
+    def list_pages(
+        self,
+        project: Dict,
+        part: sources.QueryPart,
+        cursor: Optional[dt.datetime],
+        before_request: Callable[[], bool],
+    ) -> Iterator[List[Dict]]:
+        terms_no_curlies = project["search_terms"].replace("“", '"').replace("”", '"')
+        page_token = None
+        # every call costs a credit, so `before_request` stops us once we've used up the project's share
+        while before_request():
             response = newsdata_api.archive_api(
                 q=terms_no_curlies,  # query limit may have changed (listed as <=512 characters in updated documentation)
-                language=p["language"].lower(),
-                from_date=from_date,
-                to_date=to_date,
+                language=project["language"].lower(),
+                # Newsdata.io takes strings as parameters and not datetime objects
+                from_date=part.start_date.strftime("%Y-%m-%d"),
+                to_date=part.end_date.strftime("%Y-%m-%d"),
                 full_content=True,  # make sure to collect full text
-                country=p["newscatcher_country"],
+                country=project["newscatcher_country"],
                 size=PAGE_SIZE,
                 page=page_token,
                 # docs say sort is by "publish date (newest first)" if no sort specified (that's what we want)
             )
-            page_of_stories = response["results"]
-            total_stories = response["totalResults"]
-            page_token = response["nextPage"]
-            logger.info("  Project {}: {} total stories".format(p["id"], total_stories))
-            if page_of_stories:
-                logger.info(
-                    "    {} - page {}: ({}) stories".format(
-                        p["id"], page_count, len(page_of_stories)
-                    )
-                )
-                skipped_dupes = 0  # how many URLs do we filter out because they're already in the DB for this project recently
-                already_processed_normalized_urls = set()
-                if total_stories > 0:
-                    # list recent urls to filter so we don't fetch text extra if we've recently proceses already
-                    # (and will be filtered out by add_stories call in later paost-text-fetch step)
-                    with Session() as db_session:
-                        already_processed_normalized_urls = (
-                            stories_db.project_story_normalized_urls(db_session, p, 14)
-                        )
-                page_latest_pub_date = [
-                    dateparser.parse(s["pubDate"]) for s in page_of_stories
-                ]
-                latest_pub_date = max(latest_pub_date, max(page_latest_pub_date))
-                cleaned_page_of_stories = (
-                    []
-                )  # make sure we respect max stories per project by using this from now on
-                for s in page_of_stories:
-                    if story_count >= MAX_STORIES_PER_PROJECT:
-                        break
-                    real_url = s["link"]
-                    # skip URLs we've processed recently
-                    if (
-                        urls.normalize_url(real_url)
-                        in already_processed_normalized_urls
-                    ):
-                        skipped_dupes += 1
-                        continue
-                    s["source"] = processor.SOURCE_NEWSDATA
-                    s["publish_date"] = str(s["pubDate"])
-                    s["project_id"] = p["id"]
-                    s["authors"] = ", ".join(s["creator"]) if s.get("creator") else None
-                    s["story_text"] = s["content"]
-                    s["url"] = real_url
-                    s["media_name"] = s["source_name"]
-                    s["media_id"] = s["source_id"]
-                    s["media_url"] = s["source_url"]
-                    cleaned_page_of_stories.append(s)
-                page_count += 1
-                # and log that we got and queued them all
-                with Session() as session:
-                    stories_to_queue = stories_db.add_stories(
-                        session, cleaned_page_of_stories, p, processor.SOURCE_NEWSDATA
-                    )
-                    story_count += len(stories_to_queue)
-                    classification_tasks.classify_and_post_worker.delay(
-                        p, stories_to_queue
-                    )
-                    # important to write this update now, because we have queued up the task to process these stories
-                    # the task queue will manage retrying with the stories if it fails with this batch
-                    projects_db.update_history(
-                        session,
-                        p["id"],
-                        latest_pub_date,  # this will be interpreted next time as GMT, so make sure it is(!)
-                        processor.SOURCE_NEWSDATA,
-                    )
-                    more_stories = page_token is not None
-                time.sleep(DELAY_SECS)
-            else:
-                more_stories = False
-        except Exception as e:
-            logger.exception(
-                "  Couldn't count/retrieve stories in project {}. Skipping project for now. {}".format(
-                    p["id"], e
+            logger.info(
+                "  Project {}: {} total stories".format(
+                    project["id"], response["totalResults"]
                 )
             )
-            project_email_message += (
-                "    failed to count and/or retrieve stories with {}\n\n".format(e)
-            )
-            return dict(
-                email_text=project_email_message,
-                stories=story_count,
-                pages=page_count,
-            )
+            yield sources.Page(response["results"], response["totalResults"])
+            page_token = response["nextPage"]
+            if (page_token is None) or (len(response["results"]) == 0):
+                return
 
-    logger.info(
-        "  queued {} stories for project {}/{} (in {} pages)".format(
-            story_count, p["id"], p["title"], page_count
+    def normalize(self, item: Dict, project: Dict) -> Dict:
+        return dict(
+            item,
+            source=processor.SOURCE_NEWSDATA,
+            publish_date=str(item["pubDate"]),
+            project_id=project["id"],
+            authors=", ".join(item["creator"]) if item.get("creator") else None,
+            story_text=item["content"],
+            url=item["link"],
+            media_name=item["source_name"],
+            media_id=item["source_id"],
+            media_url=item["source_url"],
         )
-    )
-    #  add a summary to the email we are generating
-    warnings = ""
-    if story_count > (
-        MAX_STORIES_PER_PROJECT * 0.8
-    ):  # try to get our attention in the email
-        warnings += "(⚠️️️ query might be too broad)"
-    project_email_message += "    found {} new stories (over {} pages) {}\n\n".format(
-        story_count, page_count, warnings
-    )
-    return dict(
-        email_text=project_email_message,
-        stories=story_count,
-        pages=page_count,
-    )
 
+    def item_date(self, item: Dict) -> dt.datetime:
+        return dateparser.parse(item["pubDate"])
 
-def process_projects(project_list: List[Dict]) -> List[Dict]:
-    results = []
-    for p in project_list:
-        results.append(_project_story_worker(p))
-    return results
+    def page_budgets(self, project_list: List[Dict]) -> Dict[int, Optional[int]]:
+        return plan_credits(project_list)
 
+    def max_stories(self, page_budget: Optional[int]) -> int:
+        return page_budget * PAGE_SIZE
 
-if __name__ == "__main__":
-    logger.info("Starting {} story fetch job".format(processor.SOURCE_NEWSDATA))
+    def record_usage(self, group: List[Dict], pages: int, stories: int) -> None:
+        # the credits are spent on the query, so they're counted against the project it was run for
+        Session = database.get_session_maker()
+        with Session() as session:
+            credits_db.add_credits(
+                session, processor.SOURCE_NEWSDATA, group[0]["id"], pages, stories
+            )
+
+
+def _queue_stories(project: Dict, project_stories: List[Dict]) -> int:
+    # we have the text already, so log them and queue them up for classification right away
+    Session = database.get_session_maker()
+    with Session() as session:
+        stories_to_queue = stories_db.add_stories(
+            session, project_stories, project, processor.SOURCE_NEWSDATA
+        )
+    if len(stories_to_queue) > 0:  # don't queue up unnecessary tasks
+        classification_tasks.classify_and_post_worker.delay(project, stories_to_queue)
+    return len(stories_to_queue)
+
+
+def process_projects(
+    project_list: List[Dict], deadline: Optional[float] = None
+) -> List[Dict]:
+    return driver.list_stories(
+        NewsDataSource(), project_list, _queue_stories, deadline=deadline
+    )
 
-    # important to do because there might be new models on the server!
-    logger.info("  Checking for any new models we need")
-    models_downloaded = download_models()
-    logger.info(f"    models downloaded: {models_downloaded}")
-    if not models_downloaded:
-        sys.exit(1)
 
+def run(
+    force_reload: bool = True, deadline_secs: float = run_planner.RUN_DEADLINE_SECS
+) -> None:
+    """
+    One fetch run, from listing the projects to sending the summary.
+    :param force_reload: get the latest project list from the main server first (the scheduler daemon keeps its own
+                         copy up to date, see scripts.fetch_scheduler)
+    :param deadline_secs: how long the run can take, 0 for no deadline (stories are queued as they're listed, so
+                          listing gets all of it)
+    """
+    logger.info("Starting {} story fetch job".format(processor.SOURCE_NEWSDATA))
     start_time = time.time()
 
     # 1. list all the project we need to work on
-    all_projects_list = load_projects_task()
+    all_projects_list = load_projects_task(force_reload)
     projects_list = [
         p for p in all_projects_list if len(p["search_terms"]) < MAX_QUERY_LENGTH
     ]
 
     # 2. process all the projects and queue results by project
     logger.info("Processing project")
-    project_results = process_projects(projects_list)
+    project_results = process_projects(
+        projects_list, run_planner.run_deadline(start_time, deadline_secs)
+    )
     logger.info(f"Total stories queued: {sum([p['stories'] for p in project_results])}")
 
     # 3. send email/slack_msg with results of operations
@@ -245,3 +245,13 @@ if __name__ == "__main__":
     tasks.send_project_list_email(
         project_results, processor.SOURCE_NEWSDATA, start_time
     )
+
+
+if __name__ == "__main__":
+    # important to do because there might be new models on the server!
+    logger.info("  Checking for any new models we need")
+    models_downloaded = download_models()
+    logger.info(f"    models downloaded: {models_downloaded}")
+    if not models_downloaded:
+        sys.exit(1)
+    run()
@@ -1,30 +1,36 @@
 # ruff: noqa: E402
 
+import collections
 import datetime as dt
-import itertools
-import json
 import logging
+import os
 import sys
 import time
-from multiprocessing import Pool
-from typing import Dict, List
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict, Iterator, List, Optional, Tuple
+
+import dateutil.parser
+import pytz
 
 # Disable loggers prior to package imports
 import processor
 
 processor.disable_package_loggers()
 
-import mcmetadata.urls as urls
 from waybacknews.searchapi import SearchApiClient
 
-import processor.database as database
-import processor.database.projects_db as projects_db
-import processor.database.stories_db as stories_db
-import processor.fetcher as fetcher
+import processor.json_fetcher as json_fetcher
 import processor.mcdirectory as mcdirectory
 import processor.projects as projects
+import processor.ratelimit as ratelimit
+import processor.run_ledger as run_ledger
+import processor.run_planner as run_planner
+import processor.sources as sources
+import processor.sources.driver as driver
 import scripts.tasks as tasks
 from processor.classifiers import download_models
+from processor.run_ledger import RunLedger
+from processor.story_buffer import StoryBuffer
 
 POOL_SIZE = 8  # used for fetching project domains and listing stories in parallel
 DEFAULT_DAY_OFFSET = 4  # stories don't get processed for a few days
@@ -33,14 +39,27 @@ PAGE_SIZE = 1000
 MAX_STORIES_PER_PROJECT = (
     3000  # we can't process all the stories for queries that are too big
 )
+MAX_DOMAINS_PER_SHARD = int(
+    os.environ.get("WM_MAX_DOMAINS_PER_SHARD", 500)
+)  # queries with too many domains are slow or fail, so split them up
+QUERY_FIELDS = [
+    "search_terms",
+    "language",
+    "domains",
+]  # projects with the same values for these share a query
+SHARD_THREADS = int(
+    os.environ.get("WM_SHARD_THREADS", 4)
+)  # shards queried at once per project
 
+# every worker thread (and any other fetcher process on this host) shares this, so we stay under the API's limit
+rate_limiter = ratelimit.shared_rate_limiter(processor.SOURCE_WAYBACK_MACHINE)
 
 logger = logging.getLogger(__name__)
 
 
-def load_projects() -> List[Dict]:
+def load_projects(force_reload: bool = True) -> List[Dict]:
     project_list = projects.load_project_list(
-        force_reload=True, overwrite_last_story=False
+        force_reload=force_reload, overwrite_last_story=False
     )
     logger.info("  Found {} projects".format(len(project_list)))
     # return project_list[20:22]
@@ -55,182 +74,280 @@ def _query_builder(terms: str, language: str, domains: List[str]) -> str:
     return f"({terms_no_curlies}) AND ({language_clause}) AND ({domains_clause})"
 
 
-def _project_story_worker(p: Dict) -> List[Dict]:
-    Session = database.get_session_maker()
-    # can't use start_date as `capture_time` filter; ignore last request (results sorted by most recent captures first)
-    start_date, end_date = projects.query_start_end_dates(
-        p,
-        Session,
-        DEFAULT_DAY_OFFSET,
-        DEFAULT_DAY_WINDOW,
-        processor.SOURCE_WAYBACK_MACHINE,
-    )
-    project_stories = []
-    skipped_dupes = 0  # how many URLs do we filter out because they're already in the DB for this project recently
-    page_number = 1
-    full_project_query = _query_builder(p["search_terms"], p["language"], p["domains"])
+def _shard_domains(domains: List[str], shard_size: int) -> List[List[str]]:
+    return [domains[i : i + shard_size] for i in range(0, len(domains), shard_size)]
+
+
+def _count_shard(
+    p: Dict,
+    domains: List[str],
+    start_date: dt.datetime,
+    end_date: dt.datetime,
+    before_request: Callable[[], bool],
+) -> Optional[int]:
+    """
+    :return: how many stories one shard of a project's domains has (None if we couldn't tell)
+    """
+    if not before_request():
+        return None
+    query = _query_builder(p["search_terms"], p["language"], domains)
     try:
-        wm_provider = SearchApiClient("mediacloud")
-        total_hits = wm_provider.count(full_project_query, start_date, end_date)
-        time.sleep(0.1)  # don't hammer the API
-        logger.info(
-            "Project {}/{} - {} total stories from {} domains (since {})".format(
-                p["id"], p["title"], total_hits, len(p["domains"]), start_date
-            )
+        total_hits = SearchApiClient("mediacloud").count(query, start_date, end_date)
+    except Exception as e:
+        # perhaps a query syntax error? the driver counts it from its first page instead (or notes it as failed)
+        logger.warning(f"  {p['id']} - couldn't count a shard: {e}")
+        return None
+    logger.debug(
+        "  {} - {} stories from a shard of {} domains".format(
+            p["id"], total_hits, len(domains)
         )
-        if total_hits > 0:  # don't bother querying if no results to page through
-            # list recent urls to filter so we don't fetch text extra if we've recently proceses already (and will be
-            # filtered out by add_stories call in later post-text-fetch step)
-            with Session() as session:
-                already_processed_urls = stories_db.project_story_normalized_urls(
-                    session, p, 14
+    )
+    return total_hits
+
+
+class WaybackSource(sources.Source):
+    name = processor.SOURCE_WAYBACK_MACHINE
+    query_fields = QUERY_FIELDS
+    # can't use start_date as `capture_time` filter; ignore last request (results sorted by most recent captures
+    # first)
+    day_offset = DEFAULT_DAY_OFFSET
+    day_window = DEFAULT_DAY_WINDOW
+    max_stories_per_project = MAX_STORIES_PER_PROJECT
+    pool_size = POOL_SIZE
+    part_threads = SHARD_THREADS
+    page_size = PAGE_SIZE
+    rate_limiter = rate_limiter
+
+    def query_parts(
+        self,
+        project: Dict,
+        start_date: dt.datetime,
+        end_date: dt.datetime,
+        before_request: Callable[[], bool],
+    ) -> List[sources.QueryPart]:
+        if len(project["domains"]) == 0:
+            logger.warning(f"  project {project['id']} - no domains to query")
+            return []
+        # one huge `domain:(a OR b OR ...)` clause is slow (or fails outright), so query smaller groups of domains in
+        # parallel and merge the results
+        shards = _shard_domains(project["domains"], MAX_DOMAINS_PER_SHARD)
+        with ThreadPoolExecutor(max_workers=SHARD_THREADS) as executor:
+            counts = list(
+                executor.map(
+                    lambda domains: _count_shard(
+                        project, domains, start_date, end_date, before_request
+                    ),
+                    shards,
                 )
-            # using the provider wrapper so this does the chunking into smaller queries for us
-            latest_pub_date = dt.datetime.now() - dt.timedelta(weeks=50)
-            for page in wm_provider.all_articles(
-                full_project_query,
+            )
+        logger.info(
+            "Project {}/{} - {} domains in {} shards (since {})".format(
+                project["id"],
+                project["title"],
+                len(project["domains"]),
+                len(shards),
                 start_date,
-                end_date,
-                domains=p["domains"],
-                page_size=PAGE_SIZE,
-            ):
-                # results are sorted by surt_url ASC, which is exactly helpful for us from a daily fetch perspective
-                if len(project_stories) > MAX_STORIES_PER_PROJECT:
-                    break
-                logger.debug(
-                    "  {} - page {}: {} stories".format(p["id"], page_number, len(page))
-                )
-                # track most recent story across all pages (seems to be sorted default by surt_url asc)
-                try:
-                    page_latest_pub_date = max([s["publication_date"] for s in page])
-                    latest_pub_date = max(latest_pub_date, page_latest_pub_date)
-                    # can't track `capture_time` here because it isn't returned in results
-                except Exception:  # maybe no stories on this page?
-                    pass
-                # prep all stories
-                for item in page:
-                    if len(project_stories) > MAX_STORIES_PER_PROJECT:
-                        break
-                    # skip URLs we've processed recently
-                    if urls.normalize_url(item["url"]) in already_processed_urls:
-                        skipped_dupes += 1
-                        continue
-                    info = dict(
-                        # path to pre-parsed content JSON - so we don't have to fetch and parse the HTML ourselves
-                        extracted_content_url=item["article_url"],
-                        url=item["url"],
-                        # the rest of the pipeline expects a str, @see tasks.queue_stories_for_classification
-                        source_publish_date=str(item["publication_date"]),
-                        title=item["title"],
-                        source=processor.SOURCE_WAYBACK_MACHINE,
-                        project_id=p["id"],
-                        language=item["language"],
-                        authors=None,
-                        media_url=item["domain"],
-                        media_name=item["domain"],  # same as item['media_url']
-                        archived_url=item[
-                            "archive_playback_url"
-                        ],  # the URL to the Wayback Machine provided HTML copy
-                    )
-                    project_stories.append(info)
-                time.sleep(0.1)  # don't hammer the API
-            logger.info(
-                "  project {} - {} stories (skipped {}) (after {})".format(
-                    p["id"], len(project_stories), skipped_dupes, start_date
-                )
             )
-            # after all pages done, update latest pub date so we start at that next time
-            with Session() as session:
-                projects_db.update_history(
-                    session, p["id"], latest_pub_date, processor.SOURCE_WAYBACK_MACHINE
-                )
-    except Exception:
-        # perhaps a query syntax error? log it, but keep going so other projects succeed
-        logger.error(
-            f"  project {p['id']} - failed to fetch stories (likely a query syntax or connection error)"
         )
-        # logger.exception(e) #Ignore Sentry Logging
-    return project_stories[:MAX_STORIES_PER_PROJECT]
+        return [
+            sources.QueryPart(start_date, end_date, count, domains=domains)
+            for domains, count in zip(shards, counts)
+        ]
+
+    def split_part(
+        self,
+        project: Dict,
+        part: sources.QueryPart,
+        before_request: Callable[[], bool],
+    ) -> List[sources.QueryPart]:
+        # results come sorted by surt_url, so a shard being sampled is split by domain (and each half counted); that
+        # way the domains at the end of it get their share too
+        domains = part.options["domains"]
+        if len(domains) < 2:
+            return [part]
+        halves = _shard_domains(domains, (len(domains) + 1) // 2)
+        return [
+            sources.QueryPart(
+                part.start_date,
+                part.end_date,
+                _count_shard(
+                    project, half, part.start_date, part.end_date, before_request
+                ),
+                domains=half,
+            )
+            for half in halves
+        ]
+
+    def list_pages(
+        self,
+        project: Dict,
+        part: sources.QueryPart,
+        cursor: Optional[dt.datetime],
+        before_request: Callable[[], bool],
+    ) -> Iterator[List[Dict]]:
+        domains = part.options["domains"]
+        query = _query_builder(project["search_terms"], project["language"], domains)
+        wm_provider = SearchApiClient("mediacloud")
+        if not before_request():
+            return
+        # using the provider wrapper so this does the chunking into smaller queries for us
+        for page in wm_provider.all_articles(
+            query, part.start_date, part.end_date, domains=domains, page_size=PAGE_SIZE
+        ):
+            yield page
+            # the next page is fetched when we loop
+            if not before_request():
+                return
+
+    def normalize(self, item: Dict, project: Dict) -> Dict:
+        return dict(
+            # path to pre-parsed content JSON - so we don't have to fetch and parse the HTML ourselves
+            extracted_content_url=item["article_url"],
+            url=item["url"],
+            # the rest of the pipeline expects a str, @see tasks.queue_stories_for_classification
+            source_publish_date=str(item["publication_date"]),
+            title=item["title"],
+            source=processor.SOURCE_WAYBACK_MACHINE,
+            project_id=project["id"],
+            language=item["language"],
+            authors=None,
+            media_url=item["domain"],
+            media_name=item["domain"],  # same as item['media_url']
+            archived_url=item[
+                "archive_playback_url"
+            ],  # the URL to the Wayback Machine provided HTML copy
+        )
+
+    def item_date(self, item: Dict) -> dt.datetime:
+        # can't track `capture_time` here because it isn't returned in results
+        publication_date = dateutil.parser.parse(str(item["publication_date"]))
+        if publication_date.tzinfo is not None:
+            publication_date = publication_date.astimezone(pytz.UTC).replace(
+                tzinfo=None
+            )
+        return publication_date
+
+    def fetch_text(
+        self,
+        stories: List[Dict],
+        on_story: Callable[[Dict], None],
+        ledger: Optional[RunLedger] = None,
+        deadline: Optional[float] = None,
+    ) -> int:
+        return fetch_text(stories, on_story, ledger, deadline)
+
+
+source = WaybackSource()
 
 
-def fetch_project_stories(project_list: List[Dict]) -> List[Dict]:
+def fetch_project_stories(
+    project_list: List[Dict],
+    ledger: Optional[RunLedger] = None,
+    deadline: Optional[float] = None,
+) -> Tuple[List[Dict], str]:
     """
-    Fetch stories in parallel by project. Efficient because it is mostly IO-bound. Would be smarter to use async calls
-    here but I don't think the underlying API call is async compatible yet.
+    Fetch the story URLs for every project (see `processor.sources.driver.collect_stories`).
     :param project_list:
-    :return:
+    :param ledger: optional run ledger; projects already listed earlier in this run aren't queried again
+    :param deadline: optional epoch secs to be done listing by
+    :return: the stories, and a note for the email about any projects cut short by the deadline
     """
-    with Pool(POOL_SIZE) as p:
-        lists_of_stories = p.map(_project_story_worker, project_list)
-    # flatten list of lists of stories into one big list
-    combined_stories = [s for s in itertools.chain.from_iterable(lists_of_stories)]
-    logger.info(
-        "Fetched {} total URLs from {}".format(
-            len(combined_stories), processor.SOURCE_WAYBACK_MACHINE
-        )
-    )
-    return combined_stories
+    return driver.collect_stories(source, project_list, ledger, deadline)
 
 
-def fetch_text(stories: List[Dict]) -> List[Dict]:
-    stories_to_return = []
+def fetch_text(
+    stories: List[Dict],
+    on_story: Callable[[Dict], None],
+    ledger: Optional[RunLedger] = None,
+    deadline: Optional[float] = None,
+) -> int:
+    """
+    Fetch the text for all the stories, handing each one to `on_story` as soon as it is ready.
+    :param ledger: optional run ledger to record which stories were fetched and which failed (including any the
+                   deadline stopped us getting to)
+    :param deadline: optional epoch secs to stop fetching by
+    :return: the number of stories we got text for
+    """
+    text_count = 0
+    # match up stories based on `extracted_content_url`, because we are fetching from that and not the actual story URL
+    stories_by_url = collections.defaultdict(list)
+    for s in stories:
+        stories_by_url[s["extracted_content_url"]].append(s)
 
     def handle_parse(response_data: Dict):
-        # called for each story that successfully is fetched by Scrapy
-        nonlocal stories, stories_to_return
-        try:
-            story_details = json.loads(response_data["content"])
-            # find matching stories in the original input list based on `extracted_content_url`, because we are
-            # fetching from that and not he actual story URL
-            matching_input_stories = [
-                s
-                for s in stories
-                if s["extracted_content_url"] == response_data["original_url"]
-            ]
-            for s in matching_input_stories:
-                s["story_text"] = story_details["snippet"]
-                stories_to_return.append(s)
-        except Exception as e:
+        # called for each story whose content JSON is successfully fetched
+        nonlocal text_count
+        snippet = response_data["content"]["snippet"]
+        if snippet is None:
             # this just happens occasionally so it is a normal case
             logger.warning(
-                f"Skipping story - failed to fetch due to {e} - from {response_data['original_url']}"
+                f"Skipping story - no snippet in content from {response_data['original_url']}"
             )
+            return
+        for s in stories_by_url[response_data["original_url"]]:
+            s["story_text"] = snippet
+            text_count += 1
+            if ledger:
+                ledger.mark([s], run_ledger.FETCHED)
+            on_story(s)
 
     # download them all in parallel... will take a while (note that we're fetching the extracted content JSON here,
-    # NOT the archived or original HTML because that saves us the parsing and extraction step)
-    unique_urls = list(set([s["extracted_content_url"] for s in stories]))
-    fetcher.fetch_all_html(unique_urls, handle_parse)
+    # NOT the archived or original HTML because that saves us the parsing and extraction step). These are all small
+    # docs from one host, so skip the crawler and use a pool of keep-alive connections.
+    fetch_summary = json_fetcher.fetch_all_json(
+        list(stories_by_url.keys()), handle_parse, fields=["snippet"], deadline=deadline
+    )
+    fetch_summary["crawl_stats"].save(processor.SOURCE_WAYBACK_MACHINE)
+    if ledger:
+        ledger.mark(
+            [s for s in stories if ledger.status(s) == run_ledger.LISTED],
+            run_ledger.FAILED,
+        )
     logger.info(
         "Fetched text for {} stories (failed on {})".format(
-            len(stories_to_return), len(stories) - len(stories_to_return)
+            text_count, len(stories) - text_count
         )
     )
-    return stories_to_return
+    return text_count
 
 
-if __name__ == "__main__":
+def run(
+    force_reload: bool = True, deadline_secs: float = run_planner.RUN_DEADLINE_SECS
+) -> None:
+    """
+    One fetch run, from listing the projects to sending the summary.
+    :param force_reload: get the latest project list from the main server first (the scheduler daemon keeps its own
+                         copy up to date, see scripts.fetch_scheduler)
+    :param deadline_secs: how long the run can take, 0 for no deadline (listing gets `run_planner.LIST_TIME_SHARE` of
+                          it, the rest is left for fetching the text)
+    """
     logger.info("Starting {} story fetch job".format(processor.SOURCE_WAYBACK_MACHINE))
-
-    # important to do because there might be new models on the server!
-    logger.info("  Checking for any new models we need")
-    models_downloaded = download_models()
-    logger.info(f"    models downloaded: {models_downloaded}")
-    if not models_downloaded:
-        sys.exit(1)
     start_time = time.time()
+    fetch_deadline = run_planner.run_deadline(start_time, deadline_secs)
 
     # 1. list all the project we need to work on
-    projects_list = load_projects()
+    projects_list = load_projects(force_reload)
     logger.info("Working with {} projects".format(len(projects_list)))
 
-    # 2. figure out domains to query for each project
-    with Pool(POOL_SIZE) as p:
-        projects_with_domains = p.map(
-            mcdirectory.fetch_domains_for_projects, projects_list
-        )
+    # 2. figure out domains to query for each project (each collection is only looked up once, and cached on disk)
+    projects_with_domains = mcdirectory.add_domains_to_projects(projects_list)
 
-    # 3. fetch all the urls from for each project from wayback machine (serially so we don't have to flatten 😖)
-    all_stories = fetch_project_stories(projects_with_domains)
+    # 3. fetch all the urls from for each project from wayback machine (serially so we don't have to flatten 😖),
+    # picking up where an interrupted run with the same run id left off
+    ledger = (
+        RunLedger(processor.SOURCE_WAYBACK_MACHINE)
+        if run_ledger.RUN_LEDGER_ENABLED
+        else None
+    )
+    all_stories, cut_text = fetch_project_stories(
+        projects_with_domains,
+        ledger,
+        run_planner.run_deadline(
+            start_time, deadline_secs, run_planner.LIST_TIME_SHARE
+        ),
+    )
+    if ledger:
+        all_stories = ledger.remaining(all_stories)
     unique_url_count = len(set([s["extracted_content_url"] for s in all_stories]))
     logger.info(
         "Discovered {} total stories, {} unique URLs".format(
@@ -239,18 +356,37 @@ if __name__ == "__main__":
     )
 
     # 4. fetch pre-parsed content (will happen in parallel by story)
-    stories_with_text = fetch_text(all_stories)
+    # 5. post batches of stories for classification
+    if tasks.STREAM_QUEUEING:
+        # queue them up as their text arrives, so classification overlaps with fetching
+        queuer = tasks.StreamingStoryQueuer(
+            projects_list, processor.SOURCE_WAYBACK_MACHINE, ledger=ledger
+        )
+        text_count = fetch_text(all_stories, queuer.add, ledger, fetch_deadline)
+        results_data = queuer.finish()
+    else:
+        # keep the texts on disk until it is time to queue them, so memory doesn't grow with the size of the run
+        with StoryBuffer() as story_buffer:
+            text_count = fetch_text(
+                all_stories, story_buffer.add, ledger, fetch_deadline
+            )
+            results_data = tasks.queue_stories_for_classification(
+                projects_list,
+                story_buffer,
+                processor.SOURCE_WAYBACK_MACHINE,
+                ledger=ledger,
+            )
+    if ledger:
+        ledger.finish()
+    results_data["email_text"] += cut_text + driver.fetch_cut_text(
+        len(all_stories), text_count, fetch_deadline
+    )
     logger.info(
         "Fetched {} stories with text, from {} attempted URLs".format(
-            len(stories_with_text), unique_url_count
+            text_count, unique_url_count
         )
     )
 
-    # 5. post batches of stories for classification
-    results_data = tasks.queue_stories_for_classification(
-        projects_list, stories_with_text, processor.SOURCE_WAYBACK_MACHINE
-    )
-
     # 6. send email/slack_msg with results of operations
     tasks.send_combined_slack_message(
         results_data, processor.SOURCE_WAYBACK_MACHINE, start_time
@@ -258,3 +394,13 @@ if __name__ == "__main__":
     tasks.send_combined_email(
         results_data, processor.SOURCE_WAYBACK_MACHINE, start_time
     )
+
+
+if __name__ == "__main__":
+    # important to do because there might be new models on the server!
+    logger.info("  Checking for any new models we need")
+    models_downloaded = download_models()
+    logger.info(f"    models downloaded: {models_downloaded}")
+    if not models_downloaded:
+        sys.exit(1)
+    run()
@@ -1,18 +1,32 @@
+import collections
+import datetime as dt
 import logging
+import os
+import queue
+import threading
 import time
-from typing import Dict, List
+from typing import Dict, List, Optional, Tuple, Union
 
 import dateutil.parser
 
 import processor.database as database
 import processor.notifications as notifications
+import processor.run_ledger as run_ledger
 import processor.tasks.classification as classification_tasks
 from processor import VERSION, get_email_config, get_slack_config, is_email_configured
 from processor.database import projects_db as projects_db
 from processor.database import stories_db as stories_db
+from processor.run_ledger import RunLedger
+from processor.story_buffer import StoryBuffer
 
 logger = logging.getLogger(__name__)
 
+# queue stories up for classification as soon as their text is fetched, rather than after all fetching is done
+STREAM_QUEUEING = os.environ.get("STREAM_QUEUEING", "false").lower() == "true"
+# when streaming, queue a project's stories once we have this many, or the oldest one has waited this long
+STREAM_BATCH_SIZE = int(os.environ.get("STREAM_BATCH_SIZE", 100))
+STREAM_MAX_WAIT_SECS = int(os.environ.get("STREAM_MAX_WAIT_SECS", 120))
+
 
 def send_combined_email(summary: Dict, data_source: str, start_time: float):
     email_message = _get_combined_text(
@@ -112,48 +126,79 @@ def _send_slack_message(
         logger.info("Not sending any slack updates")
 
 
+def _queue_project_stories(
+    project: Dict,
+    project_stories: List[Dict],
+    datasource: str,
+    reset_pool: bool = False,
+    latest_date: Optional[dt.datetime] = None,
+    ledger: Optional[RunLedger] = None,
+) -> Tuple[List[Dict], Optional[dt.datetime]]:
+    """
+    Log a batch of stories from one project to the DB and queue the new ones up for classification.
+    :return: the stories that were queued, and the latest publish date we've now recorded in the project history
+    """
+    batch = project_stories
+    # External source has guessed dates (Newscatcher/Google), so use that
+    for s in project_stories:
+        if "source_publish_date" in s:
+            s["publish_date"] = s["source_publish_date"]
+    Session = database.get_session_maker(reset_pool=reset_pool)
+    with Session() as session:
+        project_stories = stories_db.add_stories(
+            session, project_stories, project, datasource
+        )
+        if len(project_stories) > 0:  # don't queue up unnecessary tasks
+            classification_tasks.classify_and_post_worker.delay(
+                project, project_stories
+            )
+            # important to write this update now, because we have queued up the task to process these
+            # stories the task queue will manage retrying with the stories if it fails with this batch
+            publish_dates = [
+                dateutil.parser.parse(s["source_publish_date"]) for s in project_stories
+            ]
+            # we use latest pub_date to filter in our queries tomorrow
+            batch_latest_date = max(publish_dates)
+            if (latest_date is None) or (batch_latest_date > latest_date):
+                latest_date = batch_latest_date
+            projects_db.update_history(session, project["id"], latest_date, datasource)
+    if ledger:
+        # the whole batch is dealt with now, including any that were already in the DB
+        ledger.mark(batch, run_ledger.QUEUED)
+    return project_stories, latest_date
+
+
 def queue_stories_for_classification(
-    project_list: List[Dict], stories: List[Dict], datasource: str
+    project_list: List[Dict],
+    stories: Union[List[Dict], StoryBuffer],
+    datasource: str,
+    ledger: Optional[RunLedger] = None,
 ) -> Dict:
+    """
+    Log and queue up all the stories, project by project.
+    :param stories: a list of story dicts with text, or a StoryBuffer (so only one project's text is read in at a time)
+    :param ledger: optional run ledger to record which stories have been queued
+    """
     total_stories = 0
     email_message = ""
     for p in project_list:
-        project_stories = [
-            s for s in stories if (s is not None) and (s["project_id"] == p["id"])
-        ]
+        if isinstance(stories, StoryBuffer):
+            project_stories = stories.project_stories(p["id"])
+        else:
+            project_stories = [
+                s for s in stories if (s is not None) and (s["project_id"] == p["id"])
+            ]
         email_message += "Project {} - {}: {} stories\n".format(
             p["id"], p["title"], len(project_stories)
         )
         total_stories += len(project_stories)
         if len(project_stories) > 0:
-            # External source has guessed dates (Newscatcher/Google), so use that
-            for s in project_stories:
-                if "source_publish_date" in s:
-                    s["publish_date"] = s["source_publish_date"]
             # and log that we got and queued them all (this might happen a loooooong time after we last used the DB,
             # so lets be careful here and reset the engine before using the session)
             try:
-                Session = database.get_session_maker(reset_pool=True)
-                with Session() as session:
-                    project_stories = stories_db.add_stories(
-                        session, project_stories, p, datasource
-                    )
-                    if len(project_stories) > 0:  # don't queue up unnecessary tasks
-                        classification_tasks.classify_and_post_worker.delay(
-                            p, project_stories
-                        )
-                        # important to write this update now, because we have queued up the task to process these
-                        # stories the task queue will manage retrying with the stories if it fails with this batch
-                        publish_dates = [
-                            dateutil.parser.parse(s["source_publish_date"])
-                            for s in project_stories
-                        ]
-                        latest_date = max(
-                            publish_dates
-                        )  # we use latest pub_date to filter in our queries tomorrow
-                        projects_db.update_history(
-                            session, p["id"], latest_date, datasource
-                        )
+                project_stories, _ = _queue_project_stories(
+                    p, project_stories, datasource, reset_pool=True, ledger=ledger
+                )
                 logger.info(
                     "  queued {} stories for project {}/{}".format(
                         len(project_stories), p["id"], p["title"]
@@ -165,3 +210,138 @@ def queue_stories_for_classification(
     return dict(
         email_text=email_message, project_count=len(project_list), stories=total_stories
     )
+
+
+_STOP_QUEUER = object()
+
+
+class StreamingStoryQueuer:
+    """
+    Queue stories for classification as they arrive (ie. as soon as their text is extracted), instead of waiting until
+    every story has been fetched. Stories are held in per-project buffers, and each buffer is flushed to the DB and
+    Celery once it has `batch_size` stories or its oldest story has waited `max_wait_secs`. This gets workers going
+    while fetching is still happening, and bounds how many story texts we hold in memory at once.
+    `add` is called from the crawler's parse callback, so it only hands full batches off - the DB writes and Celery
+    calls happen on a worker thread, where they can't hold up the crawl. Call `finish` when fetching is done.
+    """
+
+    def __init__(
+        self,
+        project_list: List[Dict],
+        datasource: str,
+        batch_size: int = STREAM_BATCH_SIZE,
+        max_wait_secs: float = STREAM_MAX_WAIT_SECS,
+        ledger: Optional[RunLedger] = None,
+    ):
+        self._projects = {p["id"]: p for p in project_list}
+        self._datasource = datasource
+        self._batch_size = batch_size
+        self._max_wait_secs = max_wait_secs
+        self._ledger = ledger
+        self._buffers: Dict[int, List[Dict]] = collections.defaultdict(list)
+        self._buffer_started: Dict[int, float] = {}
+        self._latest_dates: Dict[int, dt.datetime] = {}
+        self._story_counts: Dict[int, int] = collections.defaultdict(int)
+        self._queued_counts: Dict[int, int] = collections.defaultdict(int)
+        self._lock = threading.Lock()
+        self._pool_reset = False
+        self._batches: queue.Queue = queue.Queue()
+        self._worker = threading.Thread(
+            target=self._work, name="story-queuer", daemon=True
+        )
+        self._worker.start()
+
+    def add(self, story: Dict) -> None:
+        with self._lock:
+            project_id = story["project_id"]
+            if project_id not in self._buffer_started:
+                self._buffer_started[project_id] = time.time()
+            self._buffers[project_id].append(story)
+            self._story_counts[project_id] += 1
+            if len(self._buffers[project_id]) >= self._batch_size:
+                self._batches.put(self._take(project_id))
+
+    def _take(self, project_id: int) -> Tuple[int, List[Dict]]:
+        # call with the lock held
+        self._buffer_started.pop(project_id, None)
+        return project_id, self._buffers.pop(project_id, [])
+
+    def _take_stale(self) -> List[Tuple[int, List[Dict]]]:
+        now = time.time()
+        with self._lock:
+            return [
+                self._take(project_id)
+                for project_id, started in list(self._buffer_started.items())
+                if (now - started) >= self._max_wait_secs
+            ]
+
+    def _work(self) -> None:
+        # check for buffers that have waited too long even if no new stories are coming in
+        poll_secs = max(0.1, min(1.0, self._max_wait_secs))
+        while True:
+            try:
+                batch = self._batches.get(timeout=poll_secs)
+            except queue.Empty:
+                batch = None
+            if batch is _STOP_QUEUER:
+                return
+            if batch is not None:
+                self._flush(*batch)
+            for stale_batch in self._take_stale():
+                self._flush(*stale_batch)
+
+    def _flush(self, project_id: int, project_stories: List[Dict]) -> None:
+        if len(project_stories) == 0:
+            return
+        project = self._projects[project_id]
+        try:
+            queued_stories, self._latest_dates[project_id] = _queue_project_stories(
+                project,
+                project_stories,
+                self._datasource,
+                # listing stories might have taken a long time, so reset the engine before the first use
+                reset_pool=not self._pool_reset,
+                latest_date=self._latest_dates.get(project_id),
+                ledger=self._ledger,
+            )
+            self._pool_reset = True
+            self._queued_counts[project_id] += len(queued_stories)
+            logger.info(
+                "  queued {} stories for project {}/{}".format(
+                    len(queued_stories), project["id"], project["title"]
+                )
+            )
+        except Exception as e:
+            # could be amqp.exceptions.PreconditionFailed if message it too big, just skip it
+            logger.warning("Too big for celery, skipping: {}".format(e))
+        # the text has been handed off to the queue, so don't hold on to it
+        for s in project_stories:
+            s.pop("story_text", None)
+
+    def finish(self) -> Dict:
+        """
+        Flush anything left in the buffers, and wait for every batch to be queued.
+        :return: a summary with the same keys as `queue_stories_for_classification` returns
+        """
+        with self._lock:
+            for project_id in list(self._buffers.keys()):
+                self._batches.put(self._take(project_id))
+        self._batches.put(_STOP_QUEUER)
+        self._worker.join()
+        email_message = ""
+        for p in self._projects.values():
+            email_message += "Project {} - {}: {} stories\n".format(
+                p["id"], p["title"], self._story_counts[p["id"]]
+            )
+        logger.info(
+            "Queued {} stories (of {} fetched) across {} projects".format(
+                sum(self._queued_counts.values()),
+                sum(self._story_counts.values()),
+                len(self._projects),
+            )
+        )
+        return dict(
+            email_text=email_message,
+            project_count=len(self._projects),
+            stories=sum(self._story_counts.values()),
+        )
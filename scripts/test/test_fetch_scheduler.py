@@ -0,0 +1,118 @@
+import threading
+import time
+import types
+import unittest
+from unittest import mock
+
+import scripts.fetch_scheduler as fetch_scheduler
+from processor.fetch_schedule import SourceSchedule
+
+
+class StubFetcher(types.ModuleType):
+    # stands in for one of the scripts.queue_*_stories modules, holding each run until we let it finish
+    def __init__(self, name: str):
+        super().__init__(name)
+        self.calls = []
+        self.started = threading.Event()
+        self.release = threading.Event()
+
+    def run(self, force_reload: bool = True, deadline_secs: float = None):
+        self.calls.append(dict(force_reload=force_reload, deadline_secs=deadline_secs))
+        self.started.set()
+        self.release.wait(5)
+
+
+class TestFetchScheduler(unittest.TestCase):
+    def setUp(self):
+        self.fetchers = {}
+
+        def import_module(name):
+            return self.fetchers.setdefault(name, StubFetcher(name))
+
+        for patcher in [
+            mock.patch.object(
+                fetch_scheduler.importlib, "import_module", side_effect=import_module
+            ),
+            mock.patch.object(fetch_scheduler, "download_models", return_value=True),
+            mock.patch.object(fetch_scheduler.projects, "load_project_list"),
+            mock.patch.object(fetch_scheduler, "RUN_ON_START", True),
+            mock.patch.object(fetch_scheduler.run_planner, "RUN_DEADLINE_SECS", 0),
+        ]:
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        self.addCleanup(self._release_all)
+
+    def _release_all(self):
+        for fetcher in self.fetchers.values():
+            fetcher.release.set()
+
+    def _fetcher(self, source: str) -> StubFetcher:
+        return self.fetchers[fetch_scheduler.FETCHERS[source][0]]
+
+    def _finish(self, scheduler: fetch_scheduler.FetchScheduler, source: str):
+        self._fetcher(source).release.set()
+        scheduler._threads[source].join(5)
+
+    def test_tick_runs_due_source(self):
+        scheduler = fetch_scheduler.FetchScheduler(
+            [SourceSchedule("media-cloud", 24, jitter_secs=0)]
+        )
+        now = time.time()
+        scheduler.tick(now)
+        fetcher = self._fetcher("media-cloud")
+        assert fetcher.started.wait(5)
+        assert scheduler.running() == ["media-cloud"]
+        # with no deadline configured it has to be done by its next slot
+        next_slot = scheduler._next_runs["media-cloud"][0]
+        assert fetcher.calls == [
+            dict(force_reload=False, deadline_secs=next_slot - now)
+        ]
+        assert 0 < fetcher.calls[0]["deadline_secs"] <= 24 * 60 * 60
+        self._finish(scheduler, "media-cloud")
+        assert scheduler.running() == []
+
+    def test_tick_skips_slot_while_running(self):
+        scheduler = fetch_scheduler.FetchScheduler(
+            [SourceSchedule("media-cloud", 24, jitter_secs=0)]
+        )
+        scheduler.tick(time.time())
+        fetcher = self._fetcher("media-cloud")
+        assert fetcher.started.wait(5)
+        # its next slot comes up while the first run is still going
+        next_slot, due = scheduler._next_runs["media-cloud"]
+        scheduler.tick(due)
+        assert len(fetcher.calls) == 1
+        assert scheduler._next_runs["media-cloud"][0] > next_slot
+        self._finish(scheduler, "media-cloud")
+
+    def test_tick_concurrency_limit(self):
+        sources = ["media-cloud", "wayback-machine", "newscatcher"]
+        with mock.patch.object(fetch_scheduler, "MAX_CONCURRENT_RUNS", 2):
+            scheduler = fetch_scheduler.FetchScheduler(
+                [SourceSchedule(s, 24, jitter_secs=0) for s in sources]
+            )
+            scheduler.tick(time.time())
+            assert sorted(scheduler.running()) == ["media-cloud", "wayback-machine"]
+            assert self._fetcher("newscatcher").calls == []
+            # once a spot frees up, the source that was waiting starts
+            self._finish(scheduler, "media-cloud")
+            scheduler.tick(time.time())
+            assert self._fetcher("newscatcher").started.wait(5)
+            assert sorted(scheduler.running()) == ["newscatcher", "wayback-machine"]
+
+    def test_tick_without_models(self):
+        scheduler = fetch_scheduler.FetchScheduler(
+            [SourceSchedule("media-cloud", 24, jitter_secs=0)]
+        )
+        now = time.time()
+        fetch_scheduler.download_models.return_value = False
+        scheduler.tick(now)
+        assert scheduler.running() == []
+        assert self._fetcher("media-cloud").calls == []
+        assert (
+            scheduler._next_runs["media-cloud"][1] == now + fetch_scheduler.RETRY_SECS
+        )
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,126 @@
+import datetime as dt
+import unittest
+from unittest import mock
+
+import processor.sources.driver as driver
+import scripts.queue_mediacloud_stories as queue_mediacloud_stories
+
+START = dt.datetime(2025, 10, 1, 12, 0, 0, tzinfo=dt.timezone.utc)
+PROJECT = dict(
+    id=1, title="one", search_terms="femicide", language="en", media_collections=[1]
+)
+
+
+class FakeSearchApi:
+    """
+    Matches far more stories than a project can use, so the query gets sampled.
+    """
+
+    def __init__(self):
+        self.expanded = []
+        self.text_calls = 0
+
+    def story_count(self, q, pub_start_date, pub_end_date, collection_ids):
+        return dict(relevant=20000)
+
+    def story_list(
+        self,
+        q,
+        pub_start_date,
+        pub_end_date,
+        collection_ids,
+        pagination_token,
+        page_size,
+        sort_order,
+        expanded,
+    ):
+        self.expanded.append(expanded)
+        stories = [
+            dict(
+                id=i,
+                url=f"https://example.com/{i}/",
+                publish_date=dt.date(2025, 10, 1),
+                indexed_date=START - dt.timedelta(minutes=i),
+                media_url=f"example{i % 3}.com",
+                text=f"text {i}" if expanded else None,
+            )
+            for i in range(page_size)
+        ]
+        return stories, None
+
+    def story(self, story_id):
+        self.text_calls += 1
+        return dict(text=f"text {story_id}")
+
+
+class TestMediaCloudSampling(unittest.TestCase):
+    def setUp(self):
+        self.mc = FakeSearchApi()
+        self.queued = []
+        patches = [
+            mock.patch.object(
+                queue_mediacloud_stories, "get_mc_client", return_value=self.mc
+            ),
+            mock.patch.object(queue_mediacloud_stories.rate_limiter, "acquire"),
+            mock.patch.object(queue_mediacloud_stories, "STORIES_PER_PAGE", 30),
+            mock.patch.object(queue_mediacloud_stories, "SLICE_MAX_STORIES", 1000000),
+            mock.patch.object(
+                queue_mediacloud_stories.MediaCloudSource,
+                "story_caps",
+                return_value={PROJECT["id"]: 10},
+            ),
+            mock.patch.object(queue_mediacloud_stories.database, "get_session_maker"),
+            mock.patch.object(
+                queue_mediacloud_stories.stories_db,
+                "project_existing_normalized_urls",
+                return_value=set(),
+            ),
+            mock.patch.object(driver.database, "get_session_maker"),
+            mock.patch.object(
+                driver.projects,
+                "group_start_end_dates",
+                return_value=(START - dt.timedelta(days=4), START),
+            ),
+            mock.patch.object(
+                driver.projects,
+                "group_recent_normalized_urls",
+                return_value=({PROJECT["id"]: set()}, set()),
+            ),
+            mock.patch.object(
+                driver, "_history_cursors", return_value={PROJECT["id"]: None}
+            ),
+            mock.patch.object(driver.projects_db, "update_history"),
+        ]
+        for patcher in patches:
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def _on_stories(self, project, stories):
+        self.queued += stories
+        return len(stories)
+
+    def _list(self):
+        return driver.list_stories(
+            queue_mediacloud_stories.MediaCloudSource(), [PROJECT], self._on_stories
+        )
+
+    def test_sampled_pool_has_text(self):
+        results = self._list()
+        # the pool is listed with its text, so there's no call per story to get it
+        assert self.mc.expanded == [True]
+        assert self.mc.text_calls == 0
+        assert len(self.queued) == 10
+        assert all(s["story_text"] for s in self.queued)
+        assert "sampled" in results[0]["email_text"]
+
+    def test_two_phase_fetch(self):
+        with mock.patch.object(queue_mediacloud_stories, "TWO_PHASE_FETCH", True):
+            self._list()
+        # only the stories in the sample get their text fetched
+        assert self.mc.expanded == [False]
+        assert self.mc.text_calls == 10
+        assert len(self.queued) == 10
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,86 @@
+import threading
+import time
+import unittest
+from unittest import mock
+
+import scripts.tasks as tasks
+
+PROJECTS = [dict(id=1, title="one"), dict(id=2, title="two")]
+
+
+class TestStreamingStoryQueuer(unittest.TestCase):
+    def setUp(self):
+        self.batches = []
+        self.queued = threading.Event()
+
+        def queue_project_stories(project, project_stories, *args, **kwargs):
+            self.batches.append(
+                (
+                    project["id"],
+                    [s["url"] for s in project_stories],
+                    threading.current_thread(),
+                )
+            )
+            self.queued.set()
+            return project_stories, None
+
+        patcher = mock.patch.object(
+            tasks, "_queue_project_stories", side_effect=queue_project_stories
+        )
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def _story(self, project_id: int, url: str) -> dict:
+        return dict(project_id=project_id, url=url, story_text="text")
+
+    def test_batch_size(self):
+        queuer = tasks.StreamingStoryQueuer(
+            PROJECTS, "test", batch_size=2, max_wait_secs=60
+        )
+        stories = [self._story(1, "a"), self._story(2, "b"), self._story(1, "c")]
+        for s in stories:
+            queuer.add(s)
+        assert self.queued.wait(5)
+        # a full batch goes off on its own, and not on the thread that added it
+        assert self.batches[0][:2] == (1, ["a", "c"])
+        assert self.batches[0][2] is not threading.current_thread()
+        summary = queuer.finish()
+        assert [b[:2] for b in self.batches] == [(1, ["a", "c"]), (2, ["b"])]
+        assert summary["stories"] == 3
+        assert summary["project_count"] == 2
+        # once queued, we don't hang on to the text
+        assert all("story_text" not in s for s in stories)
+
+    def test_max_wait(self):
+        queuer = tasks.StreamingStoryQueuer(
+            PROJECTS, "test", batch_size=100, max_wait_secs=0.2
+        )
+        queuer.add(self._story(2, "a"))
+        # nothing else arrives, but the batch is still flushed once it has waited long enough
+        assert self.queued.wait(5)
+        assert [b[:2] for b in self.batches] == [(2, ["a"])]
+        queuer.finish()
+        assert len(self.batches) == 1
+
+    def test_add_does_not_block(self):
+        release = threading.Event()
+
+        def slow_queue(project, project_stories, *args, **kwargs):
+            release.wait(5)
+            return project_stories, None
+
+        tasks._queue_project_stories.side_effect = slow_queue
+        queuer = tasks.StreamingStoryQueuer(
+            PROJECTS, "test", batch_size=1, max_wait_secs=60
+        )
+        start = time.time()
+        for i in range(5):
+            queuer.add(self._story(1, str(i)))
+        assert time.time() - start < 1
+        release.set()
+        assert queuer.finish()["stories"] == 5
+        assert tasks._queue_project_stories.call_count == 5
+
+
+if __name__ == "__main__":
+    unittest.main()